@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+"""Micro-benchmarks for igotchuu's progress pipeline.
+
+Replaces `restic` with `fake_restic.py` and measures:
+
+ - decode: `Restic.progress_iter` reading the stub's output
+ - dbus: publishing progress on a private `dbus-daemon`, both through
+   `ProgressPublisher` and by emitting an unthrottled `Progress` signal
+   for every message
+ - render: formatting the progress line for a terminal and for a log
+
+Each case runs in a process of its own, so that its peak RSS isn't
+the largest one of the cases before it. Results can be saved with
+`--json` and compared against a previous run with `--baseline`.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_restic
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def status_objects(args):
+    from igotchuu.restic import StatusMessage
+    return [
+        StatusMessage.from_json(message)
+        for message in fake_restic.status_messages(args.messages, args.current_files, args.path_length)
+    ]
+
+
+def result(messages, wall, cpu):
+    return {
+        "messages_per_second": messages / wall if wall else float("inf"),
+        "us_per_message": wall / messages * 1e6,
+        "cpu_us_per_message": cpu / messages * 1e6,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def bench_decode(args, coalesce_status):
+    from igotchuu.restic import Restic
+    with tempfile.TemporaryDirectory() as bindir:
+        stub = os.path.join(bindir, "restic")
+        with open(stub, "w") as f:
+            f.write(f"#!/bin/sh\nexec {sys.executable} {os.path.join(HERE, 'fake_restic.py')} \"$@\"\n")
+        os.chmod(stub, 0o755)
+        env = dict(os.environ)
+        env.update({
+            "PATH": bindir + os.pathsep + env.get("PATH", ""),
+            "IGOTCHUU_BENCH_MESSAGES": str(args.messages),
+            "IGOTCHUU_BENCH_RATE": str(args.rate),
+            "IGOTCHUU_BENCH_CURRENT_FILES": str(args.current_files),
+            "IGOTCHUU_BENCH_PATH_LENGTH": str(args.path_length),
+            "IGOTCHUU_BENCH_ERROR_EVERY": str(args.error_every),
+        })
+        cpu = cpu_time()
+        started = time.perf_counter()
+        restic = Restic.backup(places=["/"], env=env)
+        yielded = sum(1 for _ in restic.progress_iter(coalesce_status=coalesce_status))
+        wall = time.perf_counter() - started
+        cpu = cpu_time() - cpu
+    stats = result(args.messages, wall, cpu)
+    stats["yielded"] = yielded
+    return stats
+
+
+def bench_dbus(args, mode):
+    try:
+        from gi.repository import Gio, GLib
+    except ImportError:
+        return {"skipped": "PyGObject is not available"}
+    from igotchuu.manager import DBusBackupManagerInterface
+    from igotchuu.publisher import STATUS_FIELDS
+
+    try:
+        daemon = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+            stdout=subprocess.PIPE, text=True
+        )
+    except FileNotFoundError:
+        return {"skipped": "dbus-daemon is not available"}
+    try:
+        address = daemon.stdout.readline().strip()
+        con = Gio.DBusConnection.new_for_address_sync(
+            address,
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT
+            | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None, None
+        )
+        manager = DBusBackupManagerInterface(con, rate=args.dbus_rate)
+        messages = status_objects(args)
+        signature = "(" + "".join(sig for _, sig in STATUS_FIELDS) + ")"
+
+        cpu = cpu_time()
+        started = time.perf_counter()
+        for message in messages:
+            if mode == "publisher":
+                manager.publisher.progress(message)
+                continue
+            con.emit_signal(
+                None, manager.publish_path, manager.interface_name, "Progress",
+                GLib.Variant(signature, (
+                    message.seconds_elapsed, message.seconds_remaining or 0,
+                    float(message.percent_done), message.total_files,
+                    message.files_done, message.total_bytes or 0,
+                    message.bytes_done, message.error_count,
+                    list(message.current_files)
+                ))
+            )
+        con.flush_sync(None)
+        stats = result(len(messages), time.perf_counter() - started, cpu_time() - cpu)
+        manager.unregister()
+        con.close_sync(None)
+        return stats
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def bench_render(args, mode):
+    from igotchuu.render import Renderer
+    messages = status_objects(args)
+    renderer = Renderer(stdout=io.StringIO(), stderr=io.StringIO())
+    renderer.tty = mode == "tty"
+    cpu = cpu_time()
+    started = time.perf_counter()
+    for message in messages:
+        renderer.update(message)
+        renderer.render()
+    return result(len(messages), time.perf_counter() - started, cpu_time() - cpu)
+
+
+# (benchmark, path in the results, function)
+CASES = [
+    ("decode", ("decode",), lambda args: bench_decode(args, coalesce_status=False)),
+    ("decode", ("decode_coalesced",), lambda args: bench_decode(args, coalesce_status=True)),
+    ("dbus", ("dbus", "publisher"), lambda args: bench_dbus(args, "publisher")),
+    ("dbus", ("dbus", "unthrottled"), lambda args: bench_dbus(args, "unthrottled")),
+    ("render", ("render", "tty"), lambda args: bench_render(args, "tty")),
+    ("render", ("render", "log"), lambda args: bench_render(args, "log")),
+]
+
+
+def run_case(name):
+    """Run the case `name` in a new process, with the same options."""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--case", name],
+        stdout=subprocess.PIPE, text=True, check=True
+    ).stdout
+    return json.loads(output)
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="status messages per run")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s sent by the stub, 0 for unlimited")
+    parser.add_argument("--current-files", type=int, default=2, help="entries in current_files")
+    parser.add_argument("--path-length", type=int, default=60, help="length of each current file path")
+    parser.add_argument("--error-every", type=int, default=0, help="emit an error every N status messages")
+    parser.add_argument("--dbus-rate", type=float, default=4.0, help="ProgressPublisher rate limit (Hz)")
+    parser.add_argument("--only", choices=("decode", "dbus", "render"), action="append", help="run only these benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved with --json")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        for _, path, function in CASES:
+            if ".".join(path) == args.case:
+                json.dump(function(args), sys.stdout)
+                return
+        parser.error(f"unknown case {args.case}")
+
+    only = args.only or ("decode", "dbus", "render")
+    results = {}
+    for benchmark, path, _ in CASES:
+        if benchmark not in only:
+            continue
+        parent = results
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[path[-1]] = run_case(".".join(path))
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = dict(flatten(json.load(f)))
+    for key, value in flatten(results):
+        line = f"{key:<48} {value:>14.2f}" if isinstance(value, float) else f"{key:<48} {value!s:>14}"
+        old = baseline.get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  ({(value - old) / old:+.1%})"
+        print(line)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+"""Start-up time benchmark for the `igotchuu` command.
+
+Runs a fresh interpreter with `-X importtime` and reports:
+
+ - import: cumulative import time of the `igotchuu` package
+ - cli: wall time of `igotchuu mount --help`, i.e. everything a
+   lightweight subcommand does before it gets to work
+ - the modules with the highest import time of their own
+
+`import` is checked against `--budget-ms`, and none of the `--forbid`
+modules (by default the ones only backups need) may be imported by
+either. The CLI is given an empty config file, so no config needs to
+be installed.
+The exit status is 1 if either check fails, so this can run in CI.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+CLI = "import sys; sys.argv = ['igotchuu', '-c', {config!r}, 'mount', '--help']; import igotchuu; igotchuu.cli()"
+FORBID = ("gi", "btrfsutil", "unshare", "igotchuu.dbus_service", "igotchuu.mount", "igotchuu.backup")
+
+
+def run(code, importtime=False):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    args = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", code]
+    started = time.perf_counter()
+    process = subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - started
+    if process.returncode != 0:
+        sys.exit(f"{' '.join(args)} failed:\n{process.stderr}")
+    return wall, process.stderr
+
+
+def parse_importtime(output):
+    """Return {module: (self_us, cumulative_us)} from `-X importtime` output."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            own, cumulative, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = (int(own), int(cumulative))
+        except ValueError:
+            # The header line
+            continue
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="interpreters started per measurement")
+    parser.add_argument("--budget-ms", type=float, default=100, help="maximum median import time of `igotchuu`")
+    parser.add_argument("--forbid", action="append", help=f"module that must not be imported (default: {', '.join(FORBID)})")
+    parser.add_argument("--top", type=int, default=10, help="show this many of the slowest modules")
+    parser.add_argument("--json", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved with --json")
+    args = parser.parse_args()
+
+    config = tempfile.NamedTemporaryFile(prefix="igotchuu-bench-", suffix=".toml")
+    cli_code = CLI.format(config=config.name)
+    # Make sure bytecode is cached, so the first run isn't an outlier.
+    run("import igotchuu")
+
+    imports, own_times, imported = [], {}, set()
+    for _ in range(args.runs):
+        _, output = run("import igotchuu", importtime=True)
+        modules = parse_importtime(output)
+        imports.append(modules["igotchuu"][1] / 1000)
+        imported.update(modules)
+        for name, (own, _) in modules.items():
+            own_times.setdefault(name, []).append(own / 1000)
+    cli = [run(cli_code)[0] * 1000 for _ in range(args.runs)]
+    # Subcommands import what they need, which must still not be more
+    cli_imported = set(parse_importtime(run(cli_code, importtime=True)[1]))
+    config.close()
+    python = [run("pass")[0] * 1000 for _ in range(args.runs)]
+
+    results = {
+        "import_ms": statistics.median(imports),
+        "cli_ms": statistics.median(cli),
+        "interpreter_ms": statistics.median(python),
+        "modules": len(imported),
+    }
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    for key, value in results.items():
+        line = f"{key:<48} {value:>14.2f}" if isinstance(value, float) else f"{key:<48} {value!s:>14}"
+        old = baseline.get(key)
+        if isinstance(old, (int, float)) and old:
+            line += f"  ({(value - old) / old:+.1%})"
+        print(line)
+
+    print()
+    print(f"{'slowest modules (self, ms)':<48}")
+    slowest = sorted(own_times.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for name, times in slowest[:args.top]:
+        print(f"  {name:<46} {statistics.median(times):>14.2f}")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+    failed = False
+    if results["import_ms"] > args.budget_ms:
+        print(f"\nFAIL: importing igotchuu takes {results['import_ms']:.2f} ms, budget is {args.budget_ms:.2f} ms")
+        failed = True
+    for what, modules in (("importing igotchuu", imported), ("`igotchuu mount --help`", cli_imported)):
+        forbidden = sorted(name for name in modules if name in (args.forbid or FORBID))
+        if forbidden:
+            print(f"\nFAIL: {what} imports {', '.join(forbidden)}")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
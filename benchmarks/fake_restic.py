@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+"""A stand-in for `restic backup --json` that emits synthetic progress.
+
+Ignores its arguments. The stream is shaped by environment variables:
+
+IGOTCHUU_BENCH_MESSAGES       number of status messages (default 10000)
+IGOTCHUU_BENCH_RATE           status messages per second, 0 for unlimited
+IGOTCHUU_BENCH_CURRENT_FILES  entries in `current_files` (default 2)
+IGOTCHUU_BENCH_PATH_LENGTH    length of each path in `current_files` (default 60)
+IGOTCHUU_BENCH_ERROR_EVERY    emit an error message every N status messages
+"""
+import os
+import sys
+import json
+import time
+
+TOTAL_FILES = 1000000
+TOTAL_BYTES = 200 * 1024**3
+
+
+def status_messages(count, current_files=2, path_length=60):
+    """Yield `count` restic-like status messages as dicts.
+
+    The first tenth of them are sent while "scanning", without
+    `seconds_remaining` and `total_bytes`, like restic does."""
+    scan = count // 10
+    for i in range(count):
+        done = i / count
+        paths = [
+            ("/home/user/" + "x" * path_length)[:path_length - 8] + f"{i:04d}-{j:03d}"
+            for j in range(current_files)
+        ]
+        message = {
+            "message_type": "status",
+            "seconds_elapsed": i // 4,
+            "percent_done": done,
+            "total_files": TOTAL_FILES if i >= scan else int(TOTAL_FILES * i / scan),
+            "files_done": int(TOTAL_FILES * done),
+            "bytes_done": int(TOTAL_BYTES * done),
+            "error_count": 0,
+            "current_files": paths,
+        }
+        if i >= scan:
+            message["seconds_remaining"] = (count - i) // 4
+            message["total_bytes"] = TOTAL_BYTES
+        yield message
+
+
+def summary_message(count):
+    return {
+        "message_type": "summary",
+        "files_new": 10,
+        "files_changed": 20,
+        "files_unmodified": TOTAL_FILES - 30,
+        "dirs_new": 1,
+        "dirs_changed": 2,
+        "dirs_unmodified": 1000,
+        "data_blobs": 40,
+        "tree_blobs": 50,
+        "data_added": 123456789,
+        "total_files_processed": TOTAL_FILES,
+        "total_bytes_processed": TOTAL_BYTES,
+        "total_duration": count / 4,
+        "snapshot_id": "0123456789abcdef" * 4,
+    }
+
+
+def main():
+    count = int(os.environ.get("IGOTCHUU_BENCH_MESSAGES", 10000))
+    rate = float(os.environ.get("IGOTCHUU_BENCH_RATE", 0))
+    current_files = int(os.environ.get("IGOTCHUU_BENCH_CURRENT_FILES", 2))
+    path_length = int(os.environ.get("IGOTCHUU_BENCH_PATH_LENGTH", 60))
+    error_every = int(os.environ.get("IGOTCHUU_BENCH_ERROR_EVERY", 0))
+
+    out = sys.stdout
+    started = time.monotonic()
+    for i, message in enumerate(status_messages(count, current_files, path_length)):
+        out.write(json.dumps(message) + "\n")
+        if error_every and i % error_every == 0:
+            out.write(json.dumps({
+                "message_type": "error",
+                "error": {"message": "permission denied"},
+                "during": "archival",
+                "item": message["current_files"][0] if message["current_files"] else "/",
+            }) + "\n")
+        if rate > 0:
+            out.flush()
+            delay = started + (i + 1) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    out.write(json.dumps(summary_message(count)) + "\n")
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -161,6 +161,14 @@ in {
 
         serviceConfig = {
           ExecStart = "${cfg.package}/bin/igotchuu backup";
+          StateDirectory = "igotchuu";
+          # For the status page, /run/igotchuu/status
+          RuntimeDirectory = "igotchuu";
+          # restic's cache, see the `warmup` setting
+          CacheDirectory = "igotchuu";
+          # Lets igotchuu put restic in a cgroup of its own, to apply
+          # the limits of the `cgroup` setting.
+          Delegate = "yes";
         };
       };
       systemd.timers.igotchuu = {
@@ -29,8 +29,8 @@ python3Packages.buildPythonApplication {
     pygobject3 btrfsutil python-unshare click
   ];
 
-  # There are no tests for now
-  doCheck = false;
+  # The tests don't need root or btrfs; some of them run restic
+  nativeCheckInputs = [ python3Packages.pytestCheckHook restic ];
   # No double-wrapping
   dontWrapGApps = true;
 
@@ -16,90 +16,47 @@
 # damage or existence of a defect, except proven that it results out
 # of said person's immediate fault when using the work as intended.
 import os
-import sys
-import datetime
-import json
-import argparse
+import signal
 import tomllib
-import threading
-import functools
-import subprocess
-import btrfsutil
-import gi
-import unshare
 import click
-from gi.repository import Gio, GLib
-import igotchuu.idle_inhibit
-import igotchuu.glib_loop
-import igotchuu.dbus_service
-from igotchuu.mount import mount, MountFlags
-from igotchuu.restic import Restic
-
-class DBusBackupManagerInterface(igotchuu.dbus_service.DbusService):
-    introspection_xml = """
-    <!DOCTYPE node PUBLIC
-     "-//freedesktop//DTD D-BUS Object Introspection 1.0//EN"
-     "http://www.freedesktop.org/standards/dbus/1.0/introspect.dtd">
-    <node name="/com/nyantec/igotchuu">
-        <interface name="com.nyantec.igotchuu1">
-            <method name="Stop"></method>
-            <signal name="BackupStarted"></signal>
-            <!-- Signal payload mirrors structs found in Restic's source code
-                 https://github.com/restic/restic/blob/master/internal/ui/backup/json.go
-              -->
-            <signal name="Progress">
-                <arg name="seconds_elapsed" type="t" />   <!-- uint64 -->
-                <arg name="seconds_remaining" type="t" />
-                <arg name="percent_done" type="d" />      <!-- float64 -->
-                <arg name="total_files" type="t" />
-                <arg name="files_done" type="t" />
-                <arg name="total_bytes" type="t" />
-                <arg name="bytes_done" type="t" />
-                <arg name="error_count" type="t" />       <!-- uint -->
-                <arg name="current_files" type="as" />    <!-- []string -->
-            </signal>
-            <signal name="BackupComplete">
-                <arg name="files_new" type="t" />
-                <arg name="files_changed" type="t" />
-                <arg name="files_unmodified" type="t" />
-                <arg name="dirs_new" type="t" />
-                <arg name="dirs_changed" type="t" />
-                <arg name="dirs_unmodified" type="t" />
-                <arg name="data_blobs" type="x" />        <!-- int -->
-                <arg name="tree_blobs" type="x" />
-                <arg name="data_added" type="t" />
-                <arg name="total_files_processed" type="t" />
-                <arg name="total_bytes_processed" type="t" />
-                <arg name="total_duration" type="d" />
-                <arg name="snapshot_id" type="s" />       <!-- string -->
-                <arg name="dry_run" type="b" />           <!-- bool -->
-            </signal>
-            <signal name="Error">
-              <arg name="error" type="s" />               <!-- error -->
-              <arg name="during" type="s" />
-              <arg name="item" type="s" />
-            </signal>
-        </interface>
-    </node>
-    """
-    publish_path = '/com/nyantec/igotchuu'
-
-    def __init__(self, dbus, restic=None):
-        super().__init__(dbus, self.introspection_xml, self.publish_path)
-        self.restic = restic
-
-    def Stop(self):
-        if self.restic is not None:
-            self.restic.terminate()
+from igotchuu.restic import restic_env, repository_targets
+from igotchuu.profile import profile_config, profile_names
+from igotchuu.state import state_path
+from igotchuu import trace
+
+# Only what every subcommand needs is imported here. PyGObject, btrfsutil,
+# unshare and the D-Bus service are imported by the subcommands using them,
+# so that `igotchuu mount` and friends start quickly.
+# See `benchmarks/bench_startup.py`.
+
+
+def __getattr__(name):
+    if name == "DBusBackupManagerInterface":
+        from igotchuu.manager import DBusBackupManagerInterface
+        return DBusBackupManagerInterface
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def find_target(config, name=None):
+    """Find a repository target by name, or the first one."""
+    targets = repository_targets(config)
+    if name is None:
+        return targets[0]
+    for target in targets:
+        if target.name == name:
+            return target
+    raise click.BadParameter(f"Unknown repository target: {name}")
 
 
 @click.group(invoke_without_command=True)
 @click.option('-c', '--config-file', type=click.File(mode='rb'), required=False, default="/etc/igotchuu.toml")
 @click.option('-v', '--verbose', type=bool, required=False, default=False, is_flag=True)
 @click.option('-p', '--profile', type=str, required=False, default=None)
+@click.option('--trace', 'trace_file', type=click.Path(dir_okay=False, writable=True), required=False, default=None,
+              help="Write a timeline of the run to this file, in the Chrome trace event format.")
 @click.version_option()
 @click.pass_context
-def cli(ctx, config_file=None, verbose=False, profile=None):
+def cli(ctx, config_file=None, verbose=False, profile=None, trace_file=None):
     config = {
         "places": ["/home"], "snapshot": ["/home"],
         "restic_args": ["-x", "--exclude-caches"]
@@ -115,7 +72,7 @@ def cli(ctx, config_file=None, verbose=False, profile=None):
                 print("Error: paths in `sources` must be absolute, got", place)
                 exit(1)
         if config["snapshot"] != config["places"]:
-            for snapshot in config["snapshots"]:
+            for snapshot in config["snapshot"]:
                 if isinstance(snapshot, str):
                     snapshot = {"source": snapshot}
                 if snapshot["source"][0] != "/":
@@ -123,12 +80,12 @@ def cli(ctx, config_file=None, verbose=False, profile=None):
                     exit(1)
 
     config["verbose"] = verbose
-    if profile is not None:
-        # TODO: figure out recursive updates?
-        config.update(config["profiles"][profile])
-    if "profiles" in config:
-        del config["profiles"]
-    ctx.obj = config
+    if trace_file is not None:
+        trace.start()
+        ctx.call_on_close(lambda: trace.stop(trace_file))
+    ctx.meta["igotchuu.config"] = config
+    ctx.meta["igotchuu.profile"] = profile
+    ctx.obj = profile_config(config, profile)
 
     if ctx.invoked_subcommand is None:
         click.echo("WARNING: running igotchuu without arguments is deprecated.", err=True)
@@ -137,268 +94,265 @@ def cli(ctx, config_file=None, verbose=False, profile=None):
 
 @cli.command('mount')
 @click.argument('target', type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True, executable=True))
+@click.option('-r', '--repository', type=str, required=False, default=None,
+              help="Name of the repository target to mount (default: the first one).")
 @click.pass_context
-def cli_mount(ctx, target):
-    env = dict(os.environ)
+def cli_mount(ctx, target, repository=None):
     config = ctx.obj
-    if config.get("repo") is not None:
-        env['RESTIC_REPOSITORY'] = config['repo']
-    if config.get("password_file") is not None:
-        env['RESTIC_PASSWORD_FILE'] = config['password_file']
-    if config.get("repository_file") is not None:
-        env['RESTIC_REPOSITORY_FILE'] = config['repository_file']
-    if config.get("password_command") is not None:
-        env['RESTIC_PASSWORD_COMMAND'] = config['password_command']
-    extra_args = config.get("restic_args", [])
+    repository = find_target(config, repository)
+    env = restic_env(**repository.repository)
+    extra_args = config.get("restic_args", []) + repository.args
     os.execvpe("restic", ["restic", *extra_args, "mount", "--allow-other", target], env=env)
 
 
-@cli.command('backup')
+@cli.command('restore')
+@click.argument('snapshot', type=str)
+@click.option('-t', '--target', 'destination', type=click.Path(file_okay=False, writable=True), required=True,
+              help="Directory to restore the snapshot into.")
+@click.option('-r', '--repository', type=str, required=False, default=None,
+              help="Name of the repository target to restore from (default: the first one).")
+@click.option('-j', '--jobs', type=int, required=False, default=None,
+              help="Number of restic processes to run at once.")
+@click.option('--shards', type=int, required=False, default=None,
+              help="Number of pieces to split the snapshot into.")
+@click.option('--fresh', type=bool, required=False, default=False, is_flag=True,
+              help="Start over instead of resuming an interrupted restore.")
 @click.pass_context
-def cli_backup(ctx):
-    return cli_backup_inner(ctx)
+def cli_restore(ctx, snapshot, destination, repository=None, jobs=None, shards=None, fresh=False):
+    """Restore a snapshot with several restic processes at once.
+
+    Running the same command again after an interruption only restores
+    the shards that weren't restored yet."""
+    from gi.repository import Gio
+    from igotchuu.manager import own_name
+    from igotchuu.backup import make_verbose
+    from igotchuu.restore import run_restore
 
-def cli_backup_inner(ctx):
     config = ctx.obj
+    repository = find_target(config, repository)
+    name, backup_manager = own_name(config, make_verbose(config))
+    if backup_manager is None:
+        click.echo("Restoring without reporting progress over D-Bus.", err=True)
+    try:
+        succeeded = run_restore(
+            config, repository, snapshot, destination, backup_manager,
+            jobs=jobs, shards=shards, fresh=fresh
+        )
+    finally:
+        Gio.bus_unown_name(name)
+        if backup_manager is not None:
+            backup_manager.publisher.attach_page(None)
+    if not succeeded:
+        exit(1)
+
+
+@cli.command('backup')
+@click.option('-f', '--force', type=bool, required=False, default=False, is_flag=True,
+              help="Back up places even if they didn't change since the last backup.")
+@click.option('--profiles', type=str, required=False, default=None,
+              help="Back up several profiles (comma-separated, or `all`) from the same snapshots.")
+@click.pass_context
+def cli_backup(ctx, force=False, profiles=None):
+    return cli_backup_inner(ctx, force=force, profiles=profiles)
 
-    def verbose(*arguments, **kwargs):
-        if config.get("verbose", False):
-            click.echo(" ".join(map(str, arguments)), **kwargs, err=True)
+def cli_backup_inner(ctx, force=False, profiles=None):
+    from gi.repository import Gio
+    import igotchuu.idle_inhibit
+    from igotchuu.manager import own_name
+    from igotchuu.backup import make_verbose, run_backup
 
+    config = ctx.obj
+    verbose = make_verbose(config)
     verbose("Acquired config:", config)
+    base_config = ctx.meta["igotchuu.config"]
+    if profiles is not None:
+        names = profile_names(base_config, profiles)
+    else:
+        names = [ctx.meta["igotchuu.profile"]]
 
-    bus_ready_barrier = threading.Barrier(2)
-    name_acquired = False
-    backup_manager = None
-
-    verbose("Preparing for backup...")
-    glib_main_loop = igotchuu.glib_loop.GLibMainLoopThread()
-    verbose("Starting glib main loop...")
-    glib_main_loop.start()
-
-    def on_bus_acquired(dbus, name):
-        verbose("Acquired DBus connection:", dbus, name)
-        nonlocal backup_manager
-        backup_manager = DBusBackupManagerInterface(dbus, restic=None)
-        verbose("Created backup manager object:", backup_manager)
-
-    def on_name_acquired(dbus, name):
-        nonlocal name_acquired
-        name_acquired = True
-        verbose("Acquired bus name:", dbus, name)
-        bus_ready_barrier.wait()
-
-    def on_name_lost(dbus, name):
-        nonlocal name_acquired
-        if name_acquired:
-            verbose("Lost bus name:", dbus, name)
-            nonlocal backup_manager
-            if backup_manager is not None:
-                backup_manager.unregister()
-                backup_manager = None
-        else:
-            click.echo("Cannot acquire name on the bus.", err=True)
-            bus_ready_barrier.wait()
-
-    name = Gio.bus_own_name(
-        Gio.BusType.SYSTEM, "com.nyantec.IGotChuu",
-        Gio.BusNameOwnerFlags.DO_NOT_QUEUE,
-        on_bus_acquired,
-        on_name_acquired,
-        on_name_lost
-    )
-    verbose("Waiting for bus name to be acquired...")
-    bus_ready_barrier.wait()
-    if not name_acquired:
+    name, backup_manager = own_name(config, verbose)
+    if backup_manager is None:
         exit(1)
     # Retrieve the D-Bus connection again
     # Should be a singleton anyway
     dbus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
     logind = igotchuu.idle_inhibit.Logind(dbus)
 
-    with logind.inhibit("sleep:handle-lid-switch", "igotchuu", "Backup in progress", "block"):
-        verbose("Unsharing mount namespace...")
-        unshare.unshare(unshare.CLONE_NEWNS)
-        verbose("Making / mount private...")
-        mount("none", "/", None, MountFlags.MS_PRIVATE | MountFlags.MS_REC, None)
-        if "exec_before_snapshot" in config and config["exec_before_snapshot"] is not None:
-            verbose("Executing", config["exec_before_snapshot"])
-            subprocess.run(config["exec_before_snapshot"])
-        verbose("Creating snapshots...")
-        # Create a filesystem snapshot that will be deleted later
-        timestamp = datetime.datetime.now()
-        for place in config["snapshot"]:
-            if isinstance(place, str):
-                place = {
-                    "source": place,
-                    "snapshot_location": os.path.join(config.get("snapshot_prefix", ""), place[1:])
-                }
-            
-            snapshot_path="{place}-{timestamp}".format(
-                place=place["source"],
-                timestamp=timestamp.strftime("%Y-%m-%dT%H:%M:%S%z")   
-            )
-            verbose("Creating snapshot for", place["source"], "at", snapshot_path)
-            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
-            btrfsutil.create_snapshot(place["source"], snapshot_path, read_only=True)
+    try:
+        succeeded = run_backup(base_config, backup_manager, logind, force=force, profiles=names)
+    finally:
+        Gio.bus_unown_name(name)
+        backup_manager.publisher.attach_page(None)
+    if not succeeded:
+        exit(1)
+
+
+@cli.command('maintain')
+@click.option('-r', '--repository', type=str, required=False, default=None,
+              help="Only maintain this repository target (default: all of them).")
+@click.option('--skip', type=click.Choice(["forget", "prune", "check"]), multiple=True,
+              help="Skip a step; may be given several times.")
+@click.pass_context
+def cli_maintain(ctx, repository=None, skip=()):
+    """Forget old snapshots, prune and check the repositories, within budget.
+
+    See `[maintain]` in the config."""
+    from gi.repository import Gio
+    import igotchuu.idle_inhibit
+    from igotchuu.manager import own_name
+    from igotchuu.backup import make_verbose
+    from igotchuu.maintain import STEPS, run_maintenance
+
+    config = ctx.obj
+    if repository is not None:
+        find_target(config, repository)
+    name, backup_manager = own_name(config, make_verbose(config))
+    if backup_manager is None:
+        exit(1)
+    logind = igotchuu.idle_inhibit.Logind(Gio.bus_get_sync(Gio.BusType.SYSTEM))
+    try:
+        succeeded = run_maintenance(
+            config, backup_manager, logind, repository=repository,
+            steps=[step for step in STEPS if step not in skip]
+        )
+    finally:
+        Gio.bus_unown_name(name)
+        backup_manager.publisher.attach_page(None)
+    if not succeeded:
+        exit(1)
+
+
+@cli.command('daemon')
+@click.pass_context
+def cli_daemon(ctx):
+    """Stay running and run backups requested over D-Bus, one at a time.
 
+    The bus name, main loop, logind connection and config are kept
+    between backups; `StartBackup` queues a backup of one or more
+    profiles."""
+    from gi.repository import Gio
+    import igotchuu.idle_inhibit
+    from igotchuu.glib_loop import EventLoop
+    from igotchuu.manager import own_name
+    from igotchuu.backup import make_verbose, run_backup
+    from igotchuu.daemon import BackupQueue
+    from igotchuu.janitor import Janitor, SnapshotJournal
+
+    base_config = ctx.meta["igotchuu.config"]
+    config = ctx.obj
+    verbose = make_verbose(config)
+
+    def resolve(profiles):
+        if profiles is None:
+            return [None]
         try:
-            for place in config["snapshot"]:
-                if isinstance(place, str):
-                    place = {
-                        "source": place,
-                        "snapshot_location": os.path.join(config.get("snapshot_prefix", ""), place[1:])
-                    }
-                snapshot_path="{place}-{timestamp}".format(
-                    place=place["source"],
-                    timestamp=timestamp.strftime("%Y-%m-%dT%H:%M:%S%z")
-                )
-                verbose("Remounting {} to {}...".format(snapshot_path, place["source"]))
-                mount(snapshot_path, place["source"], flags=MountFlags.MS_BIND)
-            verbose("Running restic...")
-
-            backup_manager.restic = Restic.backup(
-                places=config["places"],
-                extra_args=config.get("restic_backup_args", []) + config.get("restic_args", []),
-                repo=config.get("repo", None),
-                repository_file=config.get("repository_file", None),
-                password_command=config.get("password_command", None),
-                password_file=config.get("password_file", None)
-            )
-            dbus.emit_signal(
-                None,
-                "/com/nyantec/igotchuu",
-                "com.nyantec.igotchuu1",
-                "BackupStarted",
-                None
-            )
-            progress_percentage_int = 0
-            verbose("Is stdout a tty? ", sys.stdout.isatty())
-            if not sys.stdout.isatty():
-                print("scanning...", file=sys.stderr)
-            for progress in backup_manager.restic.progress_iter():
-                if progress["message_type"] == "status":
-                    # Map JSON progress keys to GLib.Variant
-                    # I wonder if there's a way to do this automatically?
-                    dbus.emit_signal(
-                        None,
-                        "/com/nyantec/igotchuu",
-                        "com.nyantec.igotchuu1",
-                        "Progress",
-                        GLib.Variant.new_tuple(
-                            GLib.Variant.new_uint64(progress.get("seconds_elapsed", 0)),
-                            GLib.Variant.new_uint64(progress.get("seconds_remaining", 0)),
-                            GLib.Variant.new_double(float(progress.get("percent_done", 0.0))),
-                            GLib.Variant.new_uint64(progress.get("total_files", 0)),
-                            GLib.Variant.new_uint64(progress.get("files_done", 0)),
-                            GLib.Variant.new_uint64(progress.get("total_bytes", 0)),
-                            GLib.Variant.new_uint64(progress.get("bytes_done", 0)),
-                            GLib.Variant.new_uint64(progress.get("error_count", 0)),
-                            GLib.Variant.new_array(
-                                GLib.VariantType.new("s"),
-                                list(map(
-                                    GLib.Variant.new_string,
-                                    progress.get("current_files", [])
-                                ))
-                            )
-                        )
-                    )
-                    if sys.stdout.isatty():
-                        if "seconds_remaining" not in progress and progress.get("percent_done", 0.0) < 1.0:
-                            # Scan isn't complete yet
-                            print("[scan...]", end=" ")
-                        else:
-                            print(f"[{progress['percent_done']: >7.2%}]", end=" ")
-
-                        print(f"{progress.get('files_done', 0)}/{progress['total_files']} files", end=", ")
-                        if "total_bytes" in progress:
-                            print(f"{progress.get('bytes_done', 0) / (1024**3):5.2f}/{progress['total_bytes'] / (1024**3):5.2f}G uploaded", end=" ")
-                        else:
-                            print(f"{progress.get('bytes_done', 0) / (1024**3):5.2f}G uploaded", end=" ")
-                        print("\r", end="")
-                    else:
-                        if int(progress.get("percent_done", 0.0) * 1000) > progress_percentage_int and "seconds_remaining" in progress:
-                            print(f"{progress['percent_done']: >5.1%}", end=" ", file=sys.stderr)
-                            if "total_bytes" in progress:
-                                print(f"{progress.get('bytes_done', 0) / (1024**3):5.2f}/{progress['total_bytes'] / (1024**3):5.2f}G uploaded", file=sys.stderr)
-                    if int(progress.get("percent_done", 0.0) * 1000) > progress_percentage_int and "seconds_remaining" in progress:
-                        progress_percentage_int = int(progress.get("percent_done", 0.0) * 1000)
-                elif progress["message_type"] == "error":
-                    dbus.emit_signal(
-                        None,
-                        "/com/nyantec/igotchuu",
-                        "com.nyantec.igotchuu1",
-                        "Error",
-                        GLib.Variant.new_tuple(
-                            GLib.Variant.new_string(progress["error"]),
-                            GLib.Variant.new_string(progress["during"]),
-                            GLib.Variant.new_string(progress["item"])
-                        )
-                    )
-                    if sys.stdout.isatty():
-                        print("")
-                    print("Error during {} of {}: {}".format(
-                        progress["during"], progress["item"], progress["error"]
-                    ), file=sys.stderr)
-                elif progress["message_type"] == "summary":
-                    dbus.emit_signal(
-                        None,
-                        "/com/nyantec/igotchuu",
-                        "com.nyantec.igotchuu1",
-                        "BackupComplete",
-                        GLib.Variant.new_tuple(
-                            GLib.Variant.new_uint64(progress["files_new"]),
-                            GLib.Variant.new_uint64(progress["files_changed"]),
-                            GLib.Variant.new_uint64(progress["files_unmodified"]),
-                            GLib.Variant.new_uint64(progress["dirs_new"]),
-                            GLib.Variant.new_uint64(progress["dirs_changed"]),
-                            GLib.Variant.new_uint64(progress["dirs_unmodified"]),
-                            GLib.Variant.new_int64(progress["data_blobs"]),
-                            GLib.Variant.new_int64(progress["tree_blobs"]),
-                            GLib.Variant.new_uint64(progress["total_files_processed"]),
-                            GLib.Variant.new_uint64(progress["total_bytes_processed"]),
-                            GLib.Variant.new_double(float(progress["total_duration"])),
-                            GLib.Variant.new_string(progress["snapshot_id"]),
-                            GLib.Variant.new_boolean(progress.get("dry_run", False))
-                        )
-                    )
-                    if sys.stdout.isatty():
-                        print()
-                    print("Backup complete. Stats:")
-                    print(" - New files:         ", progress["files_new"])
-                    print(" - Changed files:     ", progress["files_changed"])
-                    print(" - Unmodified files:  ", progress["files_unmodified"])
-                    print(" - New folders:       ", progress["dirs_new"])
-                    print(" - Changed folders:   ", progress["dirs_changed"])
-                    print(" - Unmodified folders:", progress["dirs_unmodified"])
-                    print(" - Data blobs:        ", progress["data_blobs"])
-                    print(" - Tree blobs:        ", progress["tree_blobs"])
-                    print(" - Processed {} files of {} bytes".format(
-                        progress["total_files_processed"],
-                        progress["total_bytes_processed"]
-                    ))
-                    print(" - Snapshot ID:", progress["snapshot_id"])
-                    if progress.get("dry_run", False):
-                        print("(this was a dry run)")
-                    break
-        finally:
-            if backup_manager.restic is not None:
-                verbose("Waiting for restic to terminate...")
-                backup_manager.restic.wait()
-            verbose("Deleting snapshots...")
-            for place in config["snapshot"]:
-                if isinstance(place, str):
-                    place = {
-                        "source": place,
-                        "snapshot_location": os.path.join(
-                            config.get("snapshot_prefix", ""),
-                            place
-                        )
-                    }
-                snapshot_path="{place}-{timestamp}".format(
-                    place=place["source"],
-                    timestamp=timestamp.strftime("%Y-%m-%dT%H:%M:%S%z")   
-                )
-                btrfsutil.delete_subvolume(snapshot_path)
-            Gio.bus_unown_name(name)
-            glib_main_loop.quit()
+            return profile_names(base_config, profiles)
+        except click.BadParameter as e:
+            raise ValueError(e.message)
+
+    def run(profiles):
+        verbose("Starting backup of profiles", profiles)
+        return run_backup(base_config, backup_manager, logind, profiles=resolve(profiles), janitor=janitor)
+
+    # Deletes snapshots after backups, and the ones left behind by
+    # igotchuu processes that didn't get to it.
+    janitor = Janitor(
+        SnapshotJournal(state_path(config, "snapshots.json")),
+        interval=config.get("gc", {}).get("interval", 3600), verbose=verbose
+    )
+    janitor.start()
+
+    queue = BackupQueue(run, validate=resolve)
+    name, backup_manager = own_name(config, verbose, queue=queue)
+    if backup_manager is None:
+        exit(1)
+    dbus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+    logind = igotchuu.idle_inhibit.Logind(dbus)
+    queue.start()
+
+    # D-Bus calls are handled here, on the main thread; every backup
+    # runs an event loop of its own on its thread.
+    loop = EventLoop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    verbose("Waiting for backup requests...")
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+
+    verbose("Shutting down...")
+    queue.stop(interrupt=backup_manager.Stop)
+    janitor.stop()
+    Gio.bus_unown_name(name)
+    backup_manager.publisher.attach_page(None)
+
+
+@cli.command('status')
+@click.option('--json', 'as_json', type=bool, required=False, default=False, is_flag=True,
+              help="Print the status as JSON.")
+@click.pass_context
+def cli_status(ctx, as_json=False):
+    """Show the state of the running backup, without using D-Bus."""
+    import json
+    from igotchuu.status_page import read_status_page, DEFAULT_PATH
+
+    config = ctx.obj
+    try:
+        status = read_status_page(config.get("status_page", {}).get("path", DEFAULT_PATH))
+    except ValueError as e:
+        click.echo(f"Error: {e}", err=True)
+        exit(1)
+    if status is not None:
+        try:
+            os.kill(status["pid"], 0)
+        except ProcessLookupError:
+            # Left behind by an igotchuu process that was killed
+            status = None
+        except PermissionError:
+            pass
+    if as_json:
+        click.echo(json.dumps(status))
+    elif status is None:
+        click.echo("igotchuu is not running.")
+    else:
+        click.echo(f"Phase: {status['phase']}" + (" (paused)" if status["paused"] else ""))
+        if status["phase"] == "backup":
+            click.echo("{:.2%} done, {} of {} files, {} of {} bytes, {} errors".format(
+                status["percent_done"], status["files_done"], status["total_files"],
+                status["bytes_done"], status["total_bytes"], status["error_count"]
+            ))
+            click.echo(f"Elapsed: {status['seconds_elapsed']}s, remaining: {status['seconds_remaining']}s")
+            for path in status["current_files"]:
+                click.echo(f" - {path}")
+    if status is None:
+        exit(3)
+
+
+@cli.command('gc')
+@click.option('--scan', type=bool, required=False, default=False, is_flag=True,
+              help="Also delete timestamped snapshots next to the configured snapshot locations "
+              "that aren't in the journal, e.g. left over from older versions.")
+@click.option('--wait/--no-wait', default=True,
+              help="Wait for btrfs to free the space of the deleted snapshots.")
+@click.option('-n', '--dry-run', type=bool, required=False, default=False, is_flag=True,
+              help="Only list the snapshots that would be deleted.")
+@click.pass_context
+def cli_gc(ctx, scan=False, wait=True, dry_run=False):
+    """Delete snapshots left behind by igotchuu processes that were killed."""
+    import datetime
+    from igotchuu.janitor import Janitor, SnapshotJournal, find_unrecorded
+    from igotchuu.snapshot import SnapshotPlan
+
+    config = ctx.obj
+    journal = SnapshotJournal(state_path(config, "snapshots.json"))
+    paths = journal.orphans()
+    if scan:
+        plan = SnapshotPlan.from_config(config, datetime.datetime.now())
+        paths += find_unrecorded(plan.locations, journal)
+    for path in paths:
+        click.echo(path)
+    if dry_run or not paths:
+        return
+    _, errors = Janitor(journal).delete_now(paths, wait=wait)
+    if errors:
+        exit(1)
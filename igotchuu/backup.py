@@ -0,0 +1,540 @@
+# Copyright © 2022-2023 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import sys
+import time
+import signal
+import datetime
+import subprocess
+import click
+import unshare
+from igotchuu.mount import make_private
+from igotchuu.restic import Restic, ErrorMessage, restic_env, restic_version, repository_name, repository_targets
+from igotchuu.parent_index import ParentIndex
+from igotchuu.profile import profile_config
+from igotchuu.state import state_path
+from igotchuu.snapshot import SnapshotPlan
+from igotchuu.btrfs import GenerationCache, covering_sources, subvolume_generation
+from igotchuu.scheduler import Scheduler, group_places, plan_jobs, merge_status, merge_summaries
+from igotchuu.render import Renderer
+from igotchuu.metrics import Metrics
+from igotchuu.cgroup import ResticCgroup, CgroupError
+from igotchuu.pressure import PressureMonitor
+from igotchuu.janitor import Janitor, SnapshotJournal
+from igotchuu.history import History, Estimator, job_key, run_key
+from igotchuu.glib_loop import EventLoop
+from igotchuu.warmup import Warmup, cache_args, cache_dir, target_key
+from igotchuu import trace
+
+
+def make_verbose(config):
+    def verbose(*arguments, **kwargs):
+        if config.get("verbose", False):
+            click.echo(" ".join(map(str, arguments)), **kwargs, err=True)
+    return verbose
+
+
+class Profile:
+    """The restic side of a backup of one profile, compiled from its config.
+
+    Holds the places, restic arguments and repository targets of the
+    profile, and the state igotchuu remembers about it between runs. The
+    snapshots are shared with the other profiles backed up in the same
+    run."""
+    def __init__(self, name, config, timestamp):
+        self.name = name
+        self.config = config
+        self.verbose = make_verbose(config)
+        self.places = config["places"]
+        self.plan = SnapshotPlan.from_config(config, timestamp)
+        self.parallel = config.get("parallel", {})
+        self.extra_args = config.get("restic_backup_args", []) + config.get("restic_args", []) + cache_args(config)
+        self.targets = repository_targets(config)
+        # Targets left out of this run, e.g. because they are unreachable
+        self.skipped_targets = []
+        # Target name -> (repository name, ParentIndex)
+        self.parent_indexes = {}
+        self.generations = None
+        incremental = config.get("incremental", {})
+        if incremental.get("enable", False):
+            # Generations are kept per profile, since profiles with
+            # overlapping places are backed up at different times.
+            filename = "generations.json" if name is None else f"generations-{name}.json"
+            self.generations = GenerationCache(state_path(config, filename))
+
+    def __repr__(self):
+        return f"Profile({self.name!r}, places={self.places!r})"
+
+    def _groups(self):
+        if self.parallel.get("enable", False):
+            return group_places(self.places, self.parallel.get("groups", []))
+        return [self.places]
+
+    def skip_unchanged(self, force=False):
+        """Drop places whose subvolumes didn't change since the last backup.
+
+        Returns whether anything is left to back up."""
+        incremental = self.config.get("incremental", {})
+        if self.generations is None or not incremental.get("skip_unchanged", False) or force:
+            return True
+        changed = {source for source in self.plan.sources if self.generations.changed(source)}
+
+        def place_changed(place):
+            covering = covering_sources(place, self.plan.sources)
+            return not covering or any(source in changed for source in covering)
+
+        # restic picks the parent by the exact set of paths, so places
+        # backed up together are skipped or kept together.
+        self.places = [
+            place for group in self._groups() if any(map(place_changed, group))
+            for place in group
+        ]
+        if not self.places:
+            return False
+        self.plan = self.plan.covering(self.places)
+        self.verbose("Places changed since the last backup:", self.places)
+        return True
+
+    def skip_targets(self, keys):
+        """Leave the targets whose `target_key` is in `keys` out of this run."""
+        self.skipped_targets += [target for target in self.targets if target_key(target) in keys]
+        self.targets = [target for target in self.targets if target_key(target) not in keys]
+
+    def prepare(self):
+        """Set up the parent index and `no_scan`, once snapshots are mounted."""
+        if self.config.get("parent_index", {}).get("enable", False) and ParentIndex.usable(self.extra_args):
+            for target in self.targets:
+                self.parent_indexes[target.name] = (repository_name(**target.repository), ParentIndex(
+                    state_path(self.config, "parents.json"),
+                    restic_args=self.config.get("restic_args", []) + cache_args(self.config) + target.args,
+                    env=restic_env(**target.repository),
+                    max_age=self.config["parent_index"].get("max_age", 86400)
+                ))
+
+        if self.config.get("no_scan", False) and "--no-scan" not in self.extra_args:
+            version = restic_version()
+            if version is not None and version >= (0, 17, 0):
+                self.extra_args = self.extra_args + ["--no-scan"]
+            else:
+                print("Warning: no_scan needs restic 0.17 or newer, scanning anyway.", file=sys.stderr)
+
+    def jobs(self):
+        """Create the scheduler jobs for this profile, for every target."""
+        if self.parallel.get("enable", False):
+            groups = self.parallel.get("groups", [])
+        else:
+            groups = [self.places]
+        return [
+            job for target in self.targets
+            for job in plan_jobs(self.places, groups, profile=self, target=target)
+        ]
+
+    def job_key(self, places, target):
+        """The key the history of backing up `places` to `target` is kept under."""
+        return job_key(self.name, target.name, places)
+
+    def start(self, places, target):
+        parent = None
+        if target.name in self.parent_indexes:
+            repo_name, parent_index = self.parent_indexes[target.name]
+            parent = parent_index.lookup(repo_name, places)
+            self.verbose("Parent snapshot for", places, "in", target.name, "is", parent)
+        return Restic.backup(
+            places=places, extra_args=self.extra_args + target.args, parent=parent,
+            **target.repository
+        )
+
+    def record(self, completed):
+        """Remember the outcome of the finished `(target, places, summary)` triples.
+
+        Generations are only recorded once every place made it to every
+        target, so a target that failed or was skipped doesn't miss
+        changes next time."""
+        for target, job_places, summary in completed:
+            if target.name in self.parent_indexes and summary.snapshot_id and not summary.dry_run:
+                repo_name, parent_index = self.parent_indexes[target.name]
+                parent_index.record(repo_name, job_places, summary.snapshot_id)
+        if (
+                self.generations is not None
+                and not any(summary.dry_run for _, _, summary in completed)
+                and not self.skipped_targets
+                and sum(len(job_places) for _, job_places, _ in completed) == len(self.places) * len(self.targets)
+        ):
+            self.generations.update({
+                source: subvolume_generation(snapshot_path)
+                for source, snapshot_path in self.plan.snapshots
+            })
+
+
+def target_label(job, with_profile=False):
+    """The name a job's repository target is reported under."""
+    if with_profile and job.profile.name is not None:
+        return f"{job.profile.name}/{job.target.name}"
+    return job.target.name
+
+
+def setup_cgroup(config, backup_manager):
+    """Create the cgroup for restic if `cgroup` is enabled, and hand it to `backup_manager`.
+
+    Returns the `ResticCgroup`, or `None` if disabled or it couldn't be
+    set up, in which case restic runs without limits."""
+    cgroup_config = config.get("cgroup", {})
+    if not cgroup_config.get("enable", False):
+        return None
+    make_verbose(config)("Creating cgroup for restic...")
+    cgroup = ResticCgroup(cgroup_config)
+    try:
+        cgroup.setup()
+    except (OSError, CgroupError) as e:
+        print("Warning: cannot set up a cgroup for restic, running without limits:", e, file=sys.stderr)
+        return None
+    backup_manager.cgroup = cgroup
+    return cgroup
+
+
+def run_backup(config, backup_manager, logind, force=False, profiles=(None,), janitor=None):
+    """Back up `profiles` of `config`, reporting through `backup_manager`.
+
+    The snapshots needed by all profiles are created and mounted once,
+    then the restic processes of every profile are run against them.
+    A single profile is backed up the way it always was; several
+    profiles share one scheduler, within the `parallel` limits of the
+    top-level config. Settings that apply to the whole run (`metrics`,
+    `output`, `exec_before_snapshot`) are taken from the profile if
+    there is only one, and from the top-level config otherwise.
+
+    Unshares the mount namespace of the calling thread, so that the
+    bind-mounted snapshots are only seen by it and the processes it
+    starts. Everything runs from an `EventLoop` on the same thread, so
+    that D-Bus calls are answered throughout; steps that block run on
+    threads started from it, which share its mount namespace.
+
+    Snapshots are recorded in the snapshot journal while they exist. At
+    the end, they are handed to `janitor` to be deleted in the
+    background, or deleted right away without one. Returns whether the
+    backup succeeded."""
+    verbose = make_verbose(config)
+    timestamp = datetime.datetime.now()
+    runs = []
+    for name in profiles:
+        profile = Profile(name, profile_config(config, name), timestamp)
+        if profile.skip_unchanged(force):
+            runs.append(profile)
+        elif name is not None:
+            print(f"Nothing changed in profile {name} since the last backup.", file=sys.stderr)
+    if not runs:
+        print("Nothing changed since the last backup.", file=sys.stderr)
+        return True
+    settings = runs[0].config if len(profiles) == 1 else profile_config(config, None)
+    plan = SnapshotPlan.union([profile.plan for profile in runs])
+    for profile in runs:
+        profile.plan = plan.select(profile.plan.sources)
+
+    warmup = None
+    failed = []
+    if settings.get("warmup", {}).get("enable", False):
+        # Opening the repositories and loading their index can take
+        # minutes with a remote one, so it happens while snapshots are
+        # being made instead of after.
+        for directory in {cache_dir(profile.config) for profile in runs} - {None}:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        warmup = Warmup(
+            [target for profile in runs for target in profile.targets],
+            restic_args=settings.get("restic_args", []) + cache_args(settings), verbose=verbose
+        )
+        warmup.start()
+
+    loop = EventLoop()
+    metrics = Metrics()
+    metrics_config = settings.get("metrics", {})
+
+    verbose("Preparing for backup...")
+    with metrics.serving(metrics_config.get("listen")), \
+            logind.inhibit("sleep:handle-lid-switch", "igotchuu", "Backup in progress", "block"):
+        with metrics.phase("unshare", flags="CLONE_NEWNS"):
+            verbose("Unsharing mount namespace...")
+            unshare.unshare(unshare.CLONE_NEWNS)
+            exec_before_snapshot = settings.get("exec_before_snapshot")
+            if exec_before_snapshot is not None:
+                # Whatever it mounts must not leak out of the namespace
+                verbose("Making / mount private...")
+                make_private()
+            else:
+                verbose("Making mounts of", plan.sources, "private...")
+                make_private(plan.sources)
+        if exec_before_snapshot is not None:
+            verbose("Executing", exec_before_snapshot)
+            with metrics.phase("exec_before_snapshot"):
+                loop.call_blocking(subprocess.run, exec_before_snapshot)
+        if warmup is not None:
+            verbose("Checking repositories...")
+            with metrics.phase("warmup_check"):
+                failed = loop.call_blocking(warmup.check)
+            for target, error in failed:
+                print(f"Warning: cannot use repository target {target.name}, skipping it: {error}", file=sys.stderr)
+            if failed:
+                # restic would only fail on them, or wait for an
+                # exclusive lock while holding on to the snapshots.
+                for profile in runs:
+                    profile.skip_targets({target_key(target) for target, _ in failed})
+                runs = [profile for profile in runs if profile.targets]
+                if not runs:
+                    print("Error: no repository is usable, not taking snapshots.", file=sys.stderr)
+                    warmup.cancel()
+                    return False
+                plan = SnapshotPlan.union([profile.plan for profile in runs])
+        backup_manager.publisher.set_phase("snapshot")
+        verbose("Creating snapshots:", plan.snapshots)
+        # Create filesystem snapshots that will be deleted later. They are
+        # journaled first, so `igotchuu gc` finds them if we get killed.
+        journal = SnapshotJournal(state_path(settings, "snapshots.json"))
+        journal.add(plan.snapshots)
+        with metrics.phase("snapshot"):
+            try:
+                loop.call_blocking(plan.create)
+            except BaseException:
+                # If we were interrupted after all, the snapshots exist
+                # and stay in the journal for `igotchuu gc`.
+                journal.remove([path for path in plan.paths if not os.path.lexists(path)])
+                if warmup is not None:
+                    warmup.cancel()
+                raise
+
+        renderer = None
+        cgroup = None
+        monitor = None
+        history = None
+        estimator = None
+        restic_started = None
+        finished = []
+        stop_signal = None
+        try:
+            verbose("Bind-mounting snapshots...")
+            with metrics.phase("bind_mount"):
+                loop.call_blocking(plan.mount)
+            cgroup = setup_cgroup(settings, backup_manager)
+
+            def start(profile, places, target):
+                with trace.span("restic_start", profile=profile.name, target=target.name, places=list(places)):
+                    restic = profile.start(places, target)
+                if cgroup is not None:
+                    cgroup.attach(restic.pid)
+                return restic
+
+            backup_manager.loop = loop
+            if loop.main:
+                stop_signal = loop.add_signal_handler(signal.SIGTERM, backup_manager.Stop)
+
+            verbose("Running restic...")
+            for profile in runs:
+                loop.call_blocking(profile.prepare)
+            if warmup is not None:
+                verbose("Waiting for repository indexes to be loaded...")
+                with metrics.phase("warmup"):
+                    for error in loop.call_blocking(warmup.wait):
+                        verbose("Could not load a repository index ahead of time:", error)
+
+            history_config = settings.get("history", {})
+            if history_config.get("enable", False):
+                history = History(
+                    state_path(settings, "history.sqlite3"),
+                    window=history_config.get("window", 5)
+                )
+
+            if len(runs) == 1 and len(runs[0].targets) == 1 and not runs[0].parallel.get("enable", False):
+                keys = [runs[0].job_key(runs[0].places, runs[0].targets[0])]
+                backup_manager.restic = start(runs[0], runs[0].places, runs[0].targets[0])
+            else:
+                jobs = [job for profile in runs for job in profile.jobs()]
+                keys = [job.profile.job_key(job.places, job.target) for job in jobs]
+                if history is not None:
+                    # Start the longest jobs first, so that the short
+                    # ones fill in the gaps instead of one long job
+                    # running on its own at the end. Jobs that never
+                    # ran before may be long, so they go first.
+                    expected = dict(zip(map(id, jobs), map(history.expected, keys)))
+                    jobs.sort(key=lambda job: (
+                        expected[id(job)] is not None,
+                        -expected[id(job)][1] if expected[id(job)] is not None else 0
+                    ))
+                parallel = settings.get("parallel", {})
+                verbose("Running jobs in parallel:", jobs)
+                backup_manager.restic = Scheduler(
+                    jobs,
+                    start=lambda job: start(job.profile, job.places, job.target),
+                    max_jobs=parallel.get("max_jobs", None),
+                    io_budget=parallel.get("io_budget", 1)
+                )
+            backup_manager.pausing.attach(backup_manager.restic)
+            pressure = settings.get("pressure", {})
+            if pressure.get("enable", False):
+                monitor = PressureMonitor(
+                    backup_manager.pausing, pressure,
+                    interval=pressure.get("interval", 5.0),
+                    min_pause=pressure.get("min_pause", 30.0)
+                )
+                monitor.start()
+            if history is not None:
+                estimator = Estimator.from_history(history, run_key(keys))
+            restic_started = time.monotonic()
+            metrics.restic_started()
+            backup_manager.publisher.set_phase("backup")
+            backup_manager.publisher.started()
+            verbose("Is stdout a tty? ", sys.stdout.isatty())
+            targets = {}
+            if isinstance(backup_manager.restic, Scheduler):
+                for job in backup_manager.restic.jobs:
+                    targets.setdefault(target_label(job, len(runs) > 1), []).append(job)
+                if len(targets) == 1:
+                    targets = {}
+            renderer = Renderer(
+                fps=settings.get("output", {}).get("fps", 4.0),
+                # With `--no-scan`, restic never knows how much is left
+                scan=not any("--no-scan" in profile.extra_args for profile in runs)
+            )
+            renderer.start()
+
+            def on_progress(progress):
+                nonlocal finished
+                if progress.message_type == "status":
+                    metrics.observe_status(progress)
+                    if estimator is not None:
+                        progress.estimated_seconds_remaining = estimator.seconds_remaining(progress)
+                    backup_manager.publisher.progress(progress)
+                    for label, jobs in targets.items():
+                        backup_manager.publisher.target_progress(label, merge_status(jobs))
+                    renderer.update(progress)
+                elif progress.message_type == "error":
+                    backup_manager.publisher.error(progress)
+                    renderer.message("Error during {} of {}: {}".format(
+                        progress.during, progress.item, progress.error
+                    ))
+                elif progress.message_type == "summary":
+                    backup_manager.publisher.complete(progress)
+                    metrics.observe_summary(progress)
+                    if isinstance(backup_manager.restic, Scheduler):
+                        finished = [
+                            (job.profile, job.target, job.places, job.summary)
+                            for job in backup_manager.restic.jobs if job.summary is not None
+                        ]
+                    else:
+                        finished = [
+                            (runs[0], runs[0].targets[0], job_places, summary)
+                            for job_places, summary in backup_manager.restic.completed()
+                        ]
+                    for profile in runs:
+                        profile.record([
+                            (target, job_places, summary)
+                            for job_profile, target, job_places, summary in finished
+                            if job_profile is profile
+                        ])
+                    renderer.stop()
+                    for profile, target, job_places, summary in finished:
+                        usual = history.collapsed(
+                            profile.job_key(job_places, target), summary,
+                            history_config.get("collapse_ratio", 0.5)
+                        ) if history is not None else None
+                        if usual is not None:
+                            # restic read every file again, which usually
+                            # means it lost track of the parent snapshot.
+                            error = ErrorMessage(
+                                error="only {:.0%} of files were unmodified, usually {:.0%}; "
+                                "restic had to read every file again".format(
+                                    summary.files_unmodified / summary.total_files_processed, usual
+                                ),
+                                during="history", item=" ".join(job_places)
+                            )
+                            backup_manager.publisher.error(error)
+                            print(f"Warning: backing up {error.item} to {target.name}: {error.error}", file=sys.stderr)
+                    print("Backup complete. Stats:")
+                    print(" - New files:         ", progress.files_new)
+                    print(" - Changed files:     ", progress.files_changed)
+                    print(" - Unmodified files:  ", progress.files_unmodified)
+                    print(" - New folders:       ", progress.dirs_new)
+                    print(" - Changed folders:   ", progress.dirs_changed)
+                    print(" - Unmodified folders:", progress.dirs_unmodified)
+                    print(" - Data blobs:        ", progress.data_blobs)
+                    print(" - Tree blobs:        ", progress.tree_blobs)
+                    print(" - Processed {} files of {} bytes".format(
+                        progress.total_files_processed,
+                        progress.total_bytes_processed
+                    ))
+                    print(" - Snapshot ID:", progress.snapshot_id)
+                    if progress.dry_run:
+                        print("(this was a dry run)")
+
+            # restic's output, D-Bus calls and SIGTERM are all handled by
+            # the loop on this thread, until every restic process exits.
+            backup_manager.restic.watch(loop, on_progress, lambda returncode: loop.stop(), coalesce_status=True)
+            loop.run()
+            renderer.stop()
+            if targets:
+                # Other targets carry on when one fails, so report each.
+                loop.call_blocking(backup_manager.restic.wait)
+                for label, jobs in targets.items():
+                    summaries = [job.summary for job in jobs if job.summary is not None]
+                    success = all(job.returncode == 0 and job.summary is not None for job in jobs)
+                    summary = None
+                    if summaries:
+                        summary = merge_summaries(summaries, max(summary.total_duration for summary in summaries))
+                    backup_manager.publisher.target_complete(label, success, summary)
+                    metrics.observe_target(label, success, summary)
+                    print(f"Target {label}:", "succeeded" if success else "FAILED")
+        finally:
+            if renderer is not None:
+                renderer.stop()
+            if warmup is not None:
+                warmup.cancel()
+            if stop_signal is not None:
+                loop.remove(stop_signal)
+            if monitor is not None:
+                monitor.stop()
+            if backup_manager.restic is not None:
+                backup_manager.pausing.detach()
+                if backup_manager.pausing.paused_seconds:
+                    metrics.record_phase("paused", backup_manager.pausing.paused_seconds)
+            if backup_manager.restic is not None:
+                verbose("Waiting for restic to terminate...")
+                with trace.span("restic_wait"):
+                    metrics.success = loop.call_blocking(backup_manager.restic.wait) == 0 and metrics.summary is not None
+            if cgroup is not None:
+                backup_manager.cgroup = None
+                cgroup.remove()
+            if history is not None:
+                if restic_started is not None:
+                    history.record(
+                        run_key(keys), metrics.started, time.monotonic() - restic_started,
+                        metrics.success, metrics.summary,
+                        [(profile.job_key(job_places, target), summary) for profile, target, job_places, summary in finished]
+                    )
+                history.close()
+            backup_manager.publisher.set_phase("cleanup")
+            with metrics.phase("delete_snapshots"):
+                if janitor is not None:
+                    verbose("Deleting snapshots in the background...")
+                    janitor.delete(plan.paths)
+                else:
+                    verbose("Deleting snapshots...")
+                    loop.call_blocking(Janitor(journal).delete_now, plan.paths)
+            if metrics_config.get("textfile") is not None:
+                metrics.write_textfile(metrics_config["textfile"])
+            backup_manager.restic = None
+            backup_manager.loop = None
+            backup_manager.publisher.set_phase("idle")
+    # Skipped targets missed this backup
+    return metrics.success and not failed
@@ -0,0 +1,99 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import ctypes
+import btrfsutil
+from igotchuu import trace
+from igotchuu.mount import libc
+from igotchuu.state import load_json, save_json
+
+# _IOW(BTRFS_IOCTL_MAGIC, 23, struct btrfs_ioctl_vol_args_v2)
+BTRFS_IOC_SNAP_CREATE_V2 = 0x50009417
+BTRFS_SUBVOL_RDONLY = 1 << 1
+BTRFS_SUBVOL_NAME_MAX = 4039
+
+
+class _VolArgsV2(ctypes.Structure):
+    _fields_ = [
+        ("fd", ctypes.c_int64),
+        ("transid", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+        ("unused", ctypes.c_uint64 * 4),
+        ("name", ctypes.c_char * (BTRFS_SUBVOL_NAME_MAX + 1)),
+    ]
+
+libc.ioctl.argtypes = (ctypes.c_int, ctypes.c_ulong, ctypes.c_void_p)
+
+
+def create_snapshot(source, path, read_only=False):
+    """Snapshot the subvolume `source` to `path`.
+
+    Does the same as `btrfsutil.create_snapshot`, but releases the GIL
+    during the ioctl, so several snapshots can be created from threads
+    at once."""
+    args = _VolArgsV2()
+    args.flags = BTRFS_SUBVOL_RDONLY if read_only else 0
+    args.name = os.path.basename(path).encode()
+    with trace.span("create_snapshot", source=source, path=path, read_only=read_only):
+        source_fd = os.open(source, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            parent_fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                args.fd = source_fd
+                ret = libc.ioctl(parent_fd, BTRFS_IOC_SNAP_CREATE_V2, ctypes.byref(args))
+            finally:
+                os.close(parent_fd)
+        finally:
+            os.close(source_fd)
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(
+            errno,
+            f"Error creating snapshot of {source} at {path}: {os.strerror(errno)}"
+        )
+
+
+def subvolume_generation(path):
+    return btrfsutil.subvolume_info(path).generation
+
+
+def covering_sources(path, sources):
+    """Return the sources that contain `path` or are contained in it."""
+    return [
+        source for source in sources
+        if os.path.commonpath((path, source)) in (path, source)
+    ]
+
+
+class GenerationCache:
+    """The btrfs generation of each snapshot source at its last successful backup."""
+    def __init__(self, path):
+        self.path = path
+        self.generations = load_json(path, {})
+
+    def get(self, source):
+        return self.generations.get(source)
+
+    def changed(self, source):
+        """Whether `source` may have changed since its last backup."""
+        generation = self.get(source)
+        return generation is None or subvolume_generation(source) > generation
+
+    def update(self, generations):
+        self.generations.update(generations)
+        save_json(self.path, self.generations)
@@ -0,0 +1,155 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import stat
+import errno
+from igotchuu.mount import mount_source
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CONTROLLERS = ("cpu", "io", "memory")
+# Where igotchuu itself moves to, so its cgroup can have children with
+# controllers enabled (cgroup v2 only allows processes in leaf cgroups).
+SUPERVISOR = "supervisor"
+RESTIC = "restic"
+
+# Limits that can be set, and the D-Bus signature of each
+LIMITS = (
+    ("cpu_weight", "u"),
+    ("io_weight", "u"),
+    ("memory_high", "s"),
+    ("io_max", "a{ss}"),
+)
+
+
+class CgroupError(Exception):
+    pass
+
+
+def own_cgroup():
+    """Return the cgroup v2 directory of the calling process."""
+    with open("/proc/self/cgroup") as f:
+        for line in f:
+            hierarchy, _, path = line.rstrip("\n").split(":", 2)
+            if hierarchy == "0":
+                return os.path.normpath(os.path.join(CGROUP_ROOT, path.lstrip("/")))
+    raise CgroupError("Not running under a unified (v2) cgroup hierarchy")
+
+
+def block_device(path):
+    """Return "major:minor" of the block device backing `path`.
+
+    `path` may be a block device node, or a path on a mounted filesystem,
+    whose mount source is used (btrfs reports an anonymous `st_dev`)."""
+    st = os.stat(path)
+    if not stat.S_ISBLK(st.st_mode):
+        source = mount_source(path)
+        if source is None or not source.startswith("/"):
+            raise CgroupError(f"Cannot find the block device of {path}")
+        st = os.stat(source)
+        if not stat.S_ISBLK(st.st_mode):
+            raise CgroupError(f"{source} (mounted at {path}) is not a block device")
+    return f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+
+
+def _normalize(limits):
+    limits = dict(limits)
+    if "memory_high" in limits:
+        limits["memory_high"] = str(limits["memory_high"])
+    return limits
+
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+class ResticCgroup:
+    """A cgroup for the restic processes, with CPU, I/O and memory limits.
+
+    Created below igotchuu's own cgroup, which must be delegated to it
+    (`Delegate=yes` in the systemd unit). igotchuu moves itself into a
+    leaf next to it on setup, since controllers can only be enabled for
+    the children of a cgroup without processes of its own.
+
+    Limits are the `cgroup` config table: `cpu_weight` and `io_weight`
+    (1-10000, default 100), `memory_high` (bytes, with an optional K, M
+    or G suffix, or "max") and `io_max` (a table from a block device or
+    a path on it to an `io.max` setting such as "rbps=52428800")."""
+    def __init__(self, config):
+        self.limits = _normalize({name: config[name] for name, _ in LIMITS if config.get(name) is not None})
+        self.path = None
+
+    def setup(self):
+        parent = own_cgroup()
+        if os.path.basename(parent) == SUPERVISOR:
+            # Already moved on an earlier backup (in daemon mode)
+            parent = os.path.dirname(parent)
+        else:
+            supervisor = os.path.join(parent, SUPERVISOR)
+            os.makedirs(supervisor, exist_ok=True)
+            _write(os.path.join(supervisor, "cgroup.procs"), str(os.getpid()))
+        _write(os.path.join(parent, "cgroup.subtree_control"), " ".join("+" + name for name in CONTROLLERS))
+        self.path = os.path.join(parent, RESTIC)
+        os.makedirs(self.path, exist_ok=True)
+        self.update(self.limits)
+
+    def update(self, limits):
+        """Apply `limits` (a subset of `LIMITS`) to the cgroup."""
+        unknown = set(limits) - {name for name, _ in LIMITS}
+        if unknown:
+            raise CgroupError(f"Unknown limits: {', '.join(sorted(unknown))}")
+        limits = _normalize(limits)
+        if "io_max" in limits:
+            # Resolve every device before writing anything.
+            io_max = {block_device(device): value for device, value in limits["io_max"].items()}
+        if self.path is not None:
+            if "cpu_weight" in limits:
+                _write(os.path.join(self.path, "cpu.weight"), str(limits["cpu_weight"]))
+            if "io_weight" in limits:
+                _write(os.path.join(self.path, "io.weight"), f"default {limits['io_weight']}")
+            if "memory_high" in limits:
+                _write(os.path.join(self.path, "memory.high"), str(limits["memory_high"]))
+            if "io_max" in limits:
+                for device in self._io_max_devices() - set(io_max):
+                    _write(os.path.join(self.path, "io.max"), f"{device} rbps=max wbps=max riops=max wiops=max")
+                for device, value in io_max.items():
+                    _write(os.path.join(self.path, "io.max"), f"{device} {value}")
+        self.limits = {**self.limits, **limits}
+
+    def _io_max_devices(self):
+        with open(os.path.join(self.path, "io.max")) as f:
+            return {line.split(" ", 1)[0] for line in f if line.strip()}
+
+    def attach(self, pid):
+        """Move the process `pid` into the cgroup."""
+        try:
+            _write(os.path.join(self.path, "cgroup.procs"), str(pid))
+        except ProcessLookupError:
+            # Already exited
+            pass
+
+    def remove(self):
+        """Remove the cgroup, once the processes in it have exited."""
+        if self.path is None:
+            return
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EBUSY):
+                raise
+        self.path = None
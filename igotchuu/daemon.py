@@ -0,0 +1,115 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import threading
+import collections
+
+
+class BackupJob:
+    def __init__(self, job_id, profile):
+        self.job_id = job_id
+        self.profile = profile
+        self.state = "queued"
+
+
+class BackupQueue:
+    """Runs requested backups one after another on a worker thread.
+
+    Every backup runs on a fresh thread of its own, since the backup
+    unshares the mount namespace of the thread it runs on. `run` is
+    called with the profile name (or `None`) and returns whether the
+    backup succeeded. `validate`, if given, is called with the profile
+    on submission and may raise `ValueError` to reject it. Finished jobs
+    are kept around, up to `history` of them, so clients can see how
+    their job went."""
+    def __init__(self, run, validate=None, history=32):
+        self.run = run
+        self.validate = validate
+        self.history = history
+        self.jobs = collections.OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._worker = threading.Thread(target=self._work, name="igotchuu-queue", daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self, interrupt=None):
+        """Stop taking jobs off the queue and wait for the worker to exit.
+
+        `interrupt` is called once no new jobs will be started, to
+        cut short the one that is running, if any."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if interrupt is not None:
+            interrupt()
+        self._worker.join()
+
+    def submit(self, profile):
+        if self.validate is not None:
+            self.validate(profile)
+        with self._lock:
+            job = BackupJob(self._next_id, profile)
+            self._next_id += 1
+            self.jobs[job.job_id] = job
+            self._wakeup.notify()
+            return job.job_id
+
+    def cancel(self, job_id):
+        """Cancel a job that hasn't started yet."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.state == "queued":
+                job.state = "cancelled"
+
+    def status(self):
+        with self._lock:
+            return [(job.job_id, job.profile or "", job.state) for job in self.jobs.values()]
+
+    def _next_job(self):
+        with self._lock:
+            while not self._stopped:
+                for job in self.jobs.values():
+                    if job.state == "queued":
+                        job.state = "running"
+                        return job
+                self._wakeup.wait()
+            return None
+
+    def _forget_finished(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.state not in ("queued", "running")]
+            for job_id in finished[:max(len(finished) - self.history, 0)]:
+                del self.jobs[job_id]
+
+    def _work(self):
+        while (job := self._next_job()) is not None:
+            succeeded = False
+
+            def run():
+                nonlocal succeeded
+                succeeded = self.run(job.profile)
+
+            thread = threading.Thread(target=run, name=f"igotchuu-backup-{job.job_id}")
+            thread.start()
+            thread.join()
+            with self._lock:
+                job.state = "succeeded" if succeeded else "failed"
+            self._forget_finished()
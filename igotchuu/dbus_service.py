@@ -25,6 +25,21 @@ def _build_variant(name, py_value):
     return s_data.end()
 
 
+class DBusError(Exception):
+    """An error returned to the caller of a D-Bus method.
+
+    `name` is appended to `com.nyantec.igotchuu1.Error.`"""
+    def __init__(self, name, message):
+        super().__init__(message)
+        self.name = name
+
+
+def with_sender(func):
+    """Mark a D-Bus method as taking the caller's bus name as `sender`."""
+    func.with_sender = True
+    return func
+
+
 class DbusService:
     def __init__(self, dbus, introspection_xml, publish_path):
         self.node_info = Gio.DBusNodeInfo.new_for_xml(introspection_xml).interfaces[0]
@@ -68,7 +83,20 @@ class DbusService:
                 args[i] = fd_list.get(args[i])
         # Get the method from the Python class
         func = self.__getattribute__(method_name)
-        result = func(*args)
+        try:
+            if getattr(func, "with_sender", False):
+                result = func(*args, sender=sender)
+            else:
+                result = func(*args)
+        except DBusError as e:
+            invocation.return_dbus_error(f"{interface_name}.Error.{e.name}", str(e))
+            return
+        except Exception as e:
+            invocation.return_dbus_error(f"{interface_name}.Error.Failed", str(e))
+            raise
+        if isinstance(result, GLib.Variant):
+            invocation.return_value(GLib.Variant.new_tuple(result))
+            return
         if result is None:
             result = ()
         else:
@@ -86,6 +114,8 @@ class DbusService:
                     name: str):
         """Method for moving properties from Python Class to D-Bus"""
         py_value = self.__getattribute__(name)
+        if isinstance(py_value, GLib.Variant):
+            return py_value
         signature = self.node_info.lookup_property(name).signature
         if 'v' in signature:
             dbus_value = _build_variant(name, py_value)
@@ -105,5 +135,19 @@ class DbusService:
         self.__setattr__(name, value.unpack())
         return True
 
+    def caller_uid(self, sender):
+        """Return the Unix user ID of the bus client `sender`."""
+        reply = self.con.call_sync(
+            'org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+            'GetConnectionUnixUser', GLib.Variant('(s)', (sender,)),
+            GLib.VariantType.new('(u)'), Gio.DBusCallFlags.NONE, -1, None
+        )
+        return reply.unpack()[0]
+
+    def unregister(self):
+        if self.registration_id:
+            self.con.unregister_object(self.registration_id)
+            self.registration_id = 0
+
     def __del__(self):
-        return self.con.unregister_object(self.registration_id)
+        return self.unregister()
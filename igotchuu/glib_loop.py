@@ -18,18 +18,140 @@
 import threading
 from gi.repository import GLib
 
-class GLibMainLoopThread(threading.Thread):
-    """A thread running the GLib main loop.
 
-    Since GLib's main loop releases the GIL, work can continue on
-    different Python threads with no problem."""
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.daemon = True
-        self.mainloop = GLib.MainLoop.new(None, False)
+class _FdSource(GLib.Source):
+    """Dispatches when a file descriptor is readable, or was closed."""
+    def __init__(self, fd):
+        super().__init__()
+        self.tag = self.add_unix_fd(fd, GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR)
+
+    def prepare(self):
+        return False, -1
+
+    def check(self):
+        return bool(self.query_unix_fd(self.tag))
+
+    def dispatch(self, callback, args):
+        return callback(*args)
+
+
+class EventLoop:
+    """A GLib main loop that runs a backup on a single thread.
+
+    restic's output, D-Bus method calls, signals and timers are all
+    handled by the thread calling `run()`, so nothing needs to be
+    handed over between threads. On the main thread, the loop runs the
+    default main context, which D-Bus method calls are dispatched from.
+    Backups run by the daemon (on threads of their own, for their own
+    mount namespace) get a context of their own, and `invoke()` passes
+    work to it.
+
+    Work that blocks is done with `call_blocking()`, which keeps the
+    loop running while it waits, so D-Bus calls are still answered.
+
+    Callbacks of readers and timers return whether to keep them. An
+    exception raised by a callback stops the loop, and is raised again
+    from `run()` (or `call_blocking()`)."""
+    def __init__(self):
+        self.main = threading.current_thread() is threading.main_thread()
+        self.context = GLib.MainContext.default() if self.main else GLib.MainContext.new()
+        self.mainloop = GLib.MainLoop.new(self.context, False)
+        self._running = None
+        self._error = None
+        # PyGObject destroys sources implemented in Python once nothing
+        # refers to them, so attached sources are kept here
+        self._sources = set()
+
+    def _add(self, source, callback, *args):
+        def dispatch(*_):
+            try:
+                keep = bool(callback(*args))
+            except BaseException as e:
+                self._error = e
+                (self._running or self.mainloop).quit()
+                keep = False
+            if not keep:
+                self._sources.discard(source)
+            return keep
+        source.set_callback(dispatch)
+        self._sources.add(source)
+        source.attach(self.context)
+        return source
+
+    def add_reader(self, fd, callback, *args):
+        """Call `callback(*args)` whenever `fd` is readable or closed."""
+        return self._add(_FdSource(fd), callback, *args)
+
+    def call_later(self, seconds, callback, *args):
+        """Call `callback(*args)` in `seconds`, and every `seconds` while it returns true."""
+        return self._add(GLib.Timeout(int(seconds * 1000)), callback, *args)
+
+    def add_signal_handler(self, signum, callback, *args):
+        """Call `callback(*args)` whenever the process receives `signum`."""
+        def handle():
+            callback(*args)
+            return True
+        return self._add(GLib.unix_signal_source_new(signum), handle)
+
+    def remove(self, source):
+        """Remove a reader, timer or signal handler."""
+        self._sources.discard(source)
+        source.destroy()
+
+    def invoke(self, callback, *args):
+        """Call `callback(*args)` from the loop: right away if called from it,
+        or as soon as the loop gets to it otherwise. Safe to call from any
+        thread."""
+        if self.context.is_owner():
+            callback(*args)
+            return
+        def once():
+            callback(*args)
+            return False
+        self._add(GLib.Idle(GLib.PRIORITY_HIGH), once)
+
+    def _run(self, mainloop):
+        outer, self._running = self._running, mainloop
+        try:
+            mainloop.run()
+        finally:
+            self._running = outer
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
 
     def run(self):
-        self.mainloop.run()
+        """Run the loop until `stop()` is called."""
+        self._run(self.mainloop)
+
+    def call_blocking(self, function, *args):
+        """Call `function(*args)` on a new thread, running the loop until it returns.
+
+        Returns what `function` returned, or raises what it raised. The
+        thread is started from the calling thread, so it shares its
+        mount namespace, unshared or not. `stop()` doesn't cut the wait
+        short."""
+        done = GLib.MainLoop.new(self.context, False)
+        outcome = []
+
+        def work():
+            try:
+                outcome.append((function(*args), None))
+            except BaseException as e:
+                outcome.append((None, e))
+            finally:
+                self.invoke(done.quit)
+
+        thread = threading.Thread(target=work, name="igotchuu-blocking", daemon=True)
+        thread.start()
+        try:
+            self._run(done)
+        finally:
+            thread.join()
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
 
-    def quit(self):
+    def stop(self):
         self.mainloop.quit()
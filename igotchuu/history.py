@@ -0,0 +1,191 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import json
+import sqlite3
+import statistics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    success INTEGER NOT NULL,
+    files_processed INTEGER,
+    bytes_processed INTEGER,
+    data_added INTEGER
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    duration REAL NOT NULL,
+    files_processed INTEGER NOT NULL,
+    files_unmodified INTEGER NOT NULL,
+    bytes_processed INTEGER NOT NULL,
+    data_added INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_key ON runs (key, id);
+CREATE INDEX IF NOT EXISTS jobs_by_key ON jobs (key, run_id);
+"""
+
+
+def job_key(profile, target, places):
+    """Identify a restic job across runs: the same places, to the same target."""
+    return json.dumps([profile, target, sorted(places)])
+
+
+def run_key(job_keys):
+    """Identify a run by the jobs it consists of."""
+    return json.dumps(sorted(job_keys))
+
+
+class History:
+    """Metrics of past backups, per run and per restic job, in SQLite.
+
+    Used to estimate how long a backup will take and how much it will
+    read, and to notice runs that looked very different from the last
+    ones. Only the last `window` runs of a job are considered, and only
+    `keep` runs are kept."""
+    def __init__(self, path, window=5, keep=1000):
+        self.window = window
+        self.keep = keep
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _recent(self, key):
+        return self.db.execute(
+            "SELECT duration, files_processed, files_unmodified, bytes_processed"
+            " FROM jobs WHERE key = ? ORDER BY run_id DESC LIMIT ?",
+            (key, self.window)
+        ).fetchall()
+
+    def expected(self, key):
+        """Return the median `(bytes_processed, duration)` of a job, or `None`."""
+        rows = self._recent(key)
+        if not rows:
+            return None
+        return (
+            statistics.median(row[3] for row in rows),
+            statistics.median(row[0] for row in rows),
+        )
+
+    def expected_run(self, key):
+        """Return the median `(bytes_processed, duration)` of a successful run, or `None`."""
+        rows = self.db.execute(
+            "SELECT bytes_processed, duration FROM runs"
+            " WHERE key = ? AND success AND bytes_processed IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (key, self.window)
+        ).fetchall()
+        if not rows:
+            return None
+        return (
+            statistics.median(row[0] for row in rows),
+            statistics.median(row[1] for row in rows),
+        )
+
+    def unmodified_ratio(self, key):
+        """Return the median share of files restic found unmodified in a job, or `None`."""
+        ratios = [row[2] / row[1] for row in self._recent(key) if row[1]]
+        if not ratios:
+            return None
+        return statistics.median(ratios)
+
+    def collapsed(self, key, summary, ratio=0.5):
+        """Check whether restic found far fewer files unmodified than usual in a job.
+
+        That happens when restic didn't find the parent snapshot, or the
+        metadata of every file changed, and it had to read everything
+        again. Returns the usual share of unmodified files if the one in
+        `summary` fell below `ratio` times it, `None` otherwise."""
+        usual = self.unmodified_ratio(key)
+        if usual is None or not summary.total_files_processed or summary.dry_run:
+            return None
+        if summary.files_unmodified / summary.total_files_processed < usual * ratio:
+            return usual
+        return None
+
+    def record(self, key, started, duration, success, summary, jobs):
+        """Record a run and the `(key, summary)` of each of its finished jobs.
+
+        Dry runs don't read file contents, so their jobs are left out."""
+        with self.db:
+            run_id = self.db.execute(
+                "INSERT INTO runs (key, started, duration, success, files_processed, bytes_processed, data_added)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, started, duration, int(bool(success)),
+                    *((summary.total_files_processed, summary.total_bytes_processed, summary.data_added)
+                      if summary is not None and not summary.dry_run else (None, None, None))
+                )
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO jobs (run_id, key, duration, files_processed, files_unmodified, bytes_processed, data_added)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id, job, float(result.total_duration), result.total_files_processed,
+                        result.files_unmodified, result.total_bytes_processed, result.data_added
+                    )
+                    for job, result in jobs if not result.dry_run
+                ]
+            )
+            self.db.execute(
+                "DELETE FROM runs WHERE id <= (SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (self.keep,)
+            )
+
+
+class Estimator:
+    """Estimates the time left in a backup from earlier runs.
+
+    restic only knows how much there is to read once its scan is done,
+    and never with `--no-scan`; until then, the amount read by the same
+    jobs last time is used. The speed is the one seen so far in this
+    run once `warmup` seconds have passed, and the one of earlier runs
+    before that."""
+    def __init__(self, expected_bytes, expected_seconds, warmup=30):
+        self.expected_bytes = expected_bytes
+        self.expected_seconds = expected_seconds
+        self.warmup = warmup
+
+    @classmethod
+    def from_history(cls, history, key):
+        """Build an estimator for the run `key`, if it succeeded before."""
+        expected = history.expected_run(key)
+        if expected is None:
+            return None
+        return cls(*expected)
+
+    def seconds_remaining(self, status):
+        total = status.total_bytes if status.total_bytes is not None else self.expected_bytes
+        left = max(total - status.bytes_done, 0)
+        if status.seconds_elapsed >= self.warmup and status.bytes_done:
+            rate = status.bytes_done / status.seconds_elapsed
+        elif self.expected_seconds:
+            rate = self.expected_bytes / self.expected_seconds
+        else:
+            rate = 0
+        if not rate:
+            return status.seconds_remaining
+        return int(left / rate)
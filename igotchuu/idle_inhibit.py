@@ -18,6 +18,7 @@
 import sys
 import os
 from gi.repository import GLib, Gio
+from igotchuu import trace
 
 class Inhibitor:
     """A systemd-logind inhibitor that should be used as a context manager."""
@@ -64,19 +65,20 @@ class Logind:
 
         In case of permission errors, returns a null inhibitor that does nothing."""
         try:
-            response = self.dbus.call_with_unix_fd_list_sync(
-                'Inhibit',
-                # These are a pain to construct
-                GLib.Variant.new_tuple(
-                    GLib.Variant.new_string(what),
-                    GLib.Variant.new_string(who),
-                    GLib.Variant.new_string(why),
-                    GLib.Variant.new_string(mode)
-                ),
-                Gio.DBusCallFlags.NO_AUTO_START,
-                500,
-                None
-            )
+            with trace.span("logind_inhibit", what=what, who=who, why=why, mode=mode):
+                response = self.dbus.call_with_unix_fd_list_sync(
+                    'Inhibit',
+                    # These are a pain to construct
+                    GLib.Variant.new_tuple(
+                        GLib.Variant.new_string(what),
+                        GLib.Variant.new_string(who),
+                        GLib.Variant.new_string(why),
+                        GLib.Variant.new_string(mode)
+                    ),
+                    Gio.DBusCallFlags.NO_AUTO_START,
+                    500,
+                    None
+                )
             return Inhibitor(response, what, who, why, mode)
         except GLib.Error as e:
             if e.matches('g-dbus-error-quark', 9):
@@ -0,0 +1,257 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import re
+import sys
+import glob
+import time
+import fcntl
+import threading
+import contextlib
+import btrfsutil
+from igotchuu import trace
+from igotchuu.state import load_json, save_json
+
+# The suffix SnapshotPlan appends to snapshot names
+TIMESTAMP_SUFFIX = re.compile(r"-\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}([+-]\d{4})?$")
+
+# Snapshots recorded by this process that a backup is still using, i.e.
+# not yet removed from the journal or handed over for deletion
+_in_use = set()
+
+
+def _boot_id():
+    with open("/proc/sys/kernel/random/boot_id") as f:
+        return f.read().strip()
+
+
+def _start_time(pid):
+    """Return the start time of process `pid` (in clock ticks since boot), or `None`."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except FileNotFoundError:
+        return None
+    # The command name may contain spaces and parentheses
+    return int(stat.rpartition(")")[2].split()[19])
+
+
+def _owner():
+    return {"pid": os.getpid(), "boot_id": _boot_id(), "start_time": _start_time(os.getpid())}
+
+
+def _alive(owner):
+    return (
+        owner.get("boot_id") == _boot_id()
+        and _start_time(owner["pid"]) == owner.get("start_time")
+    )
+
+
+def _ours(owner):
+    return {key: owner.get(key) for key in ("pid", "boot_id", "start_time")} == _owner()
+
+
+def release(paths):
+    """Mark snapshots of this process as no longer used by a backup."""
+    _in_use.difference_update(paths)
+
+
+class SnapshotJournal:
+    """An on-disk record of the snapshots igotchuu created and not yet deleted.
+
+    Snapshots are recorded before they are created and forgotten once
+    deleted, along with the process that owns them. Snapshots whose
+    owner is gone (killed, or the machine rebooted) are orphans, and can
+    be deleted by `igotchuu gc`. Several igotchuu processes may share
+    the journal; changes are made under an exclusive lock."""
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = load_json(self.path, {})
+            yield entries
+            save_json(self.path, entries)
+
+    def add(self, snapshots):
+        """Record `Snapshot`s this process is about to create."""
+        owner = _owner()
+        with self._locked() as entries:
+            for snapshot in snapshots:
+                entries[snapshot.path] = {"source": snapshot.source, "created": time.time(), **owner}
+                _in_use.add(snapshot.path)
+
+    def remove(self, paths):
+        paths = list(paths)
+        with self._locked() as entries:
+            for path in paths:
+                entries.pop(path, None)
+        release(paths)
+
+    def entries(self):
+        return load_json(self.path, {})
+
+    def orphans(self):
+        """Return the recorded snapshots whose owner has exited."""
+        return [path for path, entry in self.entries().items() if not _alive(entry)]
+
+    def live(self):
+        return [path for path, entry in self.entries().items() if _alive(entry)]
+
+    def leftovers(self):
+        """Return the snapshots of this process that no backup is using any more.
+
+        These are the ones that couldn't be deleted after their backup."""
+        return [
+            path for path, entry in self.entries().items()
+            if _ours(entry) and path not in _in_use
+        ]
+
+
+def find_unrecorded(locations, journal):
+    """Find timestamped snapshots next to `locations` that aren't in the journal.
+
+    These may be left over from before the journal existed. Snapshots
+    recorded as belonging to a running process are never returned."""
+    recorded = set(journal.entries())
+    found = []
+    for location in locations:
+        for path in glob.glob(glob.escape(location) + "-*"):
+            if path in recorded or not TIMESTAMP_SUFFIX.search(path):
+                continue
+            if os.path.isdir(path) and btrfsutil.is_subvolume(path):
+                found.append(path)
+    return sorted(found)
+
+
+def delete_subvolumes(paths):
+    """Delete subvolumes, without waiting for the btrfs cleaner.
+
+    Returns the IDs of the deleted subvolumes keyed by a path on their
+    filesystem, for `wait_for_cleaner`, and `{path: error}` for the ones
+    that couldn't be deleted. Paths that don't exist are skipped."""
+    errors = {}
+    deleted = {}
+    for path in paths:
+        try:
+            subvolume_id = btrfsutil.subvolume_id(path)
+            parent = os.path.dirname(path)
+            with trace.span("delete_subvolume", path=path, subvolume_id=subvolume_id):
+                btrfsutil.delete_subvolume(path)
+        except FileNotFoundError:
+            continue
+        except (OSError, btrfsutil.BtrfsUtilError) as e:
+            errors[path] = e
+            continue
+        deleted.setdefault(parent, set()).add(subvolume_id)
+    return deleted, errors
+
+
+def wait_for_cleaner(deleted, interval=1.0):
+    """Wait until the btrfs cleaner has freed the subvolumes in `deleted`.
+
+    `deleted` maps a path on each filesystem to subvolume IDs, as
+    returned by `delete_subvolumes`. Waits once for all of them,
+    instead of syncing after every deletion."""
+    pending = {path: set(ids) for path, ids in deleted.items()}
+    while pending:
+        for path, ids in list(pending.items()):
+            ids &= set(btrfsutil.deleted_subvolumes(path))
+            if not ids:
+                del pending[path]
+        if pending:
+            time.sleep(interval)
+
+
+class Janitor(threading.Thread):
+    """Deletes snapshots in the background.
+
+    Snapshots handed to `delete` are removed from the journal once
+    deleted; failures are left in the journal for the next `collect`.
+    With an `interval`, orphaned snapshots are also collected that
+    often (in seconds)."""
+    def __init__(self, journal, interval=None, verbose=None):
+        super().__init__(name="igotchuu-janitor", daemon=True)
+        self.journal = journal
+        self.interval = interval
+        self.verbose = verbose or (lambda *args: None)
+        self._pending = []
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    def delete(self, paths):
+        paths = list(paths)
+        release(paths)
+        with self._wakeup:
+            self._pending.extend(paths)
+            self._wakeup.notify()
+
+    def collect(self, wait=False):
+        """Delete orphaned snapshots now. Returns `(deleted, errors)`.
+
+        Snapshots of this process that failed to be deleted before are
+        tried again, unless a running backup is still using them."""
+        orphans = self.journal.orphans()
+        if orphans:
+            self.verbose("Deleting orphaned snapshots:", orphans)
+        leftovers = self.journal.leftovers()
+        if leftovers:
+            self.verbose("Retrying deletion of snapshots:", leftovers)
+        return self.delete_now(orphans + leftovers, wait=wait)
+
+    def delete_now(self, paths, wait=False):
+        """Delete snapshots on the calling thread. Returns `(deleted, errors)`."""
+        paths = list(paths)
+        release(paths)
+        deleted, errors = delete_subvolumes(paths)
+        self.journal.remove([path for path in paths if path not in errors])
+        for path, error in errors.items():
+            print(f"Warning: cannot delete snapshot {path}:", error, file=sys.stderr)
+        if wait:
+            wait_for_cleaner(deleted)
+        return deleted, errors
+
+    def run(self):
+        last_collected = 0.0
+        while True:
+            with self._wakeup:
+                timeout = None
+                if self.interval is not None:
+                    timeout = max(last_collected + self.interval - time.monotonic(), 0)
+                if not self._pending and not self._stopped:
+                    self._wakeup.wait(timeout)
+                paths, self._pending = self._pending, []
+                stopped = self._stopped
+            if paths:
+                self.delete_now(paths)
+            if self.interval is not None and time.monotonic() - last_collected >= self.interval:
+                self.collect()
+                last_collected = time.monotonic()
+            if stopped:
+                return
+
+    def stop(self):
+        """Finish pending deletions and exit."""
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        if self.is_alive():
+            self.join()
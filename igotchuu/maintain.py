@@ -0,0 +1,231 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import sys
+import time
+import signal
+import socket
+from igotchuu.restic import Restic, repository_name, repository_targets
+from igotchuu.state import state_path, load_json, save_json
+from igotchuu.parent_index import ParentIndex
+from igotchuu.glib_loop import EventLoop
+from igotchuu.warmup import cache_args
+from igotchuu.backup import make_verbose, setup_cgroup
+
+STEPS = ("forget", "prune", "check")
+
+# Retention options of `restic forget` taken from `maintain.keep`
+KEEP_OPTIONS = ("last", "hourly", "daily", "weekly", "monthly", "yearly", "within", "tag")
+
+
+def forget_args(maintain):
+    """The `restic forget` arguments for the retention policy, or `None` without one."""
+    keep = maintain.get("keep", {})
+    args = []
+    for option in KEEP_OPTIONS:
+        values = keep.get(option)
+        if values is None:
+            continue
+        for value in values if isinstance(values, list) else [values]:
+            args += [f"--keep-{option}", str(value)]
+    if not args:
+        return None
+    if not maintain.get("all_hosts", False):
+        args += ["--host", socket.gethostname()]
+    return args
+
+
+class MaintenanceRun:
+    """The restic process of the running maintenance step.
+
+    Quacks like a `Restic` process for `Stop`, `Pause` and `Resume`;
+    once stopped, the remaining steps are skipped."""
+    def __init__(self):
+        self.process = None
+        self.stopped = False
+
+    def terminate(self):
+        self.stopped = True
+        if self.process is not None:
+            self.process.terminate()
+
+    def pause(self):
+        if self.process is not None:
+            self.process.pause()
+
+    def resume(self):
+        if self.process is not None:
+            self.process.resume()
+
+    def wait(self):
+        return self.process.wait() if self.process is not None else 0
+
+
+def run_maintenance(config, backup_manager, logind, repository=None, steps=STEPS):
+    """Forget, prune and check the repositories of `config`, within budget.
+
+    `maintain.keep` is the retention policy passed to `restic forget`;
+    without one, nothing is forgotten. `prune` gets up to
+    `maintain.prune_max_repack_size` to repack, which is what bounds its
+    work, and is stopped after `maintain.prune_time_budget` seconds as a
+    last resort. restic only writes the new index at the very end, so a
+    stopped prune frees nothing and counts as failed; the next steps
+    still run. `check` reads one of `maintain.check_subsets` subsets
+    of the data every time, the next one each run, so the whole
+    repository is read over that many runs.
+
+    Runs in the cgroup, holds the inhibitor lock and reports its phase
+    and the Stop, Pause and Resume methods over `backup_manager`, as
+    backups do. Returns whether every step succeeded."""
+    verbose = make_verbose(config)
+    maintain = config.get("maintain", {})
+    state_file = state_path(config, "maintenance.json")
+    state = load_json(state_file, {})
+    targets = repository_targets(config)
+    if repository is not None:
+        targets = [target for target in targets if target.name == repository]
+    limits = []
+    if maintain.get("limit_upload") is not None:
+        limits += ["--limit-upload", str(maintain["limit_upload"])]
+    if maintain.get("limit_download") is not None:
+        limits += ["--limit-download", str(maintain["limit_download"])]
+    if maintain.get("prune_time_budget") is not None and maintain.get("prune_max_repack_size") is None:
+        print(
+            "Warning: prune_time_budget is set without prune_max_repack_size; "
+            "a prune stopped by the budget frees nothing.", file=sys.stderr
+        )
+
+    loop = EventLoop()
+    run = MaintenanceRun()
+    succeeded = True
+    with logind.inhibit("sleep:handle-lid-switch", "igotchuu", "Repository maintenance in progress", "block"):
+        cgroup = setup_cgroup(config, backup_manager)
+        backup_manager.loop = loop
+        backup_manager.restic = run
+        backup_manager.pausing.attach(run)
+        stop_signal = loop.add_signal_handler(signal.SIGTERM, backup_manager.Stop) if loop.main else None
+
+        def restic(target, args, budget=None):
+            """Run a restic command against `target` from the loop.
+
+            Returns its exit status, or `None` if it was stopped after
+            running out of its time `budget`."""
+            process = Restic.command(
+                args, extra_args=config.get("restic_args", []) + cache_args(config) + target.args + limits,
+                **target.repository
+            )
+            run.process = process
+            if cgroup is not None:
+                cgroup.attach(process.pid)
+            if run.stopped:
+                # Raced with `Stop`
+                process.terminate()
+            elif backup_manager.pausing.paused:
+                process.pause()
+            fd = process.stdout.fileno()
+            timer = None
+            out_of_budget = False
+
+            def readable():
+                data = os.read(fd, 65536)
+                if data:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+                    return True
+                loop.stop()
+                return False
+
+            def out_of_time():
+                nonlocal out_of_budget
+                out_of_budget = True
+                print(f"restic {args[0]} ran out of its time budget, stopping it.", file=sys.stderr)
+                process.terminate()
+                return False
+
+            loop.add_reader(fd, readable)
+            if budget is not None:
+                timer = loop.call_later(budget, out_of_time)
+            try:
+                loop.run()
+            finally:
+                if timer is not None:
+                    loop.remove(timer)
+                returncode = process.wait()
+                process.stdout.close()
+                run.process = None
+            if out_of_budget and not run.stopped:
+                # prune can be interrupted safely, but it only writes the
+                # new index at the end, so nothing was freed.
+                return None
+            return returncode
+
+        try:
+            for target in targets:
+                repo_name = repository_name(**target.repository)
+                target_state = state.setdefault(repo_name or target.name, {})
+                for step in steps:
+                    if run.stopped:
+                        break
+                    backup_manager.publisher.set_phase(step)
+                    print(f"Running {step} on {target.name}...", file=sys.stderr)
+                    if step == "forget":
+                        args = forget_args(maintain)
+                        if args is None:
+                            verbose("No retention policy in `maintain.keep`, not forgetting snapshots")
+                            continue
+                        returncode = restic(target, ["forget", *args])
+                        if returncode == 0:
+                            # The parent index may point at forgotten snapshots
+                            ParentIndex(state_path(config, "parents.json")).invalidate(repo_name)
+                    elif step == "prune":
+                        args = ["prune"]
+                        if maintain.get("prune_max_repack_size") is not None:
+                            args += ["--max-repack-size", str(maintain["prune_max_repack_size"])]
+                        if maintain.get("prune_max_unused") is not None:
+                            args += ["--max-unused", str(maintain["prune_max_unused"])]
+                        returncode = restic(target, args, budget=maintain.get("prune_time_budget"))
+                    else:
+                        subsets = maintain.get("check_subsets", 0)
+                        args = ["check"]
+                        if subsets:
+                            subset = target_state.get("check_subset", 0) % subsets + 1
+                            args.append(f"--read-data-subset={subset}/{subsets}")
+                        returncode = restic(target, args)
+                        if returncode == 0 and subsets:
+                            target_state["check_subset"] = subset
+                    if returncode == 0:
+                        target_state[f"last_{step}"] = time.time()
+                        save_json(state_file, state)
+                    elif returncode is None:
+                        print(f"restic {step} on {target.name} did not finish within its time budget", file=sys.stderr)
+                        succeeded = False
+                    else:
+                        print(f"restic {step} on {target.name} failed with status {returncode}", file=sys.stderr)
+                        succeeded = False
+                        break
+        finally:
+            if stop_signal is not None:
+                loop.remove(stop_signal)
+            backup_manager.pausing.detach()
+            if cgroup is not None:
+                backup_manager.cgroup = None
+                cgroup.remove()
+            backup_manager.restic = None
+            backup_manager.loop = None
+            backup_manager.publisher.set_phase("idle")
+    return succeeded and not run.stopped
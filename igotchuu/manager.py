@@ -0,0 +1,305 @@
+# Copyright © 2022-2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import click
+from gi.repository import Gio, GLib
+from igotchuu.dbus_service import DbusService, DBusError, with_sender
+from igotchuu.publisher import ProgressPublisher
+from igotchuu.cgroup import LIMITS, CgroupError
+from igotchuu.pressure import PauseControl
+from igotchuu.status_page import StatusPage, DEFAULT_PATH
+from igotchuu import trace
+
+BUS_NAME = "com.nyantec.IGotChuu"
+
+
+class DBusBackupManagerInterface(DbusService):
+    introspection_xml = """
+    <!DOCTYPE node PUBLIC
+     "-//freedesktop//DTD D-BUS Object Introspection 1.0//EN"
+     "http://www.freedesktop.org/standards/dbus/1.0/introspect.dtd">
+    <node name="/com/nyantec/igotchuu">
+        <interface name="com.nyantec.igotchuu1">
+            <method name="Stop"></method>
+            <!-- Pause restic (with SIGSTOP) without losing its work so far,
+                 and continue it. A backup may also be paused because of
+                 system pressure; it only continues once neither applies.
+                 Only available to root -->
+            <method name="Pause"></method>
+            <method name="Resume"></method>
+            <!-- Only available in daemon mode (`igotchuu daemon`) -->
+            <method name="StartBackup">
+                <arg name="profiles" type="s" direction="in" />  <!-- as for `--profiles`, "" for none -->
+                <arg name="job_id" type="u" direction="out" />
+            </method>
+            <method name="GetQueue">
+                <!-- (job_id, profile, state); state is one of
+                     "queued", "running", "succeeded", "failed", "cancelled" -->
+                <arg name="jobs" type="a(uss)" direction="out" />
+            </method>
+            <method name="CancelJob">
+                <arg name="job_id" type="u" direction="in" />
+            </method>
+            <!-- Changes the resource limits of the running restic processes.
+                 Keys are those of the `[cgroup]` config table: cpu_weight (u),
+                 io_weight (u), memory_high (s) and io_max (a{ss}).
+                 Only available to root while a backup with `[cgroup]`
+                 enabled is running -->
+            <method name="SetResourceLimits">
+                <arg name="limits" type="a{sv}" direction="in" />
+            </method>
+            <!-- Returns the same value as the Status property -->
+            <method name="GetStatus">
+                <arg name="status" type="a{sv}" direction="out" />
+            </method>
+            <!-- With `subscribers_only` set, progress signals are only sent
+                 while a client is subscribed -->
+            <method name="Subscribe"></method>
+            <method name="Unsubscribe"></method>
+            <!-- Fields of the Progress signal, plus the current phase, the
+                 names of repository targets that failed (failed_targets)
+                 and whether restic is paused (paused) -->
+            <property name="Status" type="a{sv}" access="read" />
+            <property name="Phase" type="s" access="read" />
+            <!-- The limits in effect, empty if restic runs without a cgroup -->
+            <property name="ResourceLimits" type="a{sv}" access="read" />
+            <signal name="BackupStarted"></signal>
+            <!-- Signal payload mirrors structs found in Restic's source code
+                 https://github.com/restic/restic/blob/master/internal/ui/backup/json.go
+              -->
+            <signal name="Progress">
+                <arg name="seconds_elapsed" type="t" />   <!-- uint64 -->
+                <arg name="seconds_remaining" type="t" />
+                <arg name="percent_done" type="d" />      <!-- float64 -->
+                <arg name="total_files" type="t" />
+                <arg name="files_done" type="t" />
+                <arg name="total_bytes" type="t" />
+                <arg name="bytes_done" type="t" />
+                <arg name="error_count" type="t" />       <!-- uint -->
+                <arg name="current_files" type="as" />    <!-- []string -->
+            </signal>
+            <signal name="BackupComplete">
+                <arg name="files_new" type="t" />
+                <arg name="files_changed" type="t" />
+                <arg name="files_unmodified" type="t" />
+                <arg name="dirs_new" type="t" />
+                <arg name="dirs_changed" type="t" />
+                <arg name="dirs_unmodified" type="t" />
+                <arg name="data_blobs" type="x" />        <!-- int -->
+                <arg name="tree_blobs" type="x" />
+                <arg name="data_added" type="t" />
+                <arg name="total_files_processed" type="t" />
+                <arg name="total_bytes_processed" type="t" />
+                <arg name="total_duration" type="d" />
+                <arg name="snapshot_id" type="s" />       <!-- string -->
+                <arg name="dry_run" type="b" />           <!-- bool -->
+            </signal>
+            <!-- Rate-limited; only carries the Status fields that changed -->
+            <signal name="ProgressChanged">
+                <arg name="changed" type="a{sv}" />
+            </signal>
+            <!-- Only sent when backing up to several repository targets.
+                 `status` has the fields of the Status property -->
+            <signal name="TargetProgress">
+                <arg name="target" type="s" />
+                <arg name="status" type="a{sv}" />
+            </signal>
+            <!-- `summary` has the fields of BackupComplete, or none if the
+                 target failed before restic finished -->
+            <signal name="TargetComplete">
+                <arg name="target" type="s" />
+                <arg name="success" type="b" />
+                <arg name="summary" type="a{sv}" />
+            </signal>
+            <!-- `reason` is "user", "pressure" or "finished" -->
+            <signal name="Paused">
+                <arg name="paused" type="b" />
+                <arg name="reason" type="s" />
+            </signal>
+            <signal name="Error">
+              <arg name="error" type="s" />               <!-- error -->
+              <arg name="during" type="s" />
+              <arg name="item" type="s" />
+            </signal>
+        </interface>
+    </node>
+    """
+    publish_path = '/com/nyantec/igotchuu'
+    interface_name = 'com.nyantec.igotchuu1'
+
+    def __init__(self, dbus, restic=None, queue=None, **publisher_options):
+        super().__init__(dbus, self.introspection_xml, self.publish_path)
+        self.restic = restic
+        self.queue = queue
+        # The `EventLoop` running the backup, if any
+        self.loop = None
+        self.cgroup = None
+        self.publisher = ProgressPublisher(self, **publisher_options)
+        self.pausing = PauseControl(on_change=self.publisher.paused)
+
+    def Stop(self):
+        loop, restic = self.loop, self.restic
+        if restic is None:
+            return
+        if loop is not None:
+            # The loop reads restic's output; when it runs on this thread,
+            # restic is terminated right away.
+            loop.invoke(restic.terminate)
+        else:
+            restic.terminate()
+
+    @with_sender
+    def Pause(self, sender):
+        self._require_root(sender)
+        self.pausing.pause("user")
+
+    @with_sender
+    def Resume(self, sender):
+        self._require_root(sender)
+        self.pausing.resume("user")
+
+    def _require_root(self, sender):
+        if self.caller_uid(sender) != 0:
+            raise DBusError("AccessDenied", "Only root may manage backups")
+
+    def _require_queue(self, sender):
+        if self.queue is None:
+            raise DBusError("NotSupported", "igotchuu is not running as a daemon")
+        self._require_root(sender)
+
+    @with_sender
+    def StartBackup(self, profiles, sender):
+        self._require_queue(sender)
+        try:
+            return self.queue.submit(profiles or None)
+        except ValueError as e:
+            raise DBusError("UnknownProfile", str(e))
+
+    def GetQueue(self):
+        if self.queue is None:
+            return []
+        return self.queue.status()
+
+    @with_sender
+    def CancelJob(self, job_id, sender):
+        self._require_queue(sender)
+        self.queue.cancel(job_id)
+
+    @with_sender
+    def SetResourceLimits(self, limits, sender):
+        self._require_root(sender)
+        cgroup = self.cgroup
+        if cgroup is None:
+            raise DBusError("NotRunning", "No backup with resource limits is running")
+        try:
+            cgroup.update(limits)
+        except (OSError, CgroupError) as e:
+            raise DBusError("InvalidLimits", str(e))
+
+    def GetStatus(self):
+        return self.publisher.status
+
+    @with_sender
+    def Subscribe(self, sender):
+        self.publisher.subscribe(sender)
+
+    @with_sender
+    def Unsubscribe(self, sender):
+        self.publisher.unsubscribe(sender)
+
+    @property
+    def Status(self):
+        return self.publisher.status
+
+    @property
+    def Phase(self):
+        return self.publisher.phase
+
+    @property
+    def ResourceLimits(self):
+        cgroup = self.cgroup
+        limits = cgroup.limits if cgroup is not None else {}
+        signatures = dict(LIMITS)
+        return GLib.Variant("a{sv}", {
+            name: GLib.Variant(signatures[name], value) for name, value in limits.items()
+        })
+
+
+def own_name(config, verbose, **manager_options):
+    """Own igotchuu's bus name and publish the backup manager on it.
+
+    Runs the default main context until the name is acquired or lost,
+    so it must be called from the main thread. The state of backups is
+    also published on a `StatusPage`, unless disabled in `status_page`;
+    close it with `publisher.attach_page(None)`. Returns the name owner
+    ID and the `DBusBackupManagerInterface`, or `None` for the latter if
+    the name couldn't be acquired."""
+    # None until decided
+    name_acquired = None
+    backup_manager = None
+
+    def on_bus_acquired(dbus, name):
+        verbose("Acquired DBus connection:", dbus, name)
+        nonlocal backup_manager
+        dbus_config = config.get("dbus", {})
+        backup_manager = DBusBackupManagerInterface(
+            dbus, restic=None,
+            rate=dbus_config.get("progress_rate", 4.0),
+            subscribers_only=dbus_config.get("subscribers_only", False),
+            legacy_progress=dbus_config.get("legacy_progress", True),
+            **manager_options
+        )
+        verbose("Created backup manager object:", backup_manager)
+
+    def on_name_acquired(dbus, name):
+        nonlocal name_acquired
+        name_acquired = True
+        verbose("Acquired bus name:", dbus, name)
+
+    def on_name_lost(dbus, name):
+        nonlocal name_acquired
+        if name_acquired:
+            verbose("Lost bus name:", dbus, name)
+            nonlocal backup_manager
+            if backup_manager is not None:
+                backup_manager.unregister()
+                backup_manager = None
+        else:
+            click.echo("Cannot acquire name on the bus.", err=True)
+            name_acquired = False
+
+    with trace.span("own_name", name=BUS_NAME):
+        name = Gio.bus_own_name(
+            Gio.BusType.SYSTEM, BUS_NAME,
+            Gio.BusNameOwnerFlags.DO_NOT_QUEUE,
+            on_bus_acquired,
+            on_name_acquired,
+            on_name_lost
+        )
+        verbose("Waiting for bus name to be acquired...")
+        context = GLib.MainContext.default()
+        while name_acquired is None:
+            context.iteration(True)
+    if not name_acquired:
+        return name, None
+    page_config = config.get("status_page", {})
+    if page_config.get("enable", True):
+        try:
+            backup_manager.publisher.attach_page(StatusPage(page_config.get("path", DEFAULT_PATH)))
+        except OSError as e:
+            click.echo(f"Warning: cannot create the status page: {e}", err=True)
+    return name, backup_manager
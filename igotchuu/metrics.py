@@ -0,0 +1,222 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import time
+import threading
+import contextlib
+import http.server
+from igotchuu import trace
+from igotchuu.state import atomic_write
+
+BYTES_BUCKETS = tuple(2**20 * 4**i for i in range(8))   # 1 MiB/s to 16 GiB/s
+FILES_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+SUMMARY_COUNTERS = (
+    ("files_new", "igotchuu_files", {"state": "new"}),
+    ("files_changed", "igotchuu_files", {"state": "changed"}),
+    ("files_unmodified", "igotchuu_files", {"state": "unmodified"}),
+    ("dirs_new", "igotchuu_dirs", {"state": "new"}),
+    ("dirs_changed", "igotchuu_dirs", {"state": "changed"}),
+    ("dirs_unmodified", "igotchuu_dirs", {"state": "unmodified"}),
+    ("data_blobs", "igotchuu_data_blobs", {}),
+    ("tree_blobs", "igotchuu_tree_blobs", {}),
+    ("data_added", "igotchuu_data_added_bytes", {}),
+    ("total_files_processed", "igotchuu_processed_files", {}),
+    ("total_bytes_processed", "igotchuu_processed_bytes", {}),
+    ("total_duration", "igotchuu_restic_duration_seconds", {}),
+)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        lines = [f"# TYPE {name} histogram"]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """Per-run metrics in the Prometheus text format.
+
+    Records the wall time of each phase of a backup, the throughput
+    seen between restic status messages, and the counters of restic's
+    summary."""
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.success = None
+        self.summary = None
+        self.targets = {}
+        self.bytes_per_second = Histogram(BYTES_BUCKETS)
+        self.files_per_second = Histogram(FILES_BUCKETS)
+        self._lock = threading.Lock()
+        self._last_status = None
+        self._restic_started = None
+        self._scan_done = None
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        """Time the wrapped block as phase `name`.
+
+        The phase is also traced as a span with arguments `args`."""
+        started = time.monotonic()
+        try:
+            with trace.span(name, **args):
+                yield
+        finally:
+            self.record_phase(name, time.monotonic() - started)
+
+    def record_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def restic_started(self):
+        self._restic_started = time.monotonic()
+
+    def observe_status(self, status):
+        now = time.monotonic()
+        if self._scan_done is None and status.seconds_remaining is not None and self._restic_started is not None:
+            self._scan_done = now
+            self.record_phase("restic_scan", now - self._restic_started)
+            trace.complete(
+                "restic_scan", self._restic_started, now - self._restic_started,
+                total_files=status.total_files, total_bytes=status.total_bytes
+            )
+        if self._last_status is not None:
+            last_time, last_bytes, last_files = self._last_status
+            elapsed = now - last_time
+            if elapsed > 0:
+                with self._lock:
+                    self.bytes_per_second.observe(max(status.bytes_done - last_bytes, 0) / elapsed)
+                    self.files_per_second.observe(max(status.files_done - last_files, 0) / elapsed)
+        self._last_status = (now, status.bytes_done, status.files_done)
+
+    def observe_summary(self, summary):
+        if self._restic_started is not None:
+            started = self._scan_done or self._restic_started
+            self.record_phase("restic_upload", time.monotonic() - started)
+            trace.complete(
+                "restic_upload", started, time.monotonic() - started,
+                snapshot_id=summary.snapshot_id, data_added=summary.data_added,
+                files_processed=summary.total_files_processed
+            )
+        with self._lock:
+            self.summary = summary
+
+    def observe_target(self, target, success, summary=None):
+        """Record the outcome of backing up to one repository target."""
+        with self._lock:
+            self.targets[target] = (success, summary)
+
+    def render(self):
+        with self._lock:
+            lines = [
+                "# TYPE igotchuu_last_run_timestamp_seconds gauge",
+                f"igotchuu_last_run_timestamp_seconds {self.started}",
+            ]
+            if self.success is not None:
+                lines += [
+                    "# TYPE igotchuu_last_run_success gauge",
+                    f"igotchuu_last_run_success {int(self.success)}",
+                ]
+            lines.append("# TYPE igotchuu_phase_duration_seconds gauge")
+            for name, seconds in self.phases.items():
+                lines.append(f'igotchuu_phase_duration_seconds{{phase="{name}"}} {seconds}')
+            lines += self.bytes_per_second.render("igotchuu_throughput_bytes_per_second")
+            lines += self.files_per_second.render("igotchuu_throughput_files_per_second")
+            if self.summary is not None:
+                declared = set()
+                for field, name, labels in SUMMARY_COUNTERS:
+                    if name not in declared:
+                        lines.append(f"# TYPE {name} gauge")
+                        declared.add(name)
+                    lines.append(f"{name}{_labels(labels)} {float(getattr(self.summary, field))}")
+            if self.targets:
+                lines.append("# TYPE igotchuu_target_success gauge")
+                for target, (success, _) in self.targets.items():
+                    lines.append(f"igotchuu_target_success{_labels({'target': target})} {int(success)}")
+                lines.append("# TYPE igotchuu_target_data_added_bytes gauge")
+                for target, (_, summary) in self.targets.items():
+                    if summary is not None:
+                        lines.append(f"igotchuu_target_data_added_bytes{_labels({'target': target})} {float(summary.data_added)}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics for node_exporter's textfile collector."""
+        atomic_write(path, self.render().encode())
+
+    def serve(self, address):
+        """Serve the metrics over HTTP at `address` ("host:port") from a thread."""
+        host, _, port = address.rpartition(":")
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host.strip("[]") or "127.0.0.1", int(port)), Handler)
+        threading.Thread(target=server.serve_forever, name="igotchuu-metrics", daemon=True).start()
+        return server
+
+    @contextlib.contextmanager
+    def serving(self, address):
+        """Serve the metrics at `address` while in the block, if it isn't `None`.
+
+        The server is shut down and its socket closed however the block
+        exits, so the next backup of a daemon can listen there again."""
+        if address is None:
+            yield None
+            return
+        server = self.serve(address)
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
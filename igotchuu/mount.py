@@ -15,13 +15,60 @@
 # of dealing in the work, even if advised of the possibility of such
 # damage or existence of a defect, except proven that it results out
 # of said person's immediate fault when using the work as intended.
+import os
+import re
+import errno
 import ctypes
 import ctypes.util
 import enum
+from igotchuu import trace
 
 # Mount helper
 libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
 libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
+libc.syscall.restype = ctypes.c_long
+
+# New mount API (Linux 5.2, mount_setattr since 5.12). Syscalls added
+# since Linux 5.1 have the same number on every architecture, plus an
+# offset on alpha and ia64. On MIPS the offset depends on the ABI, so
+# the new API isn't used there and the old one is used instead.
+SYSCALL_OFFSETS = {"alpha": 110, "ia64": 1024}
+if os.uname().machine.startswith("mips"):
+    SYS_open_tree = SYS_move_mount = SYS_mount_setattr = None
+else:
+    _offset = SYSCALL_OFFSETS.get(os.uname().machine, 0)
+    SYS_open_tree = 428 + _offset
+    SYS_move_mount = 429 + _offset
+    SYS_mount_setattr = 442 + _offset
+
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = os.O_CLOEXEC
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+
+
+class MountAttr(enum.IntFlag):
+    MOUNT_ATTR_RDONLY = 0x1
+    MOUNT_ATTR_NOSUID = 0x2
+    MOUNT_ATTR_NODEV = 0x4
+    MOUNT_ATTR_NOEXEC = 0x8
+    MOUNT_ATTR__ATIME = 0x70
+    MOUNT_ATTR_RELATIME = 0x0
+    MOUNT_ATTR_NOATIME = 0x10
+    MOUNT_ATTR_STRICTATIME = 0x20
+    MOUNT_ATTR_NODIRATIME = 0x80
+
+
+class _MountAttrStruct(ctypes.Structure):
+    # struct mount_attr, MOUNT_ATTR_SIZE_VER0
+    _fields_ = [
+        ("attr_set", ctypes.c_uint64),
+        ("attr_clr", ctypes.c_uint64),
+        ("propagation", ctypes.c_uint64),
+        ("userns_fd", ctypes.c_uint64),
+    ]
 
 # Mount flags are copied from linux kernel headers
 class MountFlags(enum.IntFlag):
@@ -89,3 +136,145 @@ def mount(source, target, fs=None, flags=0, options=None):
             errno,
             f"Error mounting {source} on {target}: {os.strerror(errno)}"
         )
+
+
+def _syscall(number, *args, what):
+    if number is None:
+        raise OSError(errno.ENOSYS, f"{what}: syscall number unknown on {os.uname().machine}")
+    ret = libc.syscall(ctypes.c_long(number), *args)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f"{what}: {os.strerror(err)}")
+    return ret
+
+
+def open_tree(path, flags, dirfd=AT_FDCWD):
+    """Return a file descriptor for the mount at `path` (see open_tree(2))."""
+    return _syscall(
+        SYS_open_tree, ctypes.c_int(dirfd), ctypes.c_char_p(path.encode()), ctypes.c_uint(flags),
+        what=f"Error opening mount tree {path}"
+    )
+
+
+def move_mount(from_fd, target, flags=MOVE_MOUNT_F_EMPTY_PATH, to_dirfd=AT_FDCWD):
+    """Attach the mount `from_fd` at `target` (see move_mount(2))."""
+    _syscall(
+        SYS_move_mount, ctypes.c_int(from_fd), ctypes.c_char_p(b""),
+        ctypes.c_int(to_dirfd), ctypes.c_char_p(target.encode()), ctypes.c_uint(flags),
+        what=f"Error attaching mount at {target}"
+    )
+
+
+def mount_setattr(path, flags=0, attr_set=0, attr_clr=0, propagation=0, dirfd=AT_FDCWD):
+    """Change the attributes of the mount at `path` (see mount_setattr(2))."""
+    attr = _MountAttrStruct(int(attr_set), int(attr_clr), int(propagation), 0)
+    _syscall(
+        SYS_mount_setattr, ctypes.c_int(dirfd), ctypes.c_char_p(path.encode()), ctypes.c_uint(flags),
+        ctypes.byref(attr), ctypes.c_size_t(ctypes.sizeof(attr)),
+        what=f"Error changing mount attributes of {path or dirfd}"
+    )
+
+
+# Whether the new mount API may be available; cleared on the first ENOSYS
+_new_api = True
+
+
+def _with_fallback(new, legacy):
+    global _new_api
+    if _new_api:
+        try:
+            return new()
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            _new_api = False
+    return legacy()
+
+
+def make_private(paths=None):
+    """Stop mount events from propagating out of this mount namespace.
+
+    Only the mounts containing `paths` are changed, which is enough for
+    mounts made on those paths to stay in this namespace and doesn't
+    walk every mount in the namespace. Without `paths`, every mount is
+    made private."""
+    if paths is None:
+        _with_fallback(
+            lambda: mount_setattr("/", AT_RECURSIVE, propagation=MountFlags.MS_PRIVATE),
+            lambda: mount("none", "/", None, MountFlags.MS_PRIVATE | MountFlags.MS_REC, None)
+        )
+        return
+    for mount_point in dict.fromkeys(find_mount(path)[0] for path in paths):
+        with trace.span("make_private", mount_point=mount_point):
+            _with_fallback(
+                lambda: mount_setattr(mount_point, propagation=MountFlags.MS_PRIVATE),
+                lambda: mount("none", mount_point, None, MountFlags.MS_PRIVATE, None)
+            )
+
+
+def bind_mounts(mounts, read_only=True, noatime=True):
+    """Bind-mount each `(source, target)` pair.
+
+    With the new mount API, all bind mounts are cloned and given their
+    flags while still detached, and attached one after another at the
+    end. Older kernels get plain `MS_BIND` mounts."""
+    def new():
+        attr_set = (MountAttr.MOUNT_ATTR_RDONLY if read_only else 0) | (MountAttr.MOUNT_ATTR_NOATIME if noatime else 0)
+        fds = []
+        try:
+            for source, target in mounts:
+                with trace.span("open_tree", source=source, read_only=read_only, noatime=noatime):
+                    fds.append(open_tree(source, OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC))
+                    if attr_set:
+                        mount_setattr(
+                            "", AT_EMPTY_PATH, dirfd=fds[-1], attr_set=attr_set,
+                            attr_clr=MountAttr.MOUNT_ATTR__ATIME if noatime else 0
+                        )
+            for fd, (source, target) in zip(fds, mounts):
+                with trace.span("move_mount", source=source, target=target):
+                    move_mount(fd, target)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def legacy():
+        for source, target in mounts:
+            with trace.span("mount", source=source, target=target, flags="MS_BIND"):
+                mount(source, target, flags=MountFlags.MS_BIND)
+
+    mounts = list(mounts)
+    _with_fallback(new, legacy)
+
+
+def _unescape_mountinfo(field):
+    # Spaces, tabs, newlines and backslashes are octal-escaped, the
+    # rest of the path is left as the raw bytes
+    return os.fsdecode(re.sub(rb"\\([0-7]{3})", lambda m: bytes((int(m[1], 8),)), field))
+
+
+def find_mount(path):
+    """Return the mount point and source of the mount that contains `path`.
+
+    Looks at the mount namespace of the calling thread, which may have
+    been unshared from the rest of the process."""
+    path = os.path.realpath(path)
+    best, source = "", None
+    with open("/proc/thread-self/mountinfo", "rb") as mountinfo:
+        for line in mountinfo:
+            fields, _, rest = line.partition(b" - ")
+            mount_point = _unescape_mountinfo(fields.split(b" ")[4])
+            if os.path.commonpath((path, mount_point)) != mount_point:
+                continue
+            if len(mount_point) >= len(best):
+                best = mount_point
+                source = _unescape_mountinfo(rest.split(b" ")[1])
+    return best, source
+
+
+def mount_source(path):
+    """Return the source device of the mount that contains `path`.
+
+    Subvolumes of one btrfs filesystem share the same source, unlike
+    their `st_dev`, so this can be used to tell which places will
+    compete for the same disk."""
+    return find_mount(path)[1]
@@ -0,0 +1,116 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import time
+import json
+import socket
+import subprocess
+from igotchuu.state import load_json, save_json
+
+# Options that make restic choose the parent on its own terms
+_PARENT_OPTIONS = ("--parent", "--host", "-H", "--force", "-f")
+
+
+class ParentIndex:
+    """A local map from (repository, host, paths) to the last snapshot.
+
+    Passing that snapshot as `--parent` spares restic from listing every
+    snapshot in the repository to find one. Entries older than `max_age`
+    seconds are checked against the repository before use; missing ones
+    are looked up there once."""
+    def __init__(self, path, restic_args=(), env=None, max_age=86400):
+        self.path = path
+        self.restic_args = list(restic_args)
+        self.env = env
+        self.max_age = max_age
+        self.entries = load_json(path, {})
+        self.host = socket.gethostname()
+
+    @staticmethod
+    def usable(args):
+        """Whether restic's parent selection is left at its defaults."""
+        return not any(
+            arg == option or arg.startswith(option + "=")
+            for arg in args for option in _PARENT_OPTIONS
+        )
+
+    def _key(self, repo, paths):
+        return "\0".join([repo or "", self.host, *sorted(paths)])
+
+    def _restic(self, *args):
+        return subprocess.run(
+            ["restic", *self.restic_args, *args],
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+    def _exists(self, snapshot_id):
+        return self._restic("cat", "snapshot", snapshot_id).returncode == 0
+
+    def _discover(self, paths):
+        args = ["snapshots", "--json", "--latest", "1", "--host", self.host]
+        for path in paths:
+            args += ["--path", path]
+        result = self._restic(*args)
+        if result.returncode != 0:
+            return None
+        snapshots = [
+            snapshot for snapshot in json.loads(result.stdout or b"[]")
+            if sorted(snapshot.get("paths", [])) == sorted(paths)
+        ]
+        if not snapshots:
+            return None
+        return max(snapshots, key=lambda snapshot: snapshot["time"])["id"]
+
+    def lookup(self, repo, paths):
+        """Return the parent snapshot ID for `paths`, or `None`."""
+        key = self._key(repo, paths)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None and now - entry["verified"] <= self.max_age:
+            return entry["snapshot_id"]
+        if entry is not None and self._exists(entry["snapshot_id"]):
+            snapshot_id = entry["snapshot_id"]
+        else:
+            snapshot_id = self._discover(paths)
+        if snapshot_id is None:
+            self.entries.pop(key, None)
+        else:
+            self.entries[key] = {"snapshot_id": snapshot_id, "verified": now}
+        self._save(key)
+        return snapshot_id
+
+    def record(self, repo, paths, snapshot_id):
+        key = self._key(repo, paths)
+        self.entries[key] = {"snapshot_id": snapshot_id, "verified": time.time()}
+        self._save(key)
+
+    def invalidate(self, repo):
+        """Drop every entry of `repo`, after snapshots were removed from it."""
+        prefix = (repo or "") + "\0"
+        self.entries = {key: entry for key, entry in self.entries.items() if not key.startswith(prefix)}
+        entries = load_json(self.path, {})
+        save_json(self.path, {key: entry for key, entry in entries.items() if not key.startswith(prefix)})
+
+    def _save(self, key):
+        # Several indexes (one per profile) may share the file, so only
+        # the entry that changed is written back.
+        entries = load_json(self.path, {})
+        if key in self.entries:
+            entries[key] = self.entries[key]
+        else:
+            entries.pop(key, None)
+        save_json(self.path, entries)
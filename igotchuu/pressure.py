@@ -0,0 +1,170 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import sys
+import time
+import threading
+
+PRESSURE_DIR = "/proc/pressure"
+RESOURCES = ("cpu", "io", "memory")
+
+
+def read_pressure(resource, directory=PRESSURE_DIR):
+    """Return the `some` and `full` avg10 values of a PSI file, in percent."""
+    pressure = {}
+    with open(f"{directory}/{resource}") as f:
+        for line in f:
+            kind, *fields = line.split()
+            values = dict(field.split("=", 1) for field in fields)
+            pressure[kind] = float(values["avg10"])
+    return pressure
+
+
+class PauseControl:
+    """Pauses and resumes the running restic processes.
+
+    A backup may be paused for several reasons at once (a user asking
+    over D-Bus, system pressure); it is only resumed once none is left.
+    `on_change` is called with whether restic is now paused and the
+    reason that changed it."""
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.reasons = set()
+        self.restic = None
+        self.paused_seconds = 0.0
+        self._paused_since = None
+        self._lock = threading.Lock()
+
+    @property
+    def paused(self):
+        return bool(self.reasons)
+
+    def attach(self, restic):
+        """Control `restic` (a `Restic` or a `Scheduler`) from now on."""
+        with self._lock:
+            self.restic = restic
+            self.paused_seconds = 0.0
+            if self.reasons:
+                self._paused_since = time.monotonic()
+                restic.pause()
+
+    def detach(self):
+        """Stop controlling restic, continuing it if it is paused.
+
+        Pauses don't carry over to the next backup."""
+        with self._lock:
+            self._account()
+            was_paused = self.paused
+            if was_paused and self.restic is not None:
+                self.restic.resume()
+            self.restic = None
+            self.reasons.clear()
+        if was_paused and self.on_change is not None:
+            self.on_change(False, "finished")
+
+    def _account(self):
+        if self._paused_since is not None:
+            now = time.monotonic()
+            self.paused_seconds += now - self._paused_since
+            self._paused_since = now if self.reasons and self.restic is not None else None
+
+    def pause(self, reason):
+        with self._lock:
+            if reason in self.reasons:
+                return
+            self.reasons.add(reason)
+            if len(self.reasons) > 1:
+                return
+            if self.restic is not None:
+                self._paused_since = time.monotonic()
+                self.restic.pause()
+        if self.on_change is not None:
+            self.on_change(True, reason)
+
+    def resume(self, reason):
+        with self._lock:
+            if reason not in self.reasons:
+                return
+            self.reasons.discard(reason)
+            if self.reasons:
+                return
+            if self.restic is not None:
+                self._account()
+                self.restic.resume()
+        if self.on_change is not None:
+            self.on_change(False, reason)
+
+
+class PressureMonitor(threading.Thread):
+    """Pauses restic while the system is under pressure.
+
+    Every `interval` seconds, reads the `some` avg10 pressure of each
+    resource configured in `thresholds` (a dict like
+    `{"io": {"pause": 40, "resume": 10}}`). Restic is paused as soon as
+    any resource is above its `pause` threshold, and resumed once all
+    are below their `resume` threshold and it has been paused for at
+    least `min_pause` seconds, so it doesn't flap. `resume` defaults to
+    `pause`; resources without a `pause` threshold are not watched."""
+    def __init__(self, control, thresholds, interval=5.0, min_pause=30.0, directory=PRESSURE_DIR):
+        super().__init__(name="igotchuu-pressure", daemon=True)
+        self.control = control
+        self.thresholds = {}
+        for resource in RESOURCES:
+            limits = thresholds.get(resource)
+            if limits is None:
+                continue
+            if not isinstance(limits, dict) or limits.get("pause") is None:
+                print(f"Warning: no pause threshold for {resource} pressure, not watching it", file=sys.stderr)
+                continue
+            self.thresholds[resource] = {"pause": limits["pause"], "resume": limits.get("resume", limits["pause"])}
+        self.interval = interval
+        self.min_pause = min_pause
+        self.directory = directory
+        self._stopped = threading.Event()
+        self._paused_at = None
+
+    def check(self):
+        pressure = {
+            resource: read_pressure(resource, self.directory)["some"]
+            for resource in self.thresholds
+        }
+        if self._paused_at is None:
+            if any(pressure[resource] > limits["pause"] for resource, limits in self.thresholds.items()):
+                self._paused_at = time.monotonic()
+                self.control.pause("pressure")
+        elif (
+                time.monotonic() - self._paused_at >= self.min_pause
+                and all(pressure[resource] < limits["resume"] for resource, limits in self.thresholds.items())
+        ):
+            self._paused_at = None
+            self.control.resume("pressure")
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except OSError as e:
+                print("Warning: cannot read pressure, not pausing for it:", e, file=sys.stderr)
+                return
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        if self._paused_at is not None:
+            self._paused_at = None
+            self.control.resume("pressure")
@@ -0,0 +1,58 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import click
+
+
+def merge_config(base, override):
+    """Return `base` with `override` applied on top of it.
+
+    Tables present in both are merged recursively; any other value in
+    `override`, arrays included, replaces the one in `base`."""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_config(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def profile_config(config, profile):
+    """Return the config for running `profile` (or no profile, if `None`)."""
+    profiles = config.get("profiles", {})
+    config = {key: value for key, value in config.items() if key != "profiles"}
+    if profile is not None:
+        if profile not in profiles:
+            raise click.BadParameter(f"Unknown profile: {profile}")
+        config = merge_config(config, profiles[profile])
+    return config
+
+
+def profile_names(config, spec):
+    """Parse a comma-separated list of profiles, or `all` for every profile."""
+    profiles = config.get("profiles", {})
+    if spec == "all":
+        if not profiles:
+            raise click.BadParameter("No profiles are defined in the config file")
+        return list(profiles)
+    names = [name.strip() for name in spec.split(",") if name.strip()]
+    if not names:
+        raise click.BadParameter("No profiles given")
+    for name in names:
+        if name not in profiles:
+            raise click.BadParameter(f"Unknown profile: {name}")
+    return list(dict.fromkeys(names))
@@ -0,0 +1,258 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import time
+import threading
+from gi.repository import Gio, GLib
+
+# D-Bus signatures of the fields published from restic's status messages
+STATUS_FIELDS = (
+    ("seconds_elapsed", "t"),
+    ("seconds_remaining", "t"),
+    ("percent_done", "d"),
+    ("total_files", "t"),
+    ("files_done", "t"),
+    ("total_bytes", "t"),
+    ("bytes_done", "t"),
+    ("error_count", "t"),
+    ("current_files", "as"),
+)
+
+# D-Bus signatures of the fields of restic's summary, as sent in `TargetComplete`
+SUMMARY_FIELDS = (
+    ("files_new", "t"),
+    ("files_changed", "t"),
+    ("files_unmodified", "t"),
+    ("dirs_new", "t"),
+    ("dirs_changed", "t"),
+    ("dirs_unmodified", "t"),
+    ("data_blobs", "x"),
+    ("tree_blobs", "x"),
+    ("data_added", "t"),
+    ("total_files_processed", "t"),
+    ("total_bytes_processed", "t"),
+    ("total_duration", "d"),
+    ("snapshot_id", "s"),
+    ("dry_run", "b"),
+)
+
+
+def _status_fields(status):
+    fields = {name: getattr(status, name) or 0 for name, _ in STATUS_FIELDS[:-1]}
+    if status.estimated_seconds_remaining is not None:
+        # Clients get the best estimate there is, even while restic scans
+        fields["seconds_remaining"] = status.estimated_seconds_remaining
+    fields["percent_done"] = float(fields["percent_done"])
+    fields["current_files"] = list(status.current_files)
+    return fields
+
+
+def _dict_variant(fields, signatures):
+    return GLib.Variant("a{sv}", {
+        name: GLib.Variant(signatures[name], value)
+        for name, value in fields.items()
+    })
+
+
+class ProgressPublisher:
+    """Publishes backup progress on D-Bus without flooding the bus.
+
+    Status updates are cached; `Progress` and `ProgressChanged` signals
+    are sent at most `rate` times a second, the latter with only the
+    fields that changed since the last one. The newest update is always
+    sent eventually. If `subscribers_only` is set, progress signals are
+    only sent while some client has called `Subscribe`.
+
+    `Status` holds a pre-built `a{sv}` variant of the current state for
+    clients that would rather poll.
+
+    When backing up to several repository targets, each target's
+    progress is also sent as `TargetProgress`, at most `rate` times a
+    second per target, and its outcome as `TargetComplete`.
+
+    Every update is also written to the attached `StatusPage`, if any,
+    for clients that don't use D-Bus."""
+    signatures = dict(STATUS_FIELDS, phase="s", failed_targets="as", paused="b")
+    summary_signatures = dict(SUMMARY_FIELDS)
+
+    def __init__(self, manager, rate=4.0, subscribers_only=False, legacy_progress=True):
+        self.manager = manager
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.subscribers_only = subscribers_only
+        self.legacy_progress = legacy_progress
+        self.subscribers = {}
+        self._lock = threading.Lock()
+        self._fields = {"phase": "idle"}
+        self._sent = {}
+        self._status = None
+        self._next_emit = 0.0
+        self._flush_scheduled = False
+        self._next_target_emit = {}
+        self._page = None
+
+    def _emit(self, name, variant=None):
+        self.manager.con.emit_signal(
+            None, self.manager.publish_path, self.manager.interface_name, name, variant
+        )
+
+    @property
+    def status(self):
+        """The current state as an `a{sv}` variant."""
+        with self._lock:
+            if self._status is None:
+                self._status = _dict_variant(self._fields, self.signatures)
+            return self._status
+
+    @property
+    def phase(self):
+        return self._fields["phase"]
+
+    def _update(self, fields):
+        self._fields = {**self._fields, **fields}
+        self._status = None
+        if self._page is not None:
+            self._page.write(self._fields)
+
+    def attach_page(self, page):
+        """Mirror the state to `page`, a `StatusPage`; `None` closes the current one."""
+        with self._lock:
+            old, self._page = self._page, page
+            if page is not None:
+                page.write(self._fields)
+        if old is not None:
+            old.close()
+
+    def _send_progress(self):
+        # Called with the lock held
+        self._next_emit = time.monotonic() + self.interval
+        if self.subscribers_only and not self.subscribers:
+            return
+        changed = {
+            name: value for name, value in self._fields.items()
+            if self._sent.get(name) != value
+        }
+        if not changed:
+            return
+        self._sent = dict(self._fields)
+        self._emit("ProgressChanged", GLib.Variant.new_tuple(
+            _dict_variant(changed, self.signatures)
+        ))
+        if self.legacy_progress and "seconds_elapsed" in self._fields:
+            self._emit("Progress", GLib.Variant(
+                "(" + "".join(signature for _, signature in STATUS_FIELDS) + ")",
+                tuple(self._fields[name] for name, _ in STATUS_FIELDS)
+            ))
+
+    def _flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+            self._send_progress()
+        return GLib.SOURCE_REMOVE
+
+    def set_phase(self, phase):
+        with self._lock:
+            self._update({"phase": phase})
+            self._send_progress()
+
+    def progress(self, status):
+        """Record a restic status message, and maybe send it."""
+        with self._lock:
+            self._update(_status_fields(status))
+            now = time.monotonic()
+            if now >= self._next_emit:
+                self._send_progress()
+            elif not self._flush_scheduled:
+                self._flush_scheduled = True
+                GLib.timeout_add(int((self._next_emit - now) * 1000) + 1, self._flush)
+
+    def paused(self, paused, reason):
+        with self._lock:
+            self._update({"paused": paused})
+            self._send_progress()
+        self._emit("Paused", GLib.Variant("(bs)", (paused, reason)))
+
+    def started(self):
+        with self._lock:
+            self._update({"failed_targets": []})
+            self._next_target_emit.clear()
+        self._emit("BackupStarted")
+
+    def target_progress(self, target, status):
+        """Maybe send the merged status of one repository target.
+
+        Updates in between are dropped; `target_complete` follows the
+        last one."""
+        now = time.monotonic()
+        if now < self._next_target_emit.get(target, 0.0):
+            return
+        self._next_target_emit[target] = now + self.interval
+        if self.subscribers_only and not self.subscribers:
+            return
+        self._emit("TargetProgress", GLib.Variant.new_tuple(
+            GLib.Variant("s", target),
+            _dict_variant(_status_fields(status), self.signatures)
+        ))
+
+    def target_complete(self, target, success, summary=None):
+        if not success:
+            with self._lock:
+                self._update({"failed_targets": [*self._fields.get("failed_targets", []), target]})
+        fields = {}
+        if summary is not None:
+            fields = {name: getattr(summary, name) for name, _ in SUMMARY_FIELDS}
+            fields["total_duration"] = float(fields["total_duration"])
+        self._emit("TargetComplete", GLib.Variant.new_tuple(
+            GLib.Variant("s", target),
+            GLib.Variant("b", success),
+            _dict_variant(fields, self.summary_signatures)
+        ))
+
+    def error(self, error):
+        self._emit("Error", GLib.Variant("(sss)", (error.error, error.during, error.item)))
+
+    def complete(self, summary):
+        with self._lock:
+            self._send_progress()
+        self._emit("BackupComplete", GLib.Variant("(ttttttxxtttdsb)", (
+            summary.files_new,
+            summary.files_changed,
+            summary.files_unmodified,
+            summary.dirs_new,
+            summary.dirs_changed,
+            summary.dirs_unmodified,
+            summary.data_blobs,
+            summary.tree_blobs,
+            summary.data_added,
+            summary.total_files_processed,
+            summary.total_bytes_processed,
+            float(summary.total_duration),
+            summary.snapshot_id,
+            summary.dry_run
+        )))
+
+    def subscribe(self, sender):
+        if sender in self.subscribers:
+            return
+        self.subscribers[sender] = Gio.bus_watch_name_on_connection(
+            self.manager.con, sender, Gio.BusNameWatcherFlags.NONE,
+            None, lambda connection, name: self.unsubscribe(name)
+        )
+
+    def unsubscribe(self, sender):
+        watcher = self.subscribers.pop(sender, None)
+        if watcher is not None:
+            Gio.bus_unwatch_name(watcher)
@@ -0,0 +1,133 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import sys
+import time
+import threading
+import collections
+
+
+class LatestValue:
+    """A slot holding the most recent value written to it.
+
+    Writers never block: a write is a single attribute assignment, and
+    readers simply see the newest value, skipping any in between."""
+    __slots__ = ("value", "version")
+
+    def __init__(self, value=None):
+        self.value = value
+        self.version = 0
+
+    def set(self, value):
+        self.value = value
+        self.version += 1
+
+
+class Renderer(threading.Thread):
+    """Renders backup progress to the terminal or log at a fixed frame rate.
+
+    The progress loop hands status messages over with `update()` and
+    error lines with `message()`; neither ever waits for the output, so
+    a slow terminal or a congested journal can't hold up reading
+    restic's output.
+
+    Without `scan` (restic's `--no-scan`), the amount left is never
+    known, so only the amount done is shown, and logged every
+    `log_interval` seconds instead of every 0.1%."""
+    def __init__(self, fps=4.0, stdout=sys.stdout, stderr=sys.stderr, verb="uploaded", scan=True, log_interval=60.0):
+        super().__init__(name="igotchuu-renderer", daemon=True)
+        self.interval = 1.0 / fps
+        self.verb = verb
+        self.scan = scan
+        self.log_interval = log_interval
+        self.stdout = stdout
+        self.stderr = stderr
+        self.tty = stdout.isatty()
+        self.latest = LatestValue()
+        self.messages = collections.deque()
+        self._rendered_version = 0
+        self._progress_permille = 0
+        self._logged_at = None
+        self._line_dirty = False
+        self._stopped = threading.Event()
+
+    def update(self, status):
+        self.latest.set(status)
+
+    def message(self, text):
+        self.messages.append(text)
+
+    def run(self):
+        if not self.tty and self.scan:
+            print("scanning...", file=self.stderr)
+        while not self._stopped.wait(self.interval):
+            self.render()
+        self.render()
+        if self._line_dirty:
+            print(file=self.stdout)
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def render(self):
+        while self.messages:
+            if self._line_dirty:
+                print(file=self.stdout)
+                self._line_dirty = False
+            print(self.messages.popleft(), file=self.stderr)
+        if self.latest.version == self._rendered_version:
+            return
+        self._rendered_version = self.latest.version
+        progress = self.latest.value
+        if self.tty:
+            self._render_tty(progress)
+        else:
+            self._render_log(progress)
+
+    def _render_tty(self, progress):
+        if not self.scan:
+            line = f"{progress.files_done} files, "
+        elif progress.seconds_remaining is None and progress.percent_done < 1.0:
+            # Scan isn't complete yet
+            line = f"[scan...] {progress.files_done}/{progress.total_files} files, "
+        else:
+            line = f"[{progress.percent_done: >7.2%}] {progress.files_done}/{progress.total_files} files, "
+        if progress.total_bytes is not None:
+            line += f"{progress.bytes_done / (1024**3):5.2f}/{progress.total_bytes / (1024**3):5.2f}G {self.verb} "
+        else:
+            line += f"{progress.bytes_done / (1024**3):5.2f}G {self.verb} "
+        print(line, end="\r", file=self.stdout, flush=True)
+        self._line_dirty = True
+
+    def _render_log(self, progress):
+        if not self.scan:
+            now = time.monotonic()
+            if self._logged_at is not None and now - self._logged_at < self.log_interval:
+                return
+            self._logged_at = now
+            print(f"{progress.files_done} files, {progress.bytes_done / (1024**3):5.2f}G {self.verb}", file=self.stderr)
+            return
+        permille = int(progress.percent_done * 1000)
+        if permille <= self._progress_permille or progress.seconds_remaining is None:
+            return
+        self._progress_permille = permille
+        line = f"{progress.percent_done: >5.1%}"
+        if progress.total_bytes is not None:
+            line += f" {progress.bytes_done / (1024**3):5.2f}/{progress.total_bytes / (1024**3):5.2f}G {self.verb}"
+        print(line, file=self.stderr)
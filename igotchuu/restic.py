@@ -16,42 +16,426 @@
 # damage or existence of a defect, except proven that it results out
 # of said person's immediate fault when using the work as intended.
 import os
+import re
+import signal
+import typing
+import functools
 import subprocess
+import selectors
 import json
 
 
+class Message:
+    """A single message from restic's `--json` output.
+
+    Subclasses list their fields with defaults in `fields`; a field
+    that restic omitted keeps its default."""
+    __slots__ = ()
+    message_type = None
+    fields = ()
+
+    def __init__(self, **kwargs):
+        for name, default in self.fields:
+            setattr(self, name, kwargs.get(name, default))
+
+    @classmethod
+    def from_json(cls, obj):
+        self = cls.__new__(cls)
+        for name, default in cls.fields:
+            setattr(self, name, obj.get(name, default))
+        return self
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            f"{name}={getattr(self, name)!r}" for name, _ in self.fields
+        ))
+
+
+class StatusMessage(Message):
+    # `seconds_remaining` and `total_bytes` are omitted by restic
+    # until the scan completes, so they stay `None` until then.
+    # `estimated_seconds_remaining` is never sent by restic; it is
+    # igotchuu's own estimate, from `history.Estimator`.
+    fields = (
+        ("seconds_elapsed", 0),
+        ("seconds_remaining", None),
+        ("percent_done", 0.0),
+        ("total_files", 0),
+        ("files_done", 0),
+        ("total_bytes", None),
+        ("bytes_done", 0),
+        ("error_count", 0),
+        ("current_files", ()),
+        ("estimated_seconds_remaining", None),
+    )
+    __slots__ = tuple(name for name, _ in fields)
+    message_type = "status"
+
+
+class ErrorMessage(Message):
+    fields = (
+        ("error", ""),
+        ("during", ""),
+        ("item", ""),
+    )
+    __slots__ = tuple(name for name, _ in fields)
+    message_type = "error"
+
+    @classmethod
+    def from_json(cls, obj):
+        self = super().from_json(obj)
+        # Newer restic versions wrap the error into an object
+        if isinstance(self.error, dict):
+            self.error = self.error.get("message", "")
+        return self
+
+
+class SummaryMessage(Message):
+    fields = (
+        ("files_new", 0),
+        ("files_changed", 0),
+        ("files_unmodified", 0),
+        ("dirs_new", 0),
+        ("dirs_changed", 0),
+        ("dirs_unmodified", 0),
+        ("data_blobs", 0),
+        ("tree_blobs", 0),
+        ("data_added", 0),
+        ("total_files_processed", 0),
+        ("total_bytes_processed", 0),
+        ("total_duration", 0.0),
+        ("snapshot_id", ""),
+        ("dry_run", False),
+    )
+    __slots__ = tuple(name for name, _ in fields)
+    message_type = "summary"
+
+
+MESSAGE_TYPES = {
+    cls.message_type: cls for cls in (StatusMessage, ErrorMessage, SummaryMessage)
+}
+
+
+class RestoreStatusMessage(StatusMessage):
+    """A status message of `restic restore`, in the terms of `backup`.
+
+    Files and bytes restic skipped because they were already restored
+    count as done. restic doesn't estimate the time left of a restore,
+    so it is worked out from the speed so far."""
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, obj):
+        self = super().from_json(obj)
+        self.files_done = obj.get("files_restored", 0) + obj.get("files_skipped", 0)
+        self.bytes_done = obj.get("bytes_restored", 0) + obj.get("bytes_skipped", 0)
+        if self.total_bytes is not None and self.bytes_done and self.seconds_elapsed:
+            self.seconds_remaining = int(
+                max(self.total_bytes - self.bytes_done, 0) * self.seconds_elapsed / self.bytes_done
+            )
+        return self
+
+
+class RestoreSummaryMessage(Message):
+    fields = (
+        ("seconds_elapsed", 0),
+        ("total_files", 0),
+        ("files_restored", 0),
+        ("files_skipped", 0),
+        ("total_bytes", 0),
+        ("bytes_restored", 0),
+        ("bytes_skipped", 0),
+    )
+    __slots__ = tuple(name for name, _ in fields)
+    message_type = "summary"
+
+
+RESTORE_MESSAGE_TYPES = {
+    cls.message_type: cls for cls in (RestoreStatusMessage, ErrorMessage, RestoreSummaryMessage)
+}
+
+
+def _decode_lines(lines):
+    """Decode a batch of JSON lines, skipping ones that aren't JSON objects."""
+    try:
+        # One parser call for the whole batch is much cheaper than
+        # one per line.
+        return json.loads(b"[" + b",".join(lines) + b"]")
+    except ValueError:
+        objects = []
+        for line in lines:
+            try:
+                objects.append(json.loads(line))
+            except ValueError:
+                pass
+        return objects
+
+
+class ProgressReader:
+    """Incrementally reads and decodes restic's `--json` output from a pipe.
+
+    The file descriptor is switched to non-blocking mode; `read()` should
+    be called whenever it becomes readable. Data is drained into a
+    reusable buffer and complete lines are decoded in one batch."""
+    def __init__(self, fd, coalesce_status=False, chunk_size=65536, message_types=MESSAGE_TYPES):
+        self.fd = fd
+        self.coalesce_status = coalesce_status
+        self.message_types = message_types
+        self.eof = False
+        self._chunk = bytearray(chunk_size)
+        self._view = memoryview(self._chunk)
+        self._pending = bytearray()
+        os.set_blocking(fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Drain the pipe and return a list of decoded messages."""
+        while True:
+            try:
+                size = os.readv(self.fd, (self._chunk,))
+            except BlockingIOError:
+                break
+            if size == 0:
+                self.eof = True
+                break
+            self._pending += self._view[:size]
+            if size < len(self._chunk):
+                break
+
+        if self.eof:
+            end = len(self._pending)
+        else:
+            end = self._pending.rfind(b"\n") + 1
+        if end == 0:
+            return []
+        lines = [line for line in self._pending[:end].split(b"\n") if line.strip()]
+        del self._pending[:end]
+        return self._parse(_decode_lines(lines))
+
+    def _parse(self, objects):
+        messages = []
+        for obj in objects:
+            if not isinstance(obj, dict):
+                continue
+            cls = self.message_types.get(obj.get("message_type"))
+            if cls is None:
+                continue
+            if (
+                    self.coalesce_status and messages
+                    and cls.message_type == "status"
+                    and messages[-1].message_type == "status"
+            ):
+                messages.pop()
+            messages.append(cls.from_json(obj))
+        return messages
+
+
+def repository_kwargs(config):
+    """Pick the repository and password options out of the config."""
+    return {
+        key: config.get(key, None)
+        for key in ("repo", "repository_file", "password_command", "password_file")
+    }
+
+
+class RepositoryTarget(typing.NamedTuple):
+    """A repository igotchuu backs up to."""
+    name: str
+    repository: dict
+    # Extra restic options for this repository, like bandwidth limits
+    args: typing.List[str]
+    # At most this many restic processes back up to it at once
+    max_jobs: typing.Optional[int]
+
+
+def repository_targets(config):
+    """The repositories to back up to.
+
+    Every entry of `targets` is a table with the same repository and
+    password options as the top level, plus `name`, `max_jobs`,
+    `limit_upload`/`limit_download` (KiB/s) and `restic_args`. Without
+    `targets`, the top-level options make up a single target."""
+    targets = config.get("targets")
+    if not targets:
+        return [RepositoryTarget("default", repository_kwargs(config), [], None)]
+    result = []
+    for i, target in enumerate(targets):
+        args = list(target.get("restic_args", []))
+        if target.get("limit_upload") is not None:
+            args += ["--limit-upload", str(target["limit_upload"])]
+        if target.get("limit_download") is not None:
+            args += ["--limit-download", str(target["limit_download"])]
+        result.append(RepositoryTarget(
+            target.get("name", str(i)), repository_kwargs(target), args, target.get("max_jobs")
+        ))
+    return result
+
+
+def repository_name(repo=None, repository_file=None, **kwargs):
+    """A string identifying the repository, for keying local state."""
+    if repo is not None:
+        return repo
+    if repository_file is not None:
+        with open(repository_file) as f:
+            return f.read().strip()
+    return os.environ.get("RESTIC_REPOSITORY")
+
+
+@functools.lru_cache(maxsize=None)
+def restic_version():
+    """The version of restic as a tuple of numbers, or `None` if it can't be told."""
+    try:
+        result = subprocess.run(["restic", "version"], stdout=subprocess.PIPE, text=True)
+    except OSError:
+        return None
+    match = re.match(r"restic (\d+)\.(\d+)\.(\d+)", result.stdout)
+    return tuple(map(int, match.groups())) if match is not None else None
+
+
+def restic_env(
+        env=None, repo=None, password_file=None, repository_file=None,
+        password_command=None
+):
+    """Build the environment for running restic against a repository."""
+    env = dict(os.environ if env is None else env)
+    if repo is not None:
+        env["RESTIC_REPOSITORY"] = repo
+    if password_file is not None:
+        env['RESTIC_PASSWORD_FILE'] = password_file
+    if repository_file is not None:
+        env['RESTIC_REPOSITORY_FILE'] = repository_file
+    if password_command is not None:
+        env['RESTIC_PASSWORD_COMMAND'] = password_command
+    return env
+
+
 class Restic(subprocess.Popen):
+    places = ()
+    summary = None
+    # How to decode the `--json` output of the command
+    message_types = MESSAGE_TYPES
+
     @classmethod
     def backup(
-            cls, places=[], extra_args=[], env=dict(os.environ),
+            cls, places=[], extra_args=[], env=None,
+            repo=None, password_file=None, repository_file=None, password_command=None,
+            parent=None, **kwargs
+    ):
+        env = restic_env(
+            env, repo=repo, password_file=password_file,
+            repository_file=repository_file, password_command=password_command
+        )
+        env["RESTIC_PROGRESS_FPS"] = "4"
+        if parent is not None:
+            extra_args = [*extra_args, "--parent", parent]
+
+        self = cls(
+            args=["restic", "backup", *extra_args, "--json", "--", *places],
+            stdout=subprocess.PIPE, bufsize=0, env=env, **kwargs
+        )
+        self.places = list(places)
+        return self
+
+    @classmethod
+    def command(
+            cls, args, extra_args=[], env=None,
             repo=None, password_file=None, repository_file=None, password_command=None,
             **kwargs
     ):
-        if repo is not None:
-            env["RESTIC_REPOSITORY"] = repo
-        if password_file is not None:
-            env['RESTIC_PASSWORD_FILE'] = password_file
-        if repository_file is not None:
-            env['RESTIC_REPOSITORY_FILE'] = repository_file
-        if password_command is not None:
-            env['RESTIC_PASSWORD_COMMAND'] = password_command
+        """Run any restic command, e.g. `["prune"]`, with its output on `stdout`."""
+        env = restic_env(
+            env, repo=repo, password_file=password_file,
+            repository_file=repository_file, password_command=password_command
+        )
+        return cls(
+            args=["restic", *extra_args, *args],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, env=env, **kwargs
+        )
 
+    @classmethod
+    def restore(
+            cls, snapshot, target, include_file=None, includes=(), extra_args=[], env=None,
+            repo=None, password_file=None, repository_file=None, password_command=None,
+            **kwargs
+    ):
+        """Restore `snapshot` into `target`.
+
+        If `include_file` or `includes` are given, only the paths matching
+        the patterns in the file or the patterns themselves are restored."""
+        env = restic_env(
+            env, repo=repo, password_file=password_file,
+            repository_file=repository_file, password_command=password_command
+        )
         env["RESTIC_PROGRESS_FPS"] = "4"
+        if include_file is not None:
+            extra_args = [*extra_args, "--include-file", include_file]
+        for pattern in includes:
+            extra_args = [*extra_args, "--include", pattern]
 
-        return cls(
-            args=["restic", "backup", *extra_args, "--json", "--", *places],
-            stdout=subprocess.PIPE, text=True, env=env, **kwargs
+        self = cls(
+            args=["restic", "restore", *extra_args, "--json", "--target", target, "--", snapshot],
+            stdout=subprocess.PIPE, bufsize=0, env=env, **kwargs
         )
+        self.message_types = RESTORE_MESSAGE_TYPES
+        return self
 
-    def progress_iter(self):
-        while True:
-            line = self.stdout.readline()
-            if len(line) > 0:
-                progress = json.loads(line)
-                yield progress
-                if progress["message_type"] == "summary":
-                    return self.wait()
-            else:
-                returncode = self.poll()
-                if returncode is not None:
-                    return returncode
+    def pause(self):
+        self.send_signal(signal.SIGSTOP)
+
+    def resume(self):
+        self.send_signal(signal.SIGCONT)
+
+    def terminate(self):
+        super().terminate()
+        # A stopped process only acts on SIGTERM once it is continued
+        self.resume()
+
+    def completed(self):
+        """Return `(places, summary)` pairs for finished backups."""
+        if self.summary is None:
+            return []
+        return [(self.places, self.summary)]
+
+    def watch(self, loop, on_progress, on_exit, coalesce_status=False):
+        """Pass progress messages to `on_progress` from `loop` as they arrive.
+
+        `loop` is an `EventLoop`. `on_exit` is called with the return code
+        once restic closes its output. `coalesce_status` is as for
+        `progress_iter()`."""
+        reader = ProgressReader(
+            self.stdout.fileno(), coalesce_status=coalesce_status, message_types=self.message_types
+        )
+
+        def readable():
+            for progress in reader.read():
+                if progress.message_type == "summary":
+                    self.summary = progress
+                on_progress(progress)
+            if reader.eof:
+                on_exit(self.wait())
+            return not reader.eof
+
+        loop.add_reader(reader.fileno(), readable)
+
+    def progress_iter(self, coalesce_status=False):
+        """Iterate over progress messages until restic exits.
+
+        Blocks in `select()` while restic is quiet. If `coalesce_status`
+        is set, consecutive status messages that arrived together are
+        merged, so only the newest one is yielded."""
+        reader = ProgressReader(
+            self.stdout.fileno(), coalesce_status=coalesce_status, message_types=self.message_types
+        )
+        with selectors.DefaultSelector() as selector:
+            selector.register(reader, selectors.EVENT_READ)
+            while not reader.eof:
+                selector.select()
+                for progress in reader.read():
+                    if progress.message_type == "summary":
+                        self.summary = progress
+                    yield progress
+                    if progress.message_type == "summary":
+                        return self.wait()
+        return self.wait()
@@ -0,0 +1,351 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import re
+import sys
+import json
+import stat
+import heapq
+import signal
+import hashlib
+import calendar
+import tempfile
+import subprocess
+from igotchuu.restic import Restic, restic_env
+from igotchuu.state import state_path, load_json, save_json
+from igotchuu.scheduler import BackupJob, Scheduler
+from igotchuu.render import Renderer
+from igotchuu.glib_loop import EventLoop
+from igotchuu.warmup import cache_args
+
+
+# Fields of a `restic ls --json` node that are restored on directories
+# that were split into shards
+METADATA_FIELDS = ("mode", "uid", "gid", "mtime", "atime")
+# Go's `os.FileMode` bits, as restic reports them, and the ones of `chmod`
+GO_MODE_BITS = ((1 << 23, stat.S_ISUID), (1 << 22, stat.S_ISGID), (1 << 20, stat.S_ISVTX))
+
+
+class Tree:
+    """Sizes of the files and directories in a snapshot, down to `max_depth`.
+
+    Anything deeper is only counted towards its ancestor at `max_depth`,
+    which can't be split any further, so that listing a snapshot with
+    millions of files doesn't take gigabytes of memory. Directories
+    also keep their metadata from `restic ls`, if given."""
+    __slots__ = ("size", "children", "metadata")
+
+    def __init__(self):
+        self.size = 0
+        # Name -> Tree for directories, or size for anything else
+        self.children = {}
+        self.metadata = None
+
+    def add(self, path, size=0, directory=False, max_depth=6, metadata=None):
+        node = self
+        names = [name for name in path.split("/") if name]
+        for depth, name in enumerate(names, start=1):
+            node.size += size
+            if depth > max_depth:
+                return
+            if depth == len(names):
+                if directory:
+                    if not isinstance(node.children.get(name), Tree):
+                        node.children[name] = Tree()
+                    node.children[name].size += size
+                    node.children[name].metadata = metadata
+                else:
+                    node.children[name] = size
+                return
+            child = node.children.get(name)
+            if not isinstance(child, Tree):
+                child = node.children[name] = Tree()
+            node = child
+
+
+def list_snapshot(snapshot, restic_args=(), env=None, max_depth=6):
+    """List `snapshot` with `restic ls`. Returns its full ID and its `Tree`."""
+    process = subprocess.Popen(
+        ["restic", *restic_args, "ls", "--json", "--", snapshot],
+        stdout=subprocess.PIPE, env=env
+    )
+    snapshot_id = None
+    tree = Tree()
+    with process.stdout:
+        for line in process.stdout:
+            try:
+                node = json.loads(line)
+            except ValueError:
+                continue
+            # restic 0.16 and older only set `struct_type`
+            kind = node.get("message_type", node.get("struct_type"))
+            if kind == "snapshot":
+                snapshot_id = node["id"]
+            elif kind == "node":
+                directory = node["type"] == "dir"
+                metadata = {field: node.get(field) for field in METADATA_FIELDS} if directory else None
+                tree.add(node["path"], node.get("size", 0), directory, max_depth, metadata)
+    if process.wait() != 0 or snapshot_id is None:
+        raise RuntimeError(f"cannot list snapshot {snapshot}, restic exited with status {process.returncode}")
+    return snapshot_id, tree
+
+
+def make_shards(tree, count):
+    """Split `tree` into at most `count` lists of paths of about the same size.
+
+    Directories bigger than a shard is meant to be are split into their
+    children, largest first, then the pieces are dealt out largest first
+    to the smallest shard so far. Returns `(size, paths)` pairs."""
+    target = tree.size / count
+    # Max-heap of (-size, path, node)
+    pieces = [(-size(node), "/" + name, node) for name, node in tree.children.items()]
+    heapq.heapify(pieces)
+    while pieces and -pieces[0][0] > target:
+        _, path, node = pieces[0]
+        if not isinstance(node, Tree) or not node.children:
+            break
+        heapq.heappop(pieces)
+        for name, child in node.children.items():
+            heapq.heappush(pieces, (-size(child), f"{path}/{name}", child))
+
+    shards = [(0, i, []) for i in range(count)]
+    for negative_size, path, _ in sorted(pieces):
+        shard_size, i, paths = heapq.heappop(shards)
+        paths.append(path)
+        heapq.heappush(shards, (shard_size - negative_size, i, paths))
+    return [(shard_size, paths) for shard_size, _, paths in sorted(shards, key=lambda shard: shard[1]) if paths]
+
+
+def size(node):
+    return node.size if isinstance(node, Tree) else node
+
+
+def split_directories(tree, shards):
+    """Return `{path: metadata}` of the directories `make_shards` split up.
+
+    restic only restores the metadata of directories it was asked to
+    restore, and shards only ask for what is inside them."""
+    directories = {}
+    for _, paths in shards:
+        for path in paths:
+            node = tree
+            ancestor = ""
+            for name in path.split("/")[1:-1]:
+                node = node.children[name]
+                ancestor += "/" + name
+                directories[ancestor] = node.metadata
+    return directories
+
+
+def _timestamp_ns(text):
+    # RFC 3339 with up to nanoseconds, as restic prints them
+    match = re.fullmatch(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|([+-])(\d\d):(\d\d))", text)
+    if match is None:
+        raise ValueError(f"invalid timestamp {text!r}")
+    year, month, day, hour, minute, second = map(int, match.group(1, 2, 3, 4, 5, 6))
+    seconds = calendar.timegm((year, month, day, hour, minute, second))
+    if match[9] is not None:
+        offset = int(match[10]) * 3600 + int(match[11]) * 60
+        seconds -= offset if match[9] == "+" else -offset
+    return seconds * 10**9 + int((match[7] or "0")[:9].ljust(9, "0"))
+
+
+def restore_directories(destination, directories):
+    """Give the split `directories` under `destination` their metadata from the snapshot.
+
+    Deeper directories go first. Like restic, ownership is only changed
+    when running as root."""
+    for path, metadata in sorted(directories.items(), key=lambda item: item[0].count("/"), reverse=True):
+        target = os.path.join(destination, path.lstrip("/"))
+        if metadata is None or not os.path.isdir(target):
+            continue
+        if os.geteuid() == 0 and metadata["uid"] is not None:
+            os.chown(target, metadata["uid"], metadata["gid"], follow_symlinks=False)
+        if metadata["mode"] is not None:
+            mode = metadata["mode"] & 0o777
+            for go_bit, bit in GO_MODE_BITS:
+                if metadata["mode"] & go_bit:
+                    mode |= bit
+            os.chmod(target, mode)
+        if metadata["mtime"] is not None:
+            mtime = _timestamp_ns(metadata["mtime"])
+            atime = _timestamp_ns(metadata["atime"]) if metadata["atime"] is not None else mtime
+            os.utime(target, ns=(atime, mtime), follow_symlinks=False)
+
+
+def escape_pattern(path):
+    """Escape a path for use as a restic `--include` pattern.
+
+    `$` becomes `[$]`, which matches it and is left alone by the
+    expansion of environment variables in pattern files."""
+    escaped = "".join(
+        "\\" + char if char in "\\*?[" else "[$]" if char == "$" else char
+        for char in path
+    )
+    if escaped.startswith("#"):
+        escaped = "\\" + escaped
+    return escaped
+
+
+def split_patterns(paths):
+    """Escape `paths` into patterns for an `--include-file` and for `--include`s.
+
+    restic trims whitespace off the lines of pattern files, and can't
+    have a newline in them, so paths with either go on the command
+    line. Returns `(file patterns, argument patterns)`."""
+    lines, arguments = [], []
+    for path in paths:
+        if "\n" in path or path != path.strip():
+            arguments.append(escape_pattern(path))
+        else:
+            lines.append(escape_pattern(path))
+    return lines, arguments
+
+
+def run_restore(config, repository, snapshot, destination, backup_manager=None, jobs=None, shards=None, fresh=False):
+    """Restore `snapshot` from `repository` (a `RepositoryTarget`) into `destination`.
+
+    The snapshot is split into shards of about the same size, restored
+    by up to `jobs` restic processes at once, each with the paths of
+    one shard as `--include`s. The shards and which of them were
+    restored are kept in the state directory, so that running it again
+    after an interruption only restores the rest, unless `fresh` is set.
+    Progress is reported through `backup_manager` if given. Returns
+    whether every shard was restored.
+
+    Once every shard is restored, the directories that were split up
+    get their owner, mode and times from the snapshot, which restic
+    leaves alone as no shard includes them."""
+    restore_config = config.get("restore", {})
+    jobs = jobs or restore_config.get("jobs", 4)
+    shards = shards or jobs * restore_config.get("shards_per_job", 4)
+    env = restic_env(**repository.repository)
+    restic_args = config.get("restic_args", []) + cache_args(config) + repository.args
+    destination = os.path.abspath(destination)
+    state_file = state_path(config, "restore-{}.json".format(
+        hashlib.sha256(f"{repository.name}:{destination}".encode()).hexdigest()[:16]
+    ))
+
+    state = None if fresh else load_json(state_file)
+    if state is None or not (len(snapshot) >= 8 and state["snapshot"].startswith(snapshot)):
+        # `latest` and the like have to be looked up again
+        print(f"Listing snapshot {snapshot}...", file=sys.stderr)
+        snapshot_id, tree = list_snapshot(snapshot, restic_args, env, restore_config.get("max_depth", 6))
+        if state is None or state["snapshot"] != snapshot_id:
+            shard_list = make_shards(tree, shards)
+            state = {
+                "snapshot": snapshot_id,
+                "shards": shard_list,
+                "directories": split_directories(tree, shard_list),
+                "done": [],
+            }
+            save_json(state_file, state)
+    snapshot_id = state["snapshot"]
+    done = set(state["done"])
+    remaining = [i for i in range(len(state["shards"])) if i not in done]
+    if done:
+        print(f"Resuming: {len(done)} of {len(state['shards'])} shards are already restored.", file=sys.stderr)
+    total = sum(state["shards"][i][0] for i in remaining)
+
+    def finished(job):
+        if job.returncode == 0:
+            state["done"].append(shard_of[job])
+            save_json(state_file, state)
+
+    with tempfile.TemporaryDirectory(prefix="igotchuu-restore-") as include_dir:
+        shard_of = {}
+        include_files = {}
+        includes = {}
+        for i in remaining:
+            job = BackupJob(state["shards"][i][1])
+            shard_of[job] = i
+            include_files[job] = os.path.join(include_dir, f"shard-{i}")
+            lines, includes[job] = split_patterns(job.places)
+            with open(include_files[job], "w") as f:
+                f.writelines(line + "\n" for line in lines)
+        restic = Scheduler(
+            list(shard_of),
+            start=lambda job: Restic.restore(
+                snapshot_id, destination, include_file=include_files[job], includes=includes[job],
+                extra_args=restic_args, **repository.repository
+            ),
+            max_jobs=jobs, finished=finished
+        )
+        loop = EventLoop()
+        stop_signal = None
+        if backup_manager is not None:
+            backup_manager.loop = loop
+            backup_manager.restic = restic
+            backup_manager.pausing.attach(restic)
+            backup_manager.publisher.set_phase("restore")
+            if loop.main:
+                stop_signal = loop.add_signal_handler(signal.SIGTERM, backup_manager.Stop)
+        elif loop.main:
+            stop_signal = loop.add_signal_handler(signal.SIGTERM, restic.terminate)
+        renderer = Renderer(fps=config.get("output", {}).get("fps", 4.0), verb="restored")
+
+        def on_progress(progress):
+            if progress.message_type == "status":
+                # Shards that are yet to start count towards the total too
+                progress.total_bytes = total
+                progress.percent_done = min(progress.bytes_done / total, 1.0) if total else 1.0
+                progress.seconds_remaining = None
+                if progress.bytes_done and progress.seconds_elapsed:
+                    progress.seconds_remaining = int(
+                        max(total - progress.bytes_done, 0) * progress.seconds_elapsed / progress.bytes_done
+                    )
+                if backup_manager is not None:
+                    backup_manager.publisher.progress(progress)
+                renderer.update(progress)
+            elif progress.message_type == "error":
+                if backup_manager is not None:
+                    backup_manager.publisher.error(progress)
+                renderer.message("Error during {} of {}: {}".format(
+                    progress.during, progress.item, progress.error
+                ))
+            elif progress.message_type == "summary":
+                renderer.stop()
+                print("Restored in this run:")
+                print(" - Restored files:    ", progress.files_restored)
+                print(" - Skipped files:     ", progress.files_skipped)
+                print(" - Restored bytes:    ", progress.bytes_restored)
+
+        print(f"Restoring {len(remaining)} shards of {snapshot_id} to {destination}...", file=sys.stderr)
+        try:
+            renderer.start()
+            restic.watch(loop, on_progress, lambda returncode: loop.stop(), coalesce_status=True)
+            loop.run()
+        finally:
+            renderer.stop()
+            if stop_signal is not None:
+                loop.remove(stop_signal)
+            if backup_manager is not None:
+                backup_manager.pausing.detach()
+            restic.wait()
+            if backup_manager is not None:
+                backup_manager.restic = None
+                backup_manager.loop = None
+                backup_manager.publisher.set_phase("idle")
+
+    if len(state["done"]) < len(state["shards"]):
+        left = len(state["shards"]) - len(state["done"])
+        print(f"{left} shards were not restored; run the same command again to retry them.", file=sys.stderr)
+        return False
+    restore_directories(destination, state.get("directories", {}))
+    os.unlink(state_file)
+    return True
@@ -0,0 +1,300 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import time
+import collections
+from igotchuu.restic import ProgressReader, StatusMessage
+from igotchuu.mount import mount_source
+
+
+class BackupJob:
+    """A set of places backed up by one restic process."""
+    def __init__(self, places, devices=(), profile=None, target=None):
+        self.places = list(places)
+        self.devices = frozenset(devices)
+        self.profile = profile
+        self.target = target
+        self.restic = None
+        self.reader = None
+        self.status = None
+        self.summary = None
+        self.returncode = None
+
+    def __repr__(self):
+        return f"BackupJob(places={self.places!r}, devices={sorted(self.devices)!r})"
+
+
+def group_places(places, groups=()):
+    """Split places into groups: the configured ones, and one per ungrouped place."""
+    result = []
+    grouped = set()
+    for group in groups:
+        group = [place for place in group if place in places]
+        if group:
+            result.append(group)
+            grouped.update(group)
+    result.extend([place] for place in places if place not in grouped)
+    return result
+
+
+def plan_jobs(places, groups=(), profile=None, target=None):
+    """Create one job per group of places."""
+    return [
+        BackupJob(group, devices=(mount_source(place) for place in group), profile=profile, target=target)
+        for group in group_places(places, groups)
+    ]
+
+
+def merge_status(jobs):
+    """Merge the latest status of several jobs into one status message.
+
+    Until every job has finished scanning, `seconds_remaining` and
+    `total_bytes` stay unset, as they would for a single restic process
+    that is still scanning."""
+    merged = StatusMessage(current_files=[])
+    scanning = False
+    for job in jobs:
+        finished = job.returncode is not None
+        status = job.status
+        if status is None:
+            scanning = scanning or not finished
+            continue
+        merged.seconds_elapsed = max(merged.seconds_elapsed, status.seconds_elapsed)
+        merged.total_files += status.total_files
+        merged.files_done += status.files_done
+        merged.bytes_done += status.bytes_done
+        merged.error_count += status.error_count
+        if status.total_bytes is not None:
+            merged.total_bytes = (merged.total_bytes or 0) + status.total_bytes
+        if finished:
+            continue
+        merged.current_files.extend(status.current_files)
+        if status.seconds_remaining is None:
+            scanning = True
+        else:
+            merged.seconds_remaining = max(merged.seconds_remaining or 0, status.seconds_remaining)
+
+    if scanning:
+        merged.seconds_remaining = None
+        merged.total_bytes = None
+        done = [
+            1.0 if job.returncode is not None
+            else job.status.percent_done if job.status is not None
+            else 0.0
+            for job in jobs
+        ]
+        merged.percent_done = sum(done) / len(done) if done else 0.0
+    else:
+        merged.seconds_remaining = merged.seconds_remaining or 0
+        if merged.total_bytes:
+            merged.percent_done = min(merged.bytes_done / merged.total_bytes, 1.0)
+        else:
+            merged.percent_done = 1.0
+    return merged
+
+
+def merge_summaries(summaries, total_duration):
+    """Sum up the summaries of several restic runs into one."""
+    cls = type(summaries[0])
+    merged = cls()
+    for name, default in cls.fields:
+        values = [getattr(summary, name) for summary in summaries]
+        if name in ("total_duration", "seconds_elapsed"):
+            value = total_duration
+        elif name == "snapshot_id":
+            value = " ".join(values)
+        elif isinstance(default, bool):
+            value = any(values)
+        else:
+            value = sum(values)
+        setattr(merged, name, value)
+    return merged
+
+
+class Scheduler:
+    """Runs backup jobs concurrently, within CPU and I/O limits.
+
+    At most `max_jobs` restic processes (the CPU count by default) run
+    at the same time, and at most `io_budget` sets of places are read
+    from any single device at once. Jobs backing up the same places to
+    different repository targets count once against the budget, since
+    they read the same files. A job's target may limit how many of its
+    jobs run at once. `start` is called with a `BackupJob` and must
+    return a started `Restic` process.
+
+    Quacks like a `Restic` process, so it can be watched, stopped,
+    paused and waited on the same way. No new jobs are started while
+    paused. `finished`, if given, is called with every job whose restic
+    process exited."""
+    def __init__(self, jobs, start, max_jobs=None, io_budget=1, finished=None):
+        self.jobs = list(jobs)
+        self.start = start
+        self.finished = finished
+        self.max_jobs = max(1, max_jobs or os.cpu_count() or 1)
+        self.io_budget = max(1, io_budget)
+        self.pending = list(self.jobs)
+        self.running = []
+        self.stopped = False
+        self.paused = False
+        self._io_used = collections.Counter()
+        self._readers = collections.Counter()
+        self._loop = None
+        self._on_progress = None
+        self._on_exit = None
+        self._coalesce_status = False
+        self._started = None
+
+    def _reads(self, job):
+        return [(device, tuple(job.places)) for device in job.devices]
+
+    def _can_start(self, job):
+        if len(self.running) >= self.max_jobs:
+            return False
+        target = job.target
+        if target is not None and target.max_jobs is not None:
+            if sum(1 for other in self.running if other.target == target) >= target.max_jobs:
+                return False
+        return all(
+            self._readers[read] > 0 or self._io_used[read[0]] < self.io_budget
+            for read in self._reads(job)
+        )
+
+    def _acquire(self, job):
+        for read in self._reads(job):
+            if self._readers[read] == 0:
+                self._io_used[read[0]] += 1
+            self._readers[read] += 1
+
+    def _release(self, job):
+        for read in self._reads(job):
+            self._readers[read] -= 1
+            if self._readers[read] == 0:
+                self._io_used[read[0]] -= 1
+
+    def _start_ready(self):
+        for job in list(self.pending):
+            if self.stopped or self.paused:
+                return
+            if not self._can_start(job):
+                continue
+            self.pending.remove(job)
+            job.restic = self.start(job)
+            if self.stopped:
+                # Raced with `terminate()`
+                job.restic.terminate()
+            elif self.paused:
+                # Raced with `pause()`
+                job.restic.pause()
+            job.reader = ProgressReader(
+                job.restic.stdout.fileno(), coalesce_status=self._coalesce_status,
+                message_types=job.restic.message_types
+            )
+            self._loop.add_reader(job.reader.fileno(), self._readable, job)
+            self._acquire(job)
+            self.running.append(job)
+
+    def _finish(self, job):
+        job.returncode = job.restic.wait()
+        self._release(job)
+        self.running.remove(job)
+        if self.finished is not None:
+            self.finished(job)
+
+    def _readable(self, job):
+        status_changed = False
+        for progress in job.reader.read():
+            if progress.message_type == "status":
+                job.status = progress
+                status_changed = True
+            elif progress.message_type == "summary":
+                job.summary = progress
+            else:
+                self._on_progress(progress)
+        if job.reader.eof:
+            self._finish(job)
+            status_changed = True
+        if status_changed and self.running:
+            self._on_progress(merge_status(self.jobs))
+        self._advance()
+        return not job.reader.eof
+
+    def _advance(self):
+        if self._on_exit is None:
+            return
+        self._start_ready()
+        # Nothing may be running while paused; pending jobs are started
+        # once resumed.
+        if self.running or (self.paused and self.pending and not self.stopped):
+            return
+        on_exit, self._on_exit = self._on_exit, None
+        summaries = [job.summary for job in self.jobs if job.summary is not None]
+        if summaries:
+            self._on_progress(merge_summaries(summaries, time.monotonic() - self._started))
+        on_exit(self.returncode)
+
+    def watch(self, loop, on_progress, on_exit, coalesce_status=False):
+        """Run the jobs from `loop`, an `EventLoop`.
+
+        Error messages are passed to `on_progress` as-is, status
+        messages are merged across jobs, and a single merged summary is
+        passed once every job has finished. `on_exit` is called with the
+        return code after that."""
+        self._loop = loop
+        self._on_progress = on_progress
+        self._on_exit = on_exit
+        self._coalesce_status = coalesce_status
+        self._started = time.monotonic()
+        self._advance()
+
+    def completed(self):
+        """Return `(places, summary)` pairs for finished jobs."""
+        return [
+            (job.places, job.summary) for job in self.jobs
+            if job.summary is not None
+        ]
+
+    @property
+    def returncode(self):
+        returncodes = [job.returncode for job in self.jobs if job.restic is not None]
+        if None in returncodes:
+            return None
+        return max(returncodes, key=abs, default=0)
+
+    def pause(self):
+        self.paused = True
+        for job in list(self.running):
+            job.restic.pause()
+
+    def resume(self):
+        self.paused = False
+        for job in list(self.running):
+            job.restic.resume()
+        if self._loop is not None:
+            self._loop.invoke(self._advance)
+
+    def terminate(self):
+        self.stopped = True
+        self.pending.clear()
+        for job in list(self.running):
+            job.restic.terminate()
+
+    def wait(self):
+        for job in self.jobs:
+            if job.restic is not None:
+                job.returncode = job.restic.wait()
+        return self.returncode
@@ -0,0 +1,122 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import typing
+import concurrent.futures
+import btrfsutil
+from igotchuu.btrfs import create_snapshot, covering_sources
+from igotchuu.mount import bind_mounts
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+class Snapshot(typing.NamedTuple):
+    source: str
+    path: str
+
+
+class SnapshotPlan(typing.NamedTuple):
+    """The snapshots taken for one backup run.
+
+    Computed once from the `snapshot` config, and then used to create,
+    mount and delete the snapshots, so all three agree on the paths."""
+    timestamp: str
+    snapshots: typing.Tuple[Snapshot, ...]
+
+    @classmethod
+    def from_config(cls, config, timestamp):
+        """Plan snapshots for `config["snapshot"]` at `timestamp` (a datetime)."""
+        timestamp = timestamp.strftime(TIMESTAMP_FORMAT)
+        prefix = config.get("snapshot_prefix", "")
+        snapshots = []
+        for place in config["snapshot"]:
+            if isinstance(place, str):
+                place = {"source": place}
+            location = place.get("snapshot_location")
+            if location is None:
+                location = os.path.join(prefix, place["source"].lstrip("/")) if prefix else place["source"]
+            snapshots.append(Snapshot(place["source"], f"{location}-{timestamp}"))
+        return cls(timestamp, tuple(snapshots))
+
+    @classmethod
+    def union(cls, plans):
+        """Merge plans made at the same time into one with a snapshot per source.
+
+        If plans disagree on where to put the snapshot of a source, the
+        first one wins."""
+        snapshots = {}
+        for plan in plans:
+            for snapshot in plan.snapshots:
+                snapshots.setdefault(snapshot.source, snapshot)
+        return cls(plans[0].timestamp, tuple(snapshots.values()))
+
+    @property
+    def sources(self):
+        return [snapshot.source for snapshot in self.snapshots]
+
+    @property
+    def paths(self):
+        return [snapshot.path for snapshot in self.snapshots]
+
+    @property
+    def locations(self):
+        """Snapshot paths without the timestamp, as configured."""
+        return [snapshot.path[:-len(self.timestamp) - 1] for snapshot in self.snapshots]
+
+    def covering(self, places):
+        """Return a plan with only the snapshots relevant to `places`."""
+        return self._replace(snapshots=tuple(
+            snapshot for snapshot in self.snapshots
+            if covering_sources(snapshot.source, places)
+        ))
+
+    def select(self, sources):
+        """Return a plan with only the snapshots of `sources`."""
+        return self._replace(snapshots=tuple(
+            snapshot for snapshot in self.snapshots if snapshot.source in sources
+        ))
+
+    def create(self):
+        """Create all snapshots concurrently.
+
+        btrfs creates pending snapshots while committing a transaction,
+        and concurrent snapshot ioctls join the same commit. If any
+        snapshot fails, the ones already created are deleted again."""
+        for snapshot in self.snapshots:
+            os.makedirs(os.path.dirname(snapshot.path), exist_ok=True)
+        if not self.snapshots:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.snapshots)) as pool:
+            futures = {
+                pool.submit(create_snapshot, snapshot.source, snapshot.path, read_only=True): snapshot
+                for snapshot in self.snapshots
+            }
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            for future, snapshot in futures.items():
+                if future.exception() is None:
+                    btrfsutil.delete_subvolume(snapshot.path)
+            raise errors[0]
+
+    def mount(self):
+        """Bind-mount every snapshot over its source, read-only and noatime."""
+        bind_mounts((snapshot.path, snapshot.source) for snapshot in self.snapshots)
+
+    def delete(self):
+        for snapshot in self.snapshots:
+            btrfsutil.delete_subvolume(snapshot.path)
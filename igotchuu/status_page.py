@@ -0,0 +1,144 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import mmap
+import time
+import struct
+
+DEFAULT_PATH = "/run/igotchuu/status"
+
+MAGIC = b"igotchuu"
+VERSION = 1
+SIZE = 8192
+# Magic, layout version, page size, sequence number
+HEADER = struct.Struct("<8sIIQ")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 16
+# Writer's pid, flags, wall time of the update, phase, restic's status
+# counters, and the length of the current files that follow
+BODY = struct.Struct("<IId16sQQdQQQQQI")
+BODY_OFFSET = HEADER.size
+FILES_OFFSET = BODY_OFFSET + BODY.size
+FLAG_PAUSED = 1
+
+COUNTERS = (
+    "seconds_elapsed", "seconds_remaining", "percent_done", "total_files",
+    "files_done", "total_bytes", "bytes_done", "error_count",
+)
+
+
+class StatusPage:
+    """The state of the running backup, in a memory-mapped file.
+
+    The page has a fixed layout (see `HEADER` and `BODY`), followed by
+    the files restic is reading, separated by NUL bytes and truncated to
+    fit. Updates are plain writes to the mapping, so publishing costs no
+    system calls, and any number of readers can sample it with
+    `read_status_page()` without disturbing the backup.
+
+    Updates are guarded by a seqlock: the sequence number is odd while
+    an update is being written, and readers retry if it was odd or
+    changed while they copied the page. Only one thread may write at a
+    time."""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Set up the page under a temporary name, so that readers never
+        # see one without a header.
+        tmp = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}")
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE)
+            os.fchmod(fd, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, SIZE, self.sequence)
+        self.write({"phase": "idle"})
+
+    def write(self, fields):
+        """Publish `fields`, as held by `ProgressPublisher`."""
+        files = "\0".join(fields.get("current_files", ())).encode(errors="surrogateescape")
+        files = files[:SIZE - FILES_OFFSET]
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence + 1)
+        BODY.pack_into(
+            self.map, BODY_OFFSET,
+            os.getpid(),
+            FLAG_PAUSED if fields.get("paused", False) else 0,
+            time.time(),
+            fields.get("phase", "").encode()[:16],
+            *(fields.get(name) or 0 for name in COUNTERS),
+            len(files)
+        )
+        self.map[FILES_OFFSET:FILES_OFFSET + len(files)] = files
+        self.sequence += 2
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        """Unmap the page and remove it."""
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _decode(page):
+    magic, version, size, _ = HEADER.unpack_from(page, 0)
+    if magic != MAGIC or version != VERSION or size != SIZE:
+        raise ValueError("not an igotchuu status page of a known version")
+    pid, flags, updated, phase, *counters, files_length = BODY.unpack_from(page, BODY_OFFSET)
+    files = bytes(page[FILES_OFFSET:FILES_OFFSET + files_length])
+    return {
+        "pid": pid,
+        "updated": updated,
+        "phase": phase.rstrip(b"\0").decode(),
+        "paused": bool(flags & FLAG_PAUSED),
+        **dict(zip(COUNTERS, counters)),
+        "current_files": files.decode(errors="surrogateescape").split("\0") if files else [],
+    }
+
+
+def read_status_page(path=DEFAULT_PATH, retries=100):
+    """Read a consistent copy of a status page as a dict.
+
+    Returns `None` if there is no page, i.e. igotchuu isn't running.
+    Raises `ValueError` for a page of an unknown layout, or if it
+    couldn't get a consistent copy."""
+    try:
+        with open(path, "rb") as f:
+            page = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    with page:
+        if len(page) < FILES_OFFSET:
+            raise ValueError("status page is truncated")
+        for _ in range(retries):
+            sequence, = SEQUENCE.unpack_from(page, SEQUENCE_OFFSET)
+            if sequence % 2 == 0:
+                copy = page[:]
+                if SEQUENCE.unpack_from(page, SEQUENCE_OFFSET)[0] == sequence:
+                    return _decode(copy)
+            time.sleep(0.001)
+    raise ValueError("status page is being updated too often to read")
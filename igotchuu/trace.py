@@ -0,0 +1,109 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+"""Timelines of a run in the Chrome trace event format.
+
+`start` begins recording, after which `span` and `complete` add spans
+and `instant` adds markers to the timeline, from any thread. Without a
+running trace they do nothing. `write` saves the timeline as JSON that
+Perfetto and chrome://tracing can load."""
+import os
+import json
+import time
+import threading
+import contextlib
+
+_tracer = None
+
+
+class Tracer:
+    """Collects trace events, timed relative to when it was created."""
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+        self.origin = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _add(self, event, timestamp):
+        tid = threading.get_native_id()
+        event.update(ts=round((timestamp - self.origin) * 1e6), pid=os.getpid(), tid=tid)
+        with self._lock:
+            self.events.append(event)
+            # Named, so threads aren't just numbers in the viewer
+            self.threads[tid] = threading.current_thread().name
+
+    def complete(self, name, started, seconds, **args):
+        """Add span `name` that started at `time.monotonic()` time `started`."""
+        self._add({"name": name, "ph": "X", "dur": round(seconds * 1e6), "args": args}, started)
+
+    def instant(self, name, **args):
+        self._add({"name": name, "ph": "i", "s": "t", "args": args}, time.monotonic())
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Trace the wrapped block as span `name`.
+
+        If the block raises, the exception is added to the span's arguments."""
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            self.complete(name, started, time.monotonic() - started, **args)
+
+    def write(self, path):
+        with self._lock:
+            events = list(self.events)
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self.threads.items()
+            ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+def start():
+    """Start recording a trace, and return the `Tracer`."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(path=None):
+    """Stop recording, writing the trace to `path` if given."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and path is not None:
+        tracer.write(path)
+
+
+def span(name, **args):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **args)
+
+
+def complete(name, started, seconds, **args):
+    if _tracer is not None:
+        _tracer.complete(name, started, seconds, **args)
+
+
+def instant(name, **args):
+    if _tracer is not None:
+        _tracer.instant(name, **args)
@@ -0,0 +1,162 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import json
+import threading
+import subprocess
+import concurrent.futures
+from igotchuu.restic import restic_env
+
+DEFAULT_CACHE_DIR = "/var/cache/igotchuu/restic"
+
+
+def cache_dir(config):
+    """The cache directory igotchuu manages, or `None`.
+
+    `None` unless `warmup` is enabled, or if `restic_args` already choose
+    a cache directory or none at all."""
+    warmup = config.get("warmup", {})
+    restic_args = config.get("restic_args", [])
+    if not warmup.get("enable", False) or any(
+            arg in ("--no-cache", "--cache-dir") or arg.startswith("--cache-dir=")
+            for arg in restic_args
+    ):
+        return None
+    return warmup.get("cache_dir", DEFAULT_CACHE_DIR)
+
+
+def cache_args(config):
+    """restic options to use the cache directory igotchuu manages.
+
+    The directory is created by the backup; restic creates it on its
+    own if anything else runs first."""
+    directory = cache_dir(config)
+    return [] if directory is None else ["--cache-dir", directory]
+
+
+def target_key(target):
+    """What tells repository targets apart: targets of different profiles can share a name."""
+    return (target.name, tuple(sorted(target.repository.items())), tuple(target.args))
+
+
+class WarmupError(Exception):
+    pass
+
+
+class Warmup:
+    """Gets the repository targets of a backup ready while snapshots are made.
+
+    For every target, checks that the repository can be opened and that
+    nobody holds an exclusive lock on it, then has restic load its index
+    (`restic list blobs`) into the cache directory, so that the backup
+    doesn't have to wait for that. Runs in threads, one per target, all
+    with `--no-lock`. Targets that are the same repository with the
+    same options are only warmed up once."""
+    def __init__(self, targets, restic_args=(), verbose=None):
+        self.targets = list({target_key(target): target for target in targets}.values())
+        self.restic_args = list(restic_args)
+        self.verbose = verbose or (lambda *args: None)
+        # `target_key` -> future of the check's outcome
+        self.checked = {target_key(target): concurrent.futures.Future() for target in self.targets}
+        self._pool = None
+        self._futures = []
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def _restic(self, target, *args, output=True):
+        # `restic list blobs` prints every blob in the repository, which
+        # is only run for restic to load the index: don't keep it.
+        with self._lock:
+            if self._cancelled:
+                raise WarmupError("cancelled")
+            process = subprocess.Popen(
+                ["restic", *self.restic_args, *target.args, "--no-lock", *args],
+                env=restic_env(**target.repository),
+                stdout=subprocess.PIPE if output else subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            self._processes.add(process)
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if process.returncode != 0:
+            message = stderr.decode(errors="replace").strip().splitlines()
+            raise WarmupError(message[-1] if message else f"restic exited with status {process.returncode}")
+        return stdout
+
+    def _check(self, target):
+        self._restic(target, "cat", "config")
+        for lock_id in self._restic(target, "list", "locks").split():
+            try:
+                lock = json.loads(self._restic(target, "cat", "lock", lock_id.decode()))
+            except WarmupError:
+                # Removed in the meantime
+                continue
+            if lock.get("exclusive", False):
+                raise WarmupError("locked exclusively by PID {} on {} since {}".format(
+                    lock.get("pid"), lock.get("hostname"), lock.get("time")
+                ))
+
+    def _warm(self, target):
+        try:
+            self._check(target)
+        except Exception as e:
+            self.checked[target_key(target)].set_result(e)
+            return
+        self.checked[target_key(target)].set_result(None)
+        self.verbose("Repository target", target.name, "is reachable, loading its index...")
+        self._restic(target, "list", "blobs", output=False)
+
+    def start(self):
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(self.targets), 1), thread_name_prefix="igotchuu-warmup"
+        )
+        self._futures = [self._pool.submit(self._warm, target) for target in self.targets]
+
+    def check(self):
+        """Wait for the checks. Returns `(target, error)` for the ones that failed."""
+        return [
+            (target, error) for target in self.targets
+            if (error := self.checked[target_key(target)].result()) is not None
+        ]
+
+    def wait(self):
+        """Wait for the index of every reachable target to be loaded.
+
+        Returns the errors; restic will load what is missing on its own."""
+        errors = []
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                # Warming up is only an optimisation, restic copes without it
+                errors.append(e)
+        if self._pool is not None:
+            self._pool.shutdown()
+        return errors
+
+    def cancel(self):
+        """Stop the restic processes that are still running."""
+        with self._lock:
+            self._cancelled = True
+            for process in self._processes:
+                process.terminate()
+        if self._pool is not None:
+            self._pool.shutdown()
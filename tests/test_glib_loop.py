@@ -0,0 +1,69 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import time
+import threading
+import pytest
+
+pytest.importorskip("gi")
+
+from igotchuu.glib_loop import EventLoop
+
+
+def test_call_blocking_keeps_the_loop_running():
+    loop = EventLoop()
+    ticks = []
+    timer = loop.call_later(0.01, lambda: ticks.append(time.monotonic()) or True)
+    name = loop.call_blocking(lambda: time.sleep(0.2) or threading.current_thread().name)
+    loop.remove(timer)
+    assert name != threading.current_thread().name
+    assert len(ticks) >= 5
+
+
+def test_call_blocking_raises_errors_of_the_function_and_callbacks():
+    loop = EventLoop()
+    with pytest.raises(ZeroDivisionError):
+        loop.call_blocking(lambda: 1 / 0)
+    loop.call_later(0.01, lambda: {}["missing"])
+    with pytest.raises(KeyError):
+        loop.call_blocking(time.sleep, 0.1)
+
+
+def test_stop_does_not_end_call_blocking():
+    loop = EventLoop()
+    loop.call_later(0.01, loop.stop)
+    assert loop.call_blocking(lambda: time.sleep(0.1) or "done") == "done"
+
+
+def test_reader_and_invoke_from_another_thread():
+    loop = EventLoop()
+    read_fd, write_fd = os.pipe()
+    received = []
+
+    def readable():
+        data = os.read(read_fd, 100)
+        received.append(data)
+        if not data:
+            loop.stop()
+        return bool(data)
+
+    loop.add_reader(read_fd, readable)
+    threading.Thread(target=lambda: loop.invoke(os.write, write_fd, b"hi") or loop.invoke(os.close, write_fd)).start()
+    loop.run()
+    os.close(read_fd)
+    assert received == [b"hi", b""]
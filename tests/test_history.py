@@ -0,0 +1,81 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import pytest
+from igotchuu.restic import StatusMessage, SummaryMessage
+from igotchuu.history import History, Estimator, job_key, run_key
+
+KEY = job_key(None, "main", ["/home"])
+
+
+def summary(files, unmodified, dry_run=False):
+    return SummaryMessage(
+        total_files_processed=files, files_unmodified=unmodified,
+        total_bytes_processed=files * 1000, data_added=10, total_duration=60.0, dry_run=dry_run
+    )
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = History(str(tmp_path / "history.sqlite3"), window=3)
+    yield history
+    history.close()
+
+
+def record(history, *summaries):
+    for result in summaries:
+        history.record(run_key([KEY]), 0, 60, True, result, [(KEY, result)])
+
+
+def test_collapsed_below_configured_ratio(history):
+    record(history, summary(100, 90), summary(100, 95), summary(100, 90))
+    assert history.collapsed(KEY, summary(100, 50), ratio=0.5) is None
+    assert history.collapsed(KEY, summary(100, 40), ratio=0.5) == 0.9
+    assert history.collapsed(KEY, summary(100, 80), ratio=0.95) == 0.9
+
+
+def test_collapsed_uses_only_the_configured_ratio(history):
+    # Usually only 40% of the files are unmodified; a drop to 10% still
+    # counts, there is no separate floor on the usual share
+    record(history, summary(100, 40), summary(100, 40))
+    assert history.collapsed(KEY, summary(100, 10), ratio=0.5) == 0.4
+    assert history.collapsed(KEY, summary(100, 30), ratio=0.5) is None
+
+
+def test_collapsed_needs_history_and_real_runs(history):
+    assert history.collapsed(KEY, summary(100, 0)) is None
+    record(history, summary(100, 90))
+    assert history.collapsed(KEY, summary(100, 0, dry_run=True)) is None
+    assert history.collapsed(KEY, summary(0, 0)) is None
+    # Dry runs aren't recorded as jobs
+    record(history, summary(100, 0, dry_run=True))
+    assert history.unmodified_ratio(KEY) == 0.9
+
+
+def test_window(history):
+    record(history, summary(100, 0), summary(100, 90), summary(100, 90), summary(100, 90))
+    assert history.unmodified_ratio(KEY) == 0.9
+    assert history.expected(KEY) == (100000, 60)
+    assert history.expected_run(run_key([KEY])) == (100000, 60)
+
+
+def test_estimator_uses_history_until_warmed_up():
+    estimator = Estimator(expected_bytes=1000, expected_seconds=100, warmup=30)
+    assert estimator.seconds_remaining(StatusMessage(seconds_elapsed=10, bytes_done=100)) == 90
+    # After the warm-up, the speed of this run, and restic's total once known
+    assert estimator.seconds_remaining(StatusMessage(seconds_elapsed=40, bytes_done=200)) == 160
+    assert estimator.seconds_remaining(StatusMessage(seconds_elapsed=40, bytes_done=200, total_bytes=400)) == 40
@@ -0,0 +1,46 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import pytest
+
+pytest.importorskip("btrfsutil")
+
+from igotchuu import janitor
+from igotchuu.snapshot import Snapshot
+
+
+def test_collect_retries_own_failed_deletions(tmp_path, monkeypatch):
+    journal = janitor.SnapshotJournal(str(tmp_path / "snapshots.json"))
+    failed, running = Snapshot("/home", "/home-failed"), Snapshot("/srv", "/srv-running")
+    journal.add([failed, running])
+
+    monkeypatch.setattr(janitor, "delete_subvolumes", lambda paths: ({}, {path: OSError() for path in paths}))
+    cleaner = janitor.Janitor(journal)
+    cleaner.delete_now([failed.path])
+    assert failed.path in journal.entries()
+
+    deleted = []
+
+    def delete_subvolumes(paths):
+        deleted.extend(paths)
+        return {}, {}
+
+    monkeypatch.setattr(janitor, "delete_subvolumes", delete_subvolumes)
+    cleaner.collect()
+    # The snapshot of the backup still running is left alone
+    assert deleted == [failed.path]
+    assert list(journal.entries()) == [running.path]
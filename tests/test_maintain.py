@@ -0,0 +1,79 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import json
+import contextlib
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("btrfsutil")
+pytest.importorskip("unshare")
+
+from igotchuu.maintain import run_maintenance
+
+FAKE_RESTIC = """#!/bin/sh
+case "$*" in
+    *prune*) exec sleep 60 ;;
+esac
+"""
+
+
+class Pausing:
+    paused = False
+
+    def attach(self, restic):
+        pass
+
+    def detach(self):
+        pass
+
+
+class Publisher:
+    def set_phase(self, phase):
+        pass
+
+
+class BackupManager:
+    def __init__(self):
+        self.pausing = Pausing()
+        self.publisher = Publisher()
+
+    def Stop(self):
+        self.restic.terminate()
+
+
+class Logind:
+    @contextlib.contextmanager
+    def inhibit(self, *args):
+        yield
+
+
+def test_prune_out_of_budget_is_incomplete(tmp_path, monkeypatch):
+    restic = tmp_path / "restic"
+    restic.write_text(FAKE_RESTIC)
+    restic.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    config = {
+        "repo": str(tmp_path / "repository"),
+        "state_dir": str(tmp_path),
+        "maintain": {"prune_time_budget": 0.5, "prune_max_repack_size": "1G"},
+    }
+    assert not run_maintenance(config, BackupManager(), Logind(), steps=("prune", "check"))
+    [state] = json.loads((tmp_path / "maintenance.json").read_text()).values()
+    assert "last_prune" not in state
+    assert "last_check" in state
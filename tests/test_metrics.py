@@ -0,0 +1,38 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import urllib.request
+import pytest
+from igotchuu.metrics import Metrics
+
+
+def test_serving_releases_the_port_on_errors():
+    metrics = Metrics()
+    with pytest.raises(RuntimeError):
+        with metrics.serving("127.0.0.1:0") as server:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                assert b"igotchuu_" in response.read()
+            raise RuntimeError
+    # A later backup can listen on the same port again
+    with metrics.serving(f"127.0.0.1:{port}") as server:
+        assert server.server_address[1] == port
+
+
+def test_serving_nothing():
+    with Metrics().serving(None) as server:
+        assert server is None
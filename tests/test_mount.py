@@ -0,0 +1,40 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+from igotchuu import mount
+from igotchuu.mount import _unescape_mountinfo
+
+
+def test_unescape_octal_escapes():
+    assert _unescape_mountinfo(rb"/mnt/with\040space\011tab\134backslash") == "/mnt/with space\ttab\\backslash"
+
+
+def test_unescape_keeps_non_ascii():
+    assert _unescape_mountinfo("/home/jürgen/ファイル".encode()) == "/home/jürgen/ファイル"
+    assert _unescape_mountinfo("/mnt/ü\\040x".encode()) == "/mnt/ü x"
+
+
+def test_unescape_keeps_undecodable_bytes():
+    assert _unescape_mountinfo(b"/mnt/\xff") == "/mnt/\udcff"
+
+
+def test_unknown_syscall_numbers_fall_back(monkeypatch):
+    # As on MIPS, where the new mount API isn't used
+    monkeypatch.setattr(mount, "SYS_mount_setattr", None)
+    monkeypatch.setattr(mount, "_new_api", True)
+    assert mount._with_fallback(lambda: mount.mount_setattr("/"), lambda: "legacy") == "legacy"
+    assert not mount._new_api
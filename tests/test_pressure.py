@@ -0,0 +1,54 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+from igotchuu.pressure import PauseControl, PressureMonitor
+
+
+def write_pressure(directory, resource, some):
+    (directory / resource).write_text(
+        f"some avg10={some:.2f} avg60=0.00 avg300=0.00 total=0\n"
+        "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+    )
+
+
+def test_pressure_monitor_pauses_and_resumes(tmp_path):
+    control = PauseControl()
+    monitor = PressureMonitor(control, {"io": {"pause": 40, "resume": 10}}, min_pause=0, directory=tmp_path)
+    write_pressure(tmp_path, "io", 50)
+    monitor.check()
+    assert control.reasons == {"pressure"}
+    write_pressure(tmp_path, "io", 20)
+    monitor.check()
+    assert control.paused
+    write_pressure(tmp_path, "io", 5)
+    monitor.check()
+    assert not control.paused
+
+
+def test_pressure_monitor_tolerates_missing_thresholds(tmp_path, capsys):
+    control = PauseControl()
+    monitor = PressureMonitor(
+        control, {"io": {"pause": 40}, "memory": {"resume": 5}, "cpu": 90}, min_pause=0, directory=tmp_path
+    )
+    assert monitor.thresholds == {"io": {"pause": 40, "resume": 40}}
+    assert "memory" in capsys.readouterr().err
+    write_pressure(tmp_path, "io", 50)
+    monitor.check()
+    assert control.paused
+    write_pressure(tmp_path, "io", 30)
+    monitor.check()
+    assert not control.paused
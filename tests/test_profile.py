@@ -0,0 +1,59 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import click
+import pytest
+from igotchuu.profile import merge_config, profile_config, profile_names
+
+CONFIG = {
+    "places": ["/home"],
+    "restic_args": ["-x"],
+    "metrics": {"textfile": "/a", "listen": "[::1]:9000"},
+    "profiles": {
+        "quick": {"places": ["/home/user"], "metrics": {"textfile": "/b"}},
+        "offsite": {"restic_args": ["--limit-upload", "1000"]},
+    },
+}
+
+
+def test_merge_config_merges_tables_and_replaces_arrays():
+    merged = merge_config(CONFIG, CONFIG["profiles"]["quick"])
+    assert merged["places"] == ["/home/user"]
+    assert merged["metrics"] == {"textfile": "/b", "listen": "[::1]:9000"}
+    assert merged["restic_args"] == ["-x"]
+    # The base config is left alone
+    assert CONFIG["metrics"]["textfile"] == "/a"
+
+
+def test_profile_config_drops_profiles():
+    assert "profiles" not in profile_config(CONFIG, None)
+    config = profile_config(CONFIG, "offsite")
+    assert "profiles" not in config
+    assert config["restic_args"] == ["--limit-upload", "1000"]
+    with pytest.raises(click.BadParameter):
+        profile_config(CONFIG, "missing")
+
+
+def test_profile_names():
+    assert profile_names(CONFIG, "all") == ["quick", "offsite"]
+    assert profile_names(CONFIG, " offsite, quick,offsite ") == ["offsite", "quick"]
+    with pytest.raises(click.BadParameter):
+        profile_names(CONFIG, "quick,missing")
+    with pytest.raises(click.BadParameter):
+        profile_names(CONFIG, " , ")
+    with pytest.raises(click.BadParameter):
+        profile_names({}, "all")
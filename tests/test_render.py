@@ -0,0 +1,65 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import io
+from igotchuu.restic import StatusMessage
+from igotchuu.render import Renderer
+
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def render(renderer, status):
+    renderer.update(status)
+    renderer.render()
+
+
+def test_tty_shows_scan_until_restic_knows_the_total():
+    out = Terminal()
+    renderer = Renderer(stdout=out)
+    render(renderer, StatusMessage(total_files=10, files_done=2, bytes_done=1024**3))
+    assert out.getvalue().startswith("[scan...] 2/10 files,  1.00G uploaded")
+    render(renderer, StatusMessage(total_files=10, files_done=5, total_bytes=4 * 1024**3,
+                                   bytes_done=1024**3, percent_done=0.25, seconds_remaining=30))
+    assert out.getvalue().split("\r")[1].startswith("[ 25.00%] 5/10 files,  1.00/ 4.00G uploaded")
+
+
+def test_tty_without_scan_shows_what_is_done():
+    out = Terminal()
+    renderer = Renderer(stdout=out, scan=False)
+    render(renderer, StatusMessage(files_done=7, bytes_done=2 * 1024**3))
+    assert out.getvalue() == "7 files,  2.00G uploaded \r"
+
+
+def test_log_prints_each_permille_after_scan():
+    err = io.StringIO()
+    renderer = Renderer(stdout=io.StringIO(), stderr=err)
+    render(renderer, StatusMessage(percent_done=0.5))
+    assert err.getvalue() == ""
+    render(renderer, StatusMessage(percent_done=0.5, seconds_remaining=10))
+    render(renderer, StatusMessage(percent_done=0.5004, seconds_remaining=10))
+    assert err.getvalue() == "50.0%\n"
+
+
+def test_log_without_scan_prints_every_interval():
+    err = io.StringIO()
+    renderer = Renderer(stdout=io.StringIO(), stderr=err, scan=False, log_interval=3600)
+    render(renderer, StatusMessage(files_done=1, bytes_done=0))
+    render(renderer, StatusMessage(files_done=2, bytes_done=0))
+    assert err.getvalue() == "1 files,  0.00G uploaded\n"
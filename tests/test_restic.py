@@ -0,0 +1,121 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import json
+import pytest
+from igotchuu.restic import ProgressReader, RESTORE_MESSAGE_TYPES, restic_version
+
+
+def lines(*objects):
+    return b"".join(json.dumps(obj).encode() + b"\n" for obj in objects)
+
+
+def status(**fields):
+    return {"message_type": "status", **fields}
+
+
+def make_reader(**kwargs):
+    read_fd, write_fd = os.pipe()
+    return ProgressReader(read_fd, **kwargs), write_fd
+
+
+def test_partial_line_waits_for_newline():
+    reader, fd = make_reader()
+    data = lines(status(files_done=1))
+    os.write(fd, data[:10])
+    assert reader.read() == []
+    os.write(fd, data[10:])
+    [message] = reader.read()
+    assert message.files_done == 1
+    assert message.seconds_remaining is None
+    os.close(fd)
+
+
+def test_batch_skips_garbage_and_unknown_types():
+    reader, fd = make_reader()
+    os.write(fd, b"not json\n" + lines(
+        {"message_type": "verbose_status"},
+        status(files_done=1),
+        {"message_type": "error", "error": {"message": "oops"}, "during": "scan", "item": "/x"},
+    ))
+    status_message, error = reader.read()
+    assert status_message.files_done == 1
+    assert (error.error, error.during, error.item) == ("oops", "scan", "/x")
+    os.close(fd)
+
+
+def test_coalesce_keeps_last_status_of_each_run():
+    reader, fd = make_reader(coalesce_status=True)
+    os.write(fd, lines(
+        status(files_done=1), status(files_done=2),
+        {"message_type": "error", "error": "e"},
+        status(files_done=3), status(files_done=4),
+    ))
+    messages = reader.read()
+    assert [message.message_type for message in messages] == ["status", "error", "status"]
+    assert [messages[0].files_done, messages[2].files_done] == [2, 4]
+    os.close(fd)
+
+
+def test_eof_flushes_unterminated_line():
+    reader, fd = make_reader()
+    os.write(fd, lines(status(files_done=1)) + json.dumps({"message_type": "summary", "snapshot_id": "abc"}).encode())
+    os.close(fd)
+    messages = []
+    while not reader.eof:
+        messages.extend(reader.read())
+    assert [message.message_type for message in messages] == ["status", "summary"]
+    assert messages[1].snapshot_id == "abc"
+
+
+def test_large_output_is_read_in_chunks():
+    reader, fd = make_reader(chunk_size=64)
+    os.write(fd, lines(*(status(files_done=i) for i in range(100))))
+    os.close(fd)
+    messages = []
+    while not reader.eof:
+        messages.extend(reader.read())
+    assert [message.files_done for message in messages] == list(range(100))
+
+
+def test_restore_status_estimates_time_left():
+    reader, fd = make_reader(message_types=RESTORE_MESSAGE_TYPES)
+    os.write(fd, lines(status(
+        seconds_elapsed=10, total_bytes=300, bytes_restored=50, bytes_skipped=50,
+        files_restored=1, files_skipped=2
+    )))
+    [message] = reader.read()
+    assert (message.files_done, message.bytes_done, message.seconds_remaining) == (3, 100, 20)
+    os.close(fd)
+
+
+@pytest.mark.parametrize("output, version", [
+    ("restic 0.17.3 compiled with go1.22.5 on linux/amd64", (0, 17, 3)),
+    ("restic 0.16.4 compiled with go1.21.6 on linux/amd64", (0, 16, 4)),
+    ("something else", None),
+])
+def test_restic_version(tmp_path, monkeypatch, output, version):
+    restic = tmp_path / "restic"
+    restic.write_text(f"#!/bin/sh\necho '{output}'\n")
+    restic.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path))
+    restic_version.cache_clear()
+    try:
+        assert restic_version() == version
+    finally:
+        restic_version.cache_clear()
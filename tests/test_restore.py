@@ -0,0 +1,140 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import stat
+import shutil
+import subprocess
+import pytest
+
+pytest.importorskip("gi")
+
+from igotchuu.restic import RepositoryTarget
+from igotchuu.restore import (
+    Tree, make_shards, split_directories, restore_directories, escape_pattern, split_patterns, run_restore
+)
+
+# Names restic would mangle in a pattern file
+AWKWARD_NAMES = ("$HOME", "${USER}x", "trailing ", "new\nline", "tab\t")
+
+
+def directory(mode=0o755, mtime="2024-01-02T03:04:05.5Z"):
+    return {"mode": (1 << 31) | mode, "uid": 0, "gid": 0, "mtime": mtime, "atime": mtime}
+
+
+@pytest.fixture
+def tree():
+    tree = Tree()
+    tree.add("/home", directory=True, metadata=directory(0o711))
+    tree.add("/home/a", directory=True, metadata=directory(0o700))
+    for name in ("x", "y", "z"):
+        tree.add(f"/home/a/{name}", 100)
+    tree.add("/home/b", 50)
+    tree.add("/etc", directory=True, metadata=directory())
+    tree.add("/etc/passwd", 10)
+    return tree
+
+
+def test_make_shards_splits_big_directories(tree):
+    shards = make_shards(tree, 4)
+    assert sorted(path for _, paths in shards for path in paths) == [
+        "/etc", "/home/a/x", "/home/a/y", "/home/a/z", "/home/b"
+    ]
+    assert sum(size for size, _ in shards) == tree.size == 360
+    assert max(size for size, _ in shards) == 100
+
+
+def test_make_shards_single():
+    tree = Tree()
+    tree.add("/file", 10)
+    assert make_shards(tree, 4) == [(10, ["/file"])]
+
+
+def test_split_directories(tree):
+    directories = split_directories(tree, make_shards(tree, 4))
+    assert directories == {"/home": directory(0o711), "/home/a": directory(0o700)}
+
+
+def test_restore_directories(tmp_path):
+    (tmp_path / "home" / "a").mkdir(parents=True)
+    restore_directories(str(tmp_path), {
+        "/home": directory((1 << 20) | 0o711),  # Go's sticky bit
+        "/home/a": directory(0o700, "2024-01-02T04:04:05.25+01:00"),
+        "/missing": directory(),
+    })
+    home = os.lstat(tmp_path / "home")
+    assert stat.S_IMODE(home.st_mode) == stat.S_ISVTX | 0o711
+    assert home.st_mtime_ns == 1704164645500000000
+    assert os.lstat(tmp_path / "home" / "a").st_mtime_ns == 1704164645250000000
+
+
+def test_escape_pattern():
+    assert escape_pattern("/a/*b?[c]\\d") == "/a/\\*b\\?\\[c]\\\\d"
+    assert escape_pattern("/$HOME/${USER}") == "/[$]HOME/[$]{USER}"
+    assert escape_pattern("#x") == "\\#x"
+
+
+def test_split_patterns():
+    paths = ["/plain", "/$HOME", "/trailing ", "/new\nline", "/tab\t", "/in side"]
+    assert split_patterns(paths) == (
+        ["/plain", "/[$]HOME", "/in side"],
+        ["/trailing ", "/new\nline", "/tab\t"],
+    )
+
+
+def metadata(root):
+    result = {}
+    for directory, names, files in os.walk(root):
+        for path in [directory, *(os.path.join(directory, name) for name in files)]:
+            info = os.lstat(path)
+            result[os.path.relpath(path, root)] = (info.st_mode, info.st_uid, info.st_gid, info.st_mtime_ns)
+    return result
+
+
+@pytest.mark.skipif(shutil.which("restic") is None, reason="needs restic")
+def test_sharded_restore_matches_restic(tmp_path):
+    source = tmp_path / "source"
+    for i, mode in enumerate((0o750, 0o705, 0o2775)):
+        sub = source / f"dir{i}" / "sub"
+        sub.mkdir(parents=True)
+        for j in range(3):
+            (sub / f"file{j}").write_bytes(os.urandom(1000 * (i + j + 1)))
+        os.chmod(source / f"dir{i}", mode)
+        os.utime(sub, ns=(10**18, 10**18 + i))
+        os.utime(source / f"dir{i}", ns=(10**18, 10**18 + 10 + i))
+    for name in AWKWARD_NAMES:
+        (source / name).write_bytes(os.urandom(5000))
+    os.utime(source, ns=(10**18, 10**18 + 20))
+    (tmp_path / "password").write_text("password")
+    repository = {"repo": str(tmp_path / "repository"), "password_file": str(tmp_path / "password")}
+    env = dict(os.environ, RESTIC_REPOSITORY=repository["repo"], RESTIC_PASSWORD_FILE=repository["password_file"])
+    subprocess.run(["restic", "init"], env=env, check=True, capture_output=True)
+    subprocess.run(["restic", "backup", str(source)], env=env, check=True, capture_output=True)
+
+    subprocess.run(
+        ["restic", "restore", "latest", "--target", str(tmp_path / "plain")],
+        env=env, check=True, capture_output=True
+    )
+    # Deep enough for the files in `source` to be shards of their own
+    config = {"state_dir": str(tmp_path / "state"), "restore": {"max_depth": 20}}
+    os.mkdir(config["state_dir"])
+    target = RepositoryTarget("default", repository, [], None)
+    assert run_restore(config, target, "latest", str(tmp_path / "sharded"), jobs=2, shards=3)
+
+    assert metadata(tmp_path / "sharded") == metadata(tmp_path / "plain")
+    restored = tmp_path / "sharded" / source.relative_to("/")
+    assert all((restored / name).read_bytes() == (source / name).read_bytes() for name in AWKWARD_NAMES)
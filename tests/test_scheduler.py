@@ -0,0 +1,64 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+from igotchuu.restic import StatusMessage
+from igotchuu.scheduler import BackupJob, group_places, merge_status
+
+
+def job(status=None, returncode=None):
+    result = BackupJob(["/x"])
+    result.status = status
+    result.returncode = returncode
+    return result
+
+
+def test_group_places():
+    assert group_places(["/a", "/b", "/c"], [["/c", "/a", "/missing"]]) == [["/c", "/a"], ["/b"]]
+
+
+def test_merge_status_while_scanning():
+    merged = merge_status([
+        job(StatusMessage(seconds_elapsed=5, percent_done=0.5, total_files=10, files_done=4,
+                          total_bytes=100, bytes_done=50, seconds_remaining=10, current_files=["/a"])),
+        job(StatusMessage(seconds_elapsed=7, total_files=3, files_done=1, bytes_done=5, current_files=["/b"])),
+    ])
+    assert merged.seconds_remaining is None
+    assert merged.total_bytes is None
+    assert merged.percent_done == 0.25
+    assert (merged.seconds_elapsed, merged.total_files, merged.files_done, merged.bytes_done) == (7, 13, 5, 55)
+    assert merged.current_files == ["/a", "/b"]
+
+
+def test_merge_status_job_not_started_counts_as_scanning():
+    merged = merge_status([
+        job(StatusMessage(total_bytes=100, bytes_done=50, seconds_remaining=10)),
+        job(),
+    ])
+    assert merged.seconds_remaining is None
+
+
+def test_merge_status_after_scan():
+    merged = merge_status([
+        job(StatusMessage(total_bytes=100, bytes_done=50, seconds_remaining=10, current_files=["/a"])),
+        job(StatusMessage(total_bytes=300, bytes_done=50, seconds_remaining=30, current_files=["/b"])),
+        job(StatusMessage(total_bytes=100, bytes_done=100, seconds_remaining=0, current_files=["/c"]), returncode=0),
+    ])
+    assert merged.seconds_remaining == 30
+    assert merged.total_bytes == 500
+    assert merged.percent_done == 200 / 500
+    # Finished jobs aren't reading anything any more
+    assert merged.current_files == ["/a", "/b"]
@@ -0,0 +1,81 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import pytest
+from igotchuu import status_page
+from igotchuu.status_page import StatusPage, read_status_page
+
+
+@pytest.fixture
+def page(tmp_path):
+    page = StatusPage(str(tmp_path / "status"))
+    yield page
+    page.close()
+
+
+def test_layout():
+    # Readers in other languages rely on these offsets
+    assert status_page.HEADER.size == 24
+    assert status_page.SEQUENCE_OFFSET == 16
+    assert status_page.BODY.size == 100
+    assert status_page.FILES_OFFSET == 124
+
+
+def test_round_trip(page):
+    page.write({
+        "phase": "backup", "paused": True, "seconds_elapsed": 10, "percent_done": 0.5,
+        "total_bytes": None, "bytes_done": 1234, "current_files": ["/a b", "/ü"],
+    })
+    status = read_status_page(page.path)
+    assert status["pid"] == os.getpid()
+    assert (status["phase"], status["paused"]) == ("backup", True)
+    assert (status["seconds_elapsed"], status["percent_done"], status["total_bytes"], status["bytes_done"]) == (10, 0.5, 0, 1234)
+    assert status["current_files"] == ["/a b", "/ü"]
+
+
+def test_sequence_is_even_between_updates(page):
+    sequence = page.sequence
+    page.write({"phase": "snapshot"})
+    assert page.sequence == sequence + 2
+    assert status_page.SEQUENCE.unpack_from(page.map, status_page.SEQUENCE_OFFSET)[0] == page.sequence
+
+
+def test_reader_retries_while_updating(page):
+    status_page.SEQUENCE.pack_into(page.map, status_page.SEQUENCE_OFFSET, page.sequence + 1)
+    with pytest.raises(ValueError):
+        read_status_page(page.path, retries=3)
+
+
+def test_current_files_are_truncated(page):
+    page.write({"current_files": ["/" + "x" * status_page.SIZE]})
+    [name] = read_status_page(page.path)["current_files"]
+    assert len(name) == status_page.SIZE - status_page.FILES_OFFSET
+
+
+def test_missing_and_unknown_pages(tmp_path):
+    assert read_status_page(str(tmp_path / "missing")) is None
+    other = tmp_path / "other"
+    other.write_bytes(b"\0" * status_page.SIZE)
+    with pytest.raises(ValueError):
+        read_status_page(str(other))
+
+
+def test_close_removes_the_page(tmp_path):
+    page = StatusPage(str(tmp_path / "status"))
+    page.close()
+    assert not os.path.exists(page.path)
@@ -0,0 +1,75 @@
+# Copyright © 2024 nyantec GmbH <oss@nyantec.com>
+# Written by Vika Shleina <vsh@nyantec.com>
+#
+# Provided that these terms and disclaimer and all copyright notices
+# are retained or reproduced in an accompanying document, permission
+# is granted to deal in this work without restriction, including un‐
+# limited rights to use, publicly perform, distribute, sell, modify,
+# merge, give away, or sublicence.
+#
+# This work is provided "AS IS" and WITHOUT WARRANTY of any kind, to
+# the utmost extent permitted by applicable law, neither express nor
+# implied; without malicious intent or gross negligence. In no event
+# may a licensor, author or contributor be held liable for indirect,
+# direct, other damage, loss, or other issues arising in any way out
+# of dealing in the work, even if advised of the possibility of such
+# damage or existence of a defect, except proven that it results out
+# of said person's immediate fault when using the work as intended.
+import os
+import pytest
+from igotchuu.restic import RepositoryTarget
+from igotchuu.warmup import Warmup, cache_args
+
+FAKE_RESTIC = """#!/bin/sh
+case "$RESTIC_REPOSITORY:$*" in
+    broken:*) echo "Fatal: unable to open config file" >&2; exit 1 ;;
+    *"list locks") echo 1234 ;;
+    *"cat lock 1234") echo '{"exclusive": false, "pid": 1}' ;;
+    *"list blobs") yes blob | head -n 100000 ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_restic(tmp_path, monkeypatch):
+    restic = tmp_path / "restic"
+    restic.write_text(FAKE_RESTIC)
+    restic.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+
+def target(name, repo):
+    return RepositoryTarget(name, {"repo": repo}, [], None)
+
+
+def test_warmup_reports_failed_checks(fake_restic):
+    warmup = Warmup([target("good", "good"), target("bad", "broken")])
+    warmup.start()
+    failed = warmup.check()
+    assert [(broken.name, str(error)) for broken, error in failed] == [("bad", "Fatal: unable to open config file")]
+    assert warmup.wait() == []
+
+
+def test_warmup_tells_targets_with_the_same_name_apart(fake_restic):
+    # Two profiles, each with its own repository as the default target
+    good, bad = target("default", "good"), target("default", "broken")
+    warmup = Warmup([good, bad, good])
+    assert warmup.targets == [good, bad]
+    warmup.start()
+    assert [broken for broken, _ in warmup.check()] == [bad]
+    assert warmup.wait() == []
+
+
+def test_warmup_wait_survives_bugs(fake_restic, monkeypatch):
+    warmup = Warmup([target("good", "good")])
+    monkeypatch.setattr(warmup, "_check", lambda target: None)
+    monkeypatch.setattr(warmup, "_restic", lambda *args, **kwargs: 1 / 0)
+    warmup.start()
+    assert [type(error) for error in warmup.wait()] == [ZeroDivisionError]
+
+
+def test_cache_args_have_no_side_effects(tmp_path):
+    config = {"warmup": {"enable": True, "cache_dir": str(tmp_path / "cache")}}
+    assert cache_args(config) == ["--cache-dir", str(tmp_path / "cache")]
+    assert not (tmp_path / "cache").exists()
+    assert cache_args(dict(config, restic_args=["--no-cache"])) == []